@@ -7,14 +7,17 @@ import time
 
 from concurrent.futures import ThreadPoolExecutor
 from logging import handlers
-from multiprocessing import Queue
+from threading import Lock
 from timeit import default_timer as timer
 from typing import Optional
 
 from lib import control
 from lib.control import ControlManager
+from lib.cutoff import CutoffEngine, settle_time, wait_for_settle
 from lib.display import Display, DisplayData, DisplaySize
-from lib.pyacaia import AcaiaScale
+from lib.latency import LatencyTracker, ShotLatency
+from lib.periodic import PeriodicThread
+from lib.pyacaia import AcaiaScale, LinkWatchdog
 from lib.webserver import WebServer
 
 WEB_PORT = 80
@@ -22,12 +25,33 @@ WEB_DIR = '/opt/apollo/web'
 MIN_GOOD_SHOT_DURATION = 10
 
 stop = False
+report_requested = False
 overshoot_update_executor = ThreadPoolExecutor(max_workers=1)
+cutoff_lock = Lock()
+# weight samples handed to the cutoff engine, enough to cover its flow window
+CUTOFF_SAMPLES = 32
+# a tick without a new weight repeats the last flow rate for this long, ticks and notifications both run at
+# about 10Hz so ticks regularly fall between two weights. After that the scale has gone quiet, flow shows 0
+FLOW_HOLD = 0.5
+# how often the connection thread checks on the scale
+CONNECT_PERIOD = 0.25
+# display feeding and connecting run at this nice value, below the control thread
+BACKGROUND_NICE = 10
+control_thread: Optional[PeriodicThread] = None
+# timings along the path from a weight notification to the relay opening, logged on SIGUSR1
+latency = LatencyTracker()
 
 logLevel = os.environ.get('LOGLEVEL', 'INFO').upper()
 logPath = os.environ.get('LOGFILE', '/var/log/apollo.log')
 
 refreshRate = float(os.environ.get('REFRESH_RATE', '0.1'))
+scaleSimulator = float(os.environ.get('SCALE_SIMULATOR', '0'))
+scaleCapture = os.environ.get('SCALE_CAPTURE', '')
+scaleProfilePath = os.environ.get('SCALE_PROFILE_CACHE', '/opt/apollo/scale.json')
+scaleAllowlist = control.parse_mac_allowlist(os.environ.get('SCALE_MAC_ALLOWLIST', ''))
+memoryStatePath = os.environ.get('MEMORY_STATE', '/opt/apollo/memories.json')
+memorySaveInterval = float(os.environ.get('MEMORY_SAVE_INTERVAL', '30'))
+controlPriority = int(os.environ.get('CONTROL_RT_PRIORITY', '10'))
 smoothing = round(1 / refreshRate)
 
 stdout_handler = logging.StreamHandler(stream=sys.stdout)
@@ -42,75 +66,206 @@ logging.basicConfig(
 )
 
 
-def update_overshoot(scale: AcaiaScale, mgr: ControlManager):
+def update_overshoot(scale: AcaiaScale, mgr: ControlManager, cutoff: CutoffEngine, cut_time: float,
+                     shot: Optional[ShotLatency]):
     if mgr.shot_time_elapsed() < MIN_GOOD_SHOT_DURATION:
         logging.info("Declining to consider short shot as a good shot. Not updating overshoot value or saving image")
         return
-    time.sleep(3)
-    logging.debug("over scale weight is %.2f, target was %.2f" % (scale.weight, mgr.current_memory().target))
-    mgr.current_memory().update_overshoot(scale.weight)
+    final_weight = wait_for_settle(scale.weight_samples, cut_time)
     mgr.image_needs_save = True
+    logging.debug("scale link: %s" % scale.link_stats())
+    if final_weight is None:
+        logging.warning("Scale didn't settle after the shot, not learning from it")
+        return
+    logging.debug("settled after %.1fs, weight is %.2f, target was %.2f" %
+                  (time.monotonic() - cut_time, final_weight, mgr.current_memory().target))
+    if shot is not None:
+        samples = [s for s in scale.weight_samples.since(0) if s[0] >= cut_time]
+        settled = settle_time(samples, final_weight)
+        if settled is not None:
+            latency.settled(shot, settled, final_weight)
+        logging.info("cutoff latency: %s" % shot)
+    # learns the lag, and the overshoot in the way that fits how the relay was cut
+    report = cutoff.finish_shot(mgr.current_memory(), final_weight)
+    if report is not None:
+        logging.info("shot %s" % report)
+    if control_thread is not None:
+        logging.debug("control loop: %s" % control_thread.stats())
     logging.info("new overshoot on memory %s is %.2f" %(mgr.current_memory().name, mgr.current_memory().overshoot))
 
 
-def check_target_disable_relay(scale: AcaiaScale, mgr: ControlManager):
-    if mgr.relay_on() and scale.weight > mgr.current_memory().target_minus_overshoot():
-        mgr.disable_relay()
-        overshoot_update_executor.submit(update_overshoot, scale, mgr)
-        logging.debug("Scheduling overshoot check and update")
+def cut_relay(scale: AcaiaScale, mgr: ControlManager, cutoff: CutoffEngine):
+    # called by the cutoff engine, from the notification thread or its timer
+    with cutoff_lock:
+        if mgr.relay_on():
+            mgr.disable_relay()
+            cut_time = time.monotonic()
+            point = cutoff.last_cut
+            shot = None
+            if point is not None and point.decided is not None:
+                shot = ShotLatency(mgr.current_memory().name, point.sample_time, point.decoded, point.planned,
+                                   point.decided, cut_time)
+                latency.cut(shot)
+                logging.debug("Relay cut, %s" % shot)
+            overshoot_update_executor.submit(update_overshoot, scale, mgr, cutoff, cut_time, shot)
+            logging.debug("Scheduling overshoot check and update")
+
+
+def abandon_shot(mgr: ControlManager, cutoff: CutoffEngine):
+    # the watchdog couldn't get weights back in time, stop rather than pour without a scale
+    cutoff.cancel()
+    with cutoff_lock:
+        if mgr.relay_on():
+            logging.error("Lost the scale mid-shot, cutting the relay")
+            mgr.disable_relay()
+
+
+def check_target_disable_relay(scale: AcaiaScale, mgr: ControlManager, cutoff: CutoffEngine, sequence: int,
+                               decoded: Optional[float] = None):
+    if mgr.relay_on():
+        cutoff.on_weight(mgr.current_memory(), scale.weight_samples.since(sequence - CUTOFF_SAMPLES),
+                         decoded=decoded)
+
+
+def handle_weight(scale: AcaiaScale, mgr: ControlManager, cutoff: CutoffEngine, arrival: float, sequence: int):
+    # runs on the scale's notification thread for every weight, see AcaiaScale.add_weight_listener
+    decoded = scale.decode_time
+    check_target_disable_relay(scale, mgr, cutoff, sequence, decoded)
+    latency.notification(arrival, decoded)
+
+
+def log_stats(scale: AcaiaScale):
+    logging.info("cutoff latency: %s" % latency.snapshot())
+    if control_thread is not None:
+        logging.info("control loop: %s" % control_thread.stats())
+    logging.info("scale link: %s" % scale.link_stats())
+
+
+def update_control(scale: AcaiaScale, mgr: ControlManager, cutoff: CutoffEngine, last_sample: tuple) -> tuple:
+    # runs every refreshRate on the control thread, keep it to the flow and the relay
+    samples = scale.weight_samples.since(last_sample[2] if last_sample is not None else 0)
+    if last_sample is not None:
+        # flow comes from the notifications' own arrival times, not from when we happen to poll
+        if samples and samples[-1][0] > last_sample[0]:
+            g_per_s = round((samples[-1][1] - last_sample[1]) / (samples[-1][0] - last_sample[0]), 1)
+        elif time.monotonic() - last_sample[0] < FLOW_HOLD:
+            g_per_s = mgr.last_flow_rate()
+        else:
+            g_per_s = 0.0
+        mgr.add_flow_rate_data(g_per_s)
+    if samples:
+        last_sample = samples[-1]
+    elif last_sample is not None and mgr.relay_on() and scale.connected:
+        # no notification since the last tick, a predicted cut that falls in the gap still has to happen
+        check_target_disable_relay(scale, mgr, cutoff, last_sample[2])
+    return last_sample
 
 
 def main():
+    global control_thread, report_requested
+
     web_server = WebServer(WEB_DIR, WEB_PORT)
     web_server.start()
     logging.info("Started web server")
 
-    display_data_queue: Queue[DisplayData] = Queue()
-    display = Display(display_data_queue, display_size=DisplaySize.SIZE_2_0, image_save_dir=WEB_DIR)
+    # we need enough data points to capture 60s shot
+    max_flow_points = round(60 / refreshRate)
+
+    display = Display(display_size=DisplaySize.SIZE_2_0, image_save_dir=WEB_DIR, max_flow_points=max_flow_points)
     display.start()
 
-    # we need enough data points to capture 60s shot
-    mgr = ControlManager(max_flow_points=round(60 / refreshRate))
-    scale = AcaiaScale(mac='')
+    mgr = ControlManager(max_flow_points=max_flow_points, flow_smooth_factor=smoothing)
+    memory_store = control.MemoryStore(memoryStatePath, mgr.memories, memorySaveInterval)
+    memory_store.load()
+    memory_store.start()
+    if scaleSimulator:
+        from lib.acaia_sim import SimulatedTransport
+        scale = AcaiaScale(mac='', transport=SimulatedTransport(speed=scaleSimulator, flowing=mgr.relay_on))
+    else:
+        scale = AcaiaScale(mac='')
+    if scaleCapture:
+        scale.start_capture(scaleCapture)
+    scale_profiles = control.ScaleProfileCache(scaleProfilePath)
+    scanner = control.ScaleScanner(scale.transport, scaleAllowlist)
+    scanner.start()
 
     mgr.add_tare_handler(lambda channel: scale.tare())
+    cutoff = CutoffEngine(cut=lambda: cut_relay(scale, mgr, cutoff))
+    mgr.add_shot_start_handler(cutoff.start_shot)
+    scale.add_weight_listener(lambda weight, arrival, sequence: handle_weight(scale, mgr, cutoff, arrival,
+                                                                               sequence))
+    # a link that stalls mid-shot would let the cutoff go by unnoticed
+    watchdog = LinkWatchdog(scale, mgr.relay_on, give_up=lambda: abandon_shot(mgr, cutoff))
+    watchdog.start()
 
-    last_sample_time: Optional[float] = None
-    last_weight: Optional[float] = None
-    while not stop:
-        if control.try_connect_scale(scale, mgr):
-            check_target_disable_relay(scale, mgr)
-        if scale is not None and scale.connected:
-            (last_sample_time, last_weight) = update_display(scale, mgr, display, last_sample_time, last_weight)
+    last_sample: Optional[tuple] = None
+    last_update_time: Optional[float] = None
+
+    def control_tick():
+        nonlocal last_sample
+        last_sample = update_control(scale, mgr, cutoff, last_sample)
+
+    def display_tick():
+        nonlocal last_update_time
+        if scale.connected:
+            last_update_time = update_display(scale, mgr, display, last_update_time)
         else:
+            last_update_time = None
             display.display_off()
+
+    control_thread = PeriodicThread("control", refreshRate, control_tick,
+                                     realtime_priority=controlPriority or None)
+    display_thread = PeriodicThread("display-feed", refreshRate, display_tick, nice=BACKGROUND_NICE)
+    connect_thread = PeriodicThread("connect", CONNECT_PERIOD,
+                                    lambda: control.try_connect_scale(scale, mgr, scale_profiles, scaleAllowlist,
+                                                                      scanner),
+                                    nice=BACKGROUND_NICE)
+    control_thread.start()
+    display_thread.start()
+    connect_thread.start()
+
+    while not stop:
+        if report_requested:
+            report_requested = False
+            log_stats(scale)
         time.sleep(refreshRate)
+    for thread in (connect_thread, display_thread, control_thread):
+        thread.stop()
+        thread.join(timeout=2.0)
+    memory_store.stop()
+    log_stats(scale)
     if scale.connected:
         try:
             scale.disconnect()
         except Exception as ex:
             logging.error("Error during shutdown: %s" % str(ex))
+    scanner.stop()
+    watchdog.stop()
+    scale.stop_capture()
     if display is not None:
         display.stop()
     logging.info("Exiting on stop")
 
 
-def update_display(scale: AcaiaScale, mgr: ControlManager, display: Display, last_time: float, last_weight: float) -> (float, float):
+def update_display(scale: AcaiaScale, mgr: ControlManager, display: Display, last_time: float) -> float:
     now = timer()
     weight = scale.weight
     sample_rate = 0.0
-    if last_time is not None and last_weight is not None:
+    if last_time is not None:
         sample_rate = now - last_time
-        changed = weight - last_weight
-        g_per_s = round(1 / sample_rate * changed, 1)
-        mgr.add_flow_rate_data(g_per_s)
-    data = DisplayData(weight, sample_rate, mgr.current_memory(), mgr.flow_rate_data,
-                       scale.battery, mgr.relay_on(), mgr.shot_time_elapsed(),
-                       mgr.image_needs_save, smoothing)
     display.display_on()
+    # the control thread appends to the flow deques, copy them and publish outside the lock so it
+    # never waits on this lower priority thread for longer than the copy
+    with mgr.flow_lock:
+        flow_data = list(mgr.flow_rate_data)
+        smoothed_flow_data = list(mgr.smoothed_flow_rate_data)
+        smoothed_flow_count = mgr.smoothed_flow_count
+    data = DisplayData(weight, sample_rate, mgr.current_memory(), flow_data,
+                       scale.battery, mgr.relay_on(), mgr.shot_time_elapsed(),
+                       mgr.image_needs_save, smoothing, smoothed_flow_data, smoothed_flow_count)
     display.put_data(data)
     mgr.image_needs_save = False
-    return now, weight
+    return now
 
 
 def shutdown(sig, frame):
@@ -118,6 +273,14 @@ def shutdown(sig, frame):
     stop = True
 
 
+def request_report(sig, frame):
+    global report_requested
+    report_requested = True
+
+
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, shutdown)
+    # what systemd sends on stop, the memories still get saved
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGUSR1, request_report)
     main()
@@ -28,6 +28,13 @@ class LCD_2inch(lcdconfig.RaspberryPi):
 
     def On(self):
         self._pwm.start(100)
+
+    def PanelOff(self):
+        """Stop driving the panel, memory contents are kept"""
+        self.command(0x28)
+
+    def PanelOn(self):
+        self.command(0x29)
         
     def Init(self):
         """Initialize dispaly"""  
@@ -128,58 +135,34 @@ class LCD_2inch(lcdconfig.RaspberryPi):
         self.command(0x2A)
         self.data(Xstart>>8)        #Set the horizontal starting point to the high octet
         self.data(Xstart & 0xff)    #Set the horizontal starting point to the low octet
-        self.data(Xend>>8)          #Set the horizontal end to the high octet
+        self.data((Xend - 1)>>8)    #Set the horizontal end to the high octet
         self.data((Xend - 1) & 0xff)#Set the horizontal end to the low octet 
 
         #set the Y coordinates
         self.command(0x2B)
         self.data(Ystart>>8)
         self.data((Ystart & 0xff))
-        self.data(Yend>>8)
+        self.data((Yend - 1)>>8)
         self.data((Yend - 1) & 0xff )
 
         self.command(0x2C)    
         
-    def ShowImage(self,Image,Xstart=0,Ystart=0):
-        """Set buffer to value of Python Imaging Library image."""
-        """Write display buffer to physical display"""
+    def ShowImage(self,Image,Xstart=0,Ystart=0,partial=False):
+        """Write display buffer to physical display.
+        With partial set only the tiles that changed since the previous frame are sent."""
         imwidth, imheight = Image.size
+        #RGB888 >> RGB565, packed into a preallocated buffer and written in bulk
+        fb = self.framebuffer(imwidth, imheight)
+        fb.pack(Image)
         if imwidth == self.height and imheight ==  self.width:
-            img = self.np.asarray(Image)
-            pix = self.np.zeros((self.width, self.height,2), dtype = self.np.uint8)
-            #RGB888 >> RGB565
-            pix[...,[0]] = self.np.add(self.np.bitwise_and(img[...,[0]],0xF8),self.np.right_shift(img[...,[1]],5))
-            pix[...,[1]] = self.np.add(self.np.bitwise_and(self.np.left_shift(img[...,[1]],3),0xE0), self.np.right_shift(img[...,[2]],3))
-            pix = pix.flatten().tolist()
-            
             self.command(0x36)
-            self.data(0x70) 
-            self.SetWindows ( 0, 0, self.height,self.width)
-            self.digital_write(self.DC_PIN,self.GPIO.HIGH)
-            for i in range(0,len(pix),4096):
-                self.spi_writebyte(pix[i:i+4096])
-            
+            self.data(0x70)
         else :
-            img = self.np.asarray(Image)
-            pix = self.np.zeros((imheight,imwidth , 2), dtype = self.np.uint8)
-            
-            pix[...,[0]] = self.np.add(self.np.bitwise_and(img[...,[0]],0xF8),self.np.right_shift(img[...,[1]],5))
-            pix[...,[1]] = self.np.add(self.np.bitwise_and(self.np.left_shift(img[...,[1]],3),0xE0), self.np.right_shift(img[...,[2]],3))
-
-            pix = pix.flatten().tolist()
-            
             self.command(0x36)
-            self.data(0x00) 
-            self.SetWindows ( 0, 0, self.width, self.height)
-            self.digital_write(self.DC_PIN,self.GPIO.HIGH)
-            for i in range(0,len(pix),4096):
-                self.spi_writebyte(pix[i:i+4096])		
+            self.data(0x00)
+        return self.write_framebuffer(fb, partial)
 
     def clear(self):
         """Clear contents of image buffer"""
-        _buffer = [0xff]*(self.width * self.height * 2)
-        self.SetWindows ( 0, 0, self.height, self.width)
-        self.digital_write(self.DC_PIN,self.GPIO.HIGH)
-        for i in range(0,len(_buffer),4096):
-            self.spi_writebyte(_buffer[i:i+4096])	
+        self.fill(0xffff)	
         
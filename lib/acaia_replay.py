@@ -0,0 +1,76 @@
+import logging
+import time
+
+from lib import pyacaia
+from lib.pyacaia import AcaiaScale
+
+
+class ReplayTransport(pyacaia.ScaleTransport):
+    """Nothing to connect to, replay() feeds the capture to the scale directly"""
+
+    def connect(self, scale, timeout=10):
+        raise Exception('a replayed scale can not connect')
+
+    def write(self, packet, withResponse=False):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def disconnect(self):
+        pass
+
+
+def replay(scale: AcaiaScale, path: str, speed: float = 1.0) -> int:
+    """Feed a notification log through scale.callback_queue, keeping the recorded gaps between
+    notifications divided by speed. A speed of 0 replays as fast as possible.
+
+    Notifications are stamped with their replay time, so the weight samples and listeners see
+    arrival times as if the trace was happening now. Returns the number of notifications fed.
+    """
+    start = None
+    first = None
+    count = 0
+    for timestamp, payload in pyacaia.read_capture(path):
+        if start is None:
+            start = time.monotonic()
+            first = timestamp
+        if speed > 0:
+            delay = start + (timestamp - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        scale.notification_time = time.monotonic()
+        scale.callback_queue(payload)
+        count += 1
+    return count
+
+
+def main():
+    """Replay a notification capture through the decoder and report what it decoded"""
+    import argparse
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('capture')
+    parser.add_argument('--speed', type=float, default=1.0, help='times faster than recorded, 0 for no delays')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    records = list(pyacaia.read_capture(args.capture))
+    if not records:
+        print("%s has no notifications" % args.capture)
+        return
+    scale = AcaiaScale(mac='', transport=ReplayTransport())
+    start = time.perf_counter()
+    count = replay(scale, args.capture, args.speed)
+    elapsed = time.perf_counter() - start
+    print("%d notifications over %.1fs recorded, replayed in %.3fs" %
+          (count, records[-1][0] - records[0][0], elapsed))
+    if args.speed == 0:
+        print("%.1f us per notification" % (elapsed / count * 1e6))
+    print("%d weights, last weight %s, battery %s, %d checksum errors, %d decode errors, %d bytes discarded" %
+          (scale.weight_samples.sequence, scale.weight, scale.battery, scale.checksum_errors, scale.decode_errors,
+           scale.framer.discarded))
+
+
+if __name__ == '__main__':
+    main()
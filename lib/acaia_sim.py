@@ -0,0 +1,268 @@
+import logging
+import random
+import time
+from threading import Event, Lock
+
+from lib import pyacaia
+from lib.pyacaia import ScaleTransport
+
+# (seconds, grams per second) phases of a typical shot: preinfusion, ramp up, main extraction
+DEFAULT_PHASES = ((4.0, 0.0), (2.0, 0.8), (3.0, 1.8), (22.0, 2.2))
+SIMULATED_MAC = '00:1c:97:00:00:00'
+
+
+class ShotProfile:
+    """Flow into the cup over time, as (duration, grams per second) phases with the flow ramping
+    linearly between phases. Once the flow is stopped the remaining drip tapers off over drip_time.
+    """
+
+    def __init__(self, phases: tuple = DEFAULT_PHASES, drip_time: float = 1.5, noise: float = 0.0):
+        self.phases = phases
+        self.drip_time = drip_time
+        self.noise = noise
+
+    def flow_at(self, t: float) -> float:
+        start = 0.0
+        previous = 0.0
+        for duration, flow in self.phases:
+            if t < start + duration:
+                if duration <= 0:
+                    return flow
+                return previous + (flow - previous) * (t - start) / duration
+            start += duration
+            previous = flow
+        return previous
+
+    def weight_at(self, t: float) -> float:
+        weight = 0.0
+        start = 0.0
+        previous = 0.0
+        for duration, flow in self.phases:
+            x = min(max(t - start, 0.0), duration)
+            if duration > 0:
+                weight += previous * x + (flow - previous) * x * x / (2 * duration)
+            start += duration
+            previous = flow
+        return weight + previous * max(t - start, 0.0)
+
+
+class SimulatedTransport(ScaleTransport):
+    """Stands in for a bluetooth link to an Acaia scale, so the decoder and the control loop can be
+    exercised without hardware, optionally faster than real time.
+
+    Once identified it streams weight events at rate per second of simulated time with the given
+    jitter, plus settings notifications every settings_interval. Notifications are dropped with
+    probability drop and split in two with probability split. The shot runs while flowing() is true,
+    with time scaled by speed.
+    """
+
+    def __init__(self, profile: ShotProfile = None, rate: float = 10.0, jitter: float = 0.0,
+                 drop: float = 0.0, split: float = 0.0, speed: float = 1.0, flowing=None,
+                 battery: int = 80, settings_interval: float = 5.0, seed=None):
+        self.profile = profile if profile is not None else ShotProfile()
+        self.rate = rate
+        self.jitter = jitter
+        self.drop = drop
+        self.split = split
+        self.speed = speed
+        self.flowing = flowing if flowing is not None else lambda: True
+        self.battery = battery
+        self.settings_interval = settings_interval
+        self.rng = random.Random(seed)
+        self.scale = None
+        self.lock = Lock()
+        self.woken = Event()
+
+        self.sent = 0
+        self.dropped = 0
+        self.splits = 0
+        self.commands = []
+        # whether the scale is switched on
+        self.available = True
+        self.rssi = -60
+        # while set the scale stays connected but nothing it sends arrives
+        self.stalled = False
+        self.connects = 0
+
+        self.start = time.monotonic()
+        self.streaming = False
+        self.pending = []
+        self.next_weight = 0.0
+        self.next_settings = 0.0
+        # simulated seconds of flow, and the weight poured, up to last_time
+        self.shot_time = 0.0
+        self.poured = 0.0
+        self.last_time = 0.0
+        self.stopped_at = None
+        self.tare_offset = 0.0
+        self.timer_start = None
+
+    def clock(self) -> float:
+        """Simulated seconds since connecting"""
+        return (time.monotonic() - self.start) * self.speed
+
+    def scan(self, timeout=3):
+        return [(SIMULATED_MAC, 'LUNAR-SIM', self.rssi)] if self.available else []
+
+    def connect(self, scale, timeout=10):
+        self.connects += 1
+        if not self.available or scale.mac != SIMULATED_MAC:
+            raise Exception("No simulated scale at %s" % scale.mac)
+        self.scale = scale
+        scale.profile = pyacaia.ScaleProfile(scale.mac, False, '00002a80-0000-1000-8000-00805f9b34fb',
+                                             command_handle=14, weight_handle=14, cccd_handle=14)
+        with self.lock:
+            # the shot carries on across reconnects
+            self.streaming = False
+            self.stalled = False
+            self.pending = []
+        scale.isPyxisStyle = False
+        logging.info("Connected to simulated scale at %.0fx speed", self.speed)
+
+    def disconnect(self):
+        with self.lock:
+            self.streaming = False
+            self.pending = []
+
+    def write(self, packet, withResponse=False):
+        cmd = packet[2]
+        self.commands.append(cmd)
+        now = self.clock()
+        with self.lock:
+            self.__advance(now)
+            if cmd == 11:
+                self.streaming = True
+                self.next_weight = now
+                self.next_settings = now
+            elif cmd == 4:
+                self.tare_offset = self.poured
+                self.pending.append(self.__button(0, 5, []))
+            elif cmd == 13:
+                if packet[4] == 0:
+                    self.timer_start = now
+                    self.pending.append(self.__button(8, 5, []))
+                else:
+                    elapsed = now - self.timer_start if self.timer_start is not None else 0.0
+                    self.timer_start = None
+                    button = 10 if packet[4] == 2 else 9
+                    self.pending.append(self.__button(button, 7, self.__time(elapsed) + [0]))
+
+    def wait(self, timeout):
+        deadline = self.clock() + timeout * self.speed
+        while True:
+            now = self.clock()
+            with self.lock:
+                self.__advance(now)
+                notifications = self.__due(now)
+                next_due = min(self.next_weight, self.next_settings) if self.streaming else deadline
+            for notification in notifications:
+                self.scale.handleNotification(14, notification)
+            if notifications:
+                return True
+            if now >= deadline:
+                return False
+            if self.woken.wait(max(min(next_due, deadline) - now, 0) / self.speed):
+                self.woken.clear()
+                return False
+
+    def wake(self):
+        self.woken.set()
+
+    def __advance(self, now: float):
+        # integrate the flow up to now, stopping it as soon as flowing() goes false and starting
+        # the profile over once it turns true again
+        if now <= self.last_time:
+            return
+        flowing = self.flowing()
+        if self.stopped_at is None and not flowing:
+            self.stopped_at = self.last_time
+        elif self.stopped_at is not None and flowing:
+            self.stopped_at = None
+            self.shot_time = 0.0
+        if self.stopped_at is None:
+            self.poured += self.profile.weight_at(self.shot_time + now - self.last_time) - \
+                self.profile.weight_at(self.shot_time)
+            self.shot_time += now - self.last_time
+        elif self.profile.drip_time > 0:
+            # flow at the moment of stopping decays linearly to zero over drip_time
+            flow = self.profile.flow_at(self.shot_time)
+            t0 = min(self.last_time - self.stopped_at, self.profile.drip_time)
+            t1 = min(now - self.stopped_at, self.profile.drip_time)
+            self.poured += flow * ((t1 - t0) - (t1 * t1 - t0 * t0) / (2 * self.profile.drip_time))
+        self.last_time = now
+
+    def __due(self, now: float) -> list:
+        if not self.streaming:
+            return []
+        messages = self.pending
+        self.pending = []
+        while self.next_settings <= now:
+            messages.append(pyacaia.encode(8, [11, self.battery, 2, 0, 6, 0, 1, 0, 0, 0, 0]))
+            self.next_settings += self.settings_interval
+        while self.next_weight <= now:
+            weight = self.poured - self.tare_offset
+            if self.profile.noise:
+                weight += self.rng.gauss(0, self.profile.noise)
+            messages.append(pyacaia.encodeEventData([5] + self.__weight(weight)))
+            interval = 1 / self.rate
+            if self.jitter:
+                interval = max(interval + self.rng.uniform(-self.jitter, self.jitter), 0.001)
+            self.next_weight += interval
+
+        notifications = []
+        for message in messages:
+            if self.stalled or (self.drop and self.rng.random() < self.drop):
+                self.dropped += 1
+                continue
+            if self.split and len(message) > 1 and self.rng.random() < self.split:
+                at = self.rng.randint(1, len(message) - 1)
+                notifications.append(bytes(message[:at]))
+                notifications.append(bytes(message[at:]))
+                self.splits += 1
+            else:
+                notifications.append(bytes(message))
+            self.sent += 1
+        return notifications
+
+    def __button(self, button: int, kind: int, time_payload: list) -> bytearray:
+        return pyacaia.encodeEventData([8, button, kind] + time_payload + self.__weight(self.poured - self.tare_offset))
+
+    @staticmethod
+    def __weight(grams: float) -> list:
+        raw = round(abs(grams) * 10)
+        sign = 0x02 if grams < 0 else 0x00
+        return [raw & 0xff, (raw >> 8) & 0xff, (raw >> 16) & 0xff, (raw >> 24) & 0xff, 1, sign]
+
+    @staticmethod
+    def __time(seconds: float) -> list:
+        tenths = round(seconds * 10)
+        return [tenths // 600, (tenths // 10) % 60, tenths % 10]
+
+
+def main():
+    """Stream a simulated shot through AcaiaScale at accelerated time and report what made it through"""
+    import argparse
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--speed', type=float, default=20.0)
+    parser.add_argument('--rate', type=float, default=10.0)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--drop', type=float, default=0.01)
+    parser.add_argument('--split', type=float, default=0.2)
+    parser.add_argument('--duration', type=float, default=30.0)
+    args = parser.parse_args()
+
+    transport = SimulatedTransport(rate=args.rate, jitter=args.jitter, drop=args.drop, split=args.split,
+                                   speed=args.speed)
+    scale = pyacaia.AcaiaScale(mac=SIMULATED_MAC, transport=transport)
+    scale.connect()
+    try:
+        time.sleep(args.duration / args.speed)
+    finally:
+        scale.disconnect()
+    print("sent %d (%d split) dropped %d, decoded %d weights, last weight %s, %d checksum errors, "
+          "%d bytes discarded" % (transport.sent, transport.splits, transport.dropped, scale.weight_samples.sequence,
+                                  scale.weight, scale.checksum_errors, scale.framer.discarded))
+
+
+if __name__ == '__main__':
+    main()
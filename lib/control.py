@@ -1,16 +1,73 @@
+import json
 import logging
+import math
+import os
 import time
 from collections import deque
+from concurrent.futures import Future
+from threading import Event, Lock, Thread
 from timeit import default_timer as timer
 from typing import Optional, Callable
 
 from gpiozero import Button, DigitalOutputDevice
 
-import lib.pyacaia as pyacaia
-from lib.pyacaia import AcaiaScale
+from lib.pyacaia import AcaiaScale, ScaleProfile
 
 default_target = 50.0
 default_overshoot = 2.0
+# seconds of flow still in flight after the relay is cut, see lib/cutoff.py
+default_lag = 1.0
+
+
+class KalmanEstimate:
+    """1-D Kalman filter for a value measured once per shot that only drifts slowly, like the overshoot.
+
+    A measurement more than gate standard deviations off the estimate is rejected as an outlier, a bumped
+    cup or a channeling puck shouldn't move the next shot. If max_rejects measurements in a row are
+    rejected the value has most likely really moved, a new grind or basket, so the next one is taken with
+    the uncertainty reset to start over from there.
+    """
+
+    def __init__(self, value: float, variance: float, process_noise: float, measurement_noise: float,
+                 gate: float = 3.0, max_rejects: int = 2):
+        self.value = value
+        self.variance = variance
+        self.initial_variance = variance
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.gate = gate
+        self.max_rejects = max_rejects
+        self.rejects = 0
+
+    def update(self, measurement: float) -> bool:
+        """Fold in a measurement, returns False if it was rejected as an outlier"""
+        self.variance += self.process_noise
+        innovation = measurement - self.value
+        spread = self.variance + self.measurement_noise
+        if innovation * innovation > self.gate * self.gate * spread:
+            self.rejects += 1
+            if self.rejects <= self.max_rejects:
+                return False
+            self.variance = self.initial_variance
+            spread = self.variance + self.measurement_noise
+        self.rejects = 0
+        gain = self.variance / spread
+        self.value += gain * innovation
+        self.variance *= 1 - gain
+        return True
+
+    def to_dict(self) -> dict:
+        return {'value': self.value, 'variance': self.variance, 'rejects': self.rejects}
+
+    def restore(self, state: dict):
+        """Take over what to_dict() saved, unless the variance is negative or not a number. Either would
+        poison every update after it, the estimate keeps starting from scratch then"""
+        value = float(state['value'])
+        variance = float(state['variance'])
+        if math.isfinite(value) and math.isfinite(variance) and variance > 0:
+            self.value = value
+            self.variance = variance
+            self.rejects = max(int(state.get('rejects', 0)), 0)
 
 
 class TargetMemory:
@@ -18,19 +75,89 @@ class TargetMemory:
         self.name: str = name
         self.target: float = default_target
         self.overshoot: float = default_overshoot
+        self.lag: float = default_lag
         self.color: str = color
+        # grams, starts out unsure so the first shots pull it in quickly
+        self.overshoot_estimate = KalmanEstimate(default_overshoot, variance=4.0, process_noise=0.02,
+                                                 measurement_noise=0.09)
+        # seconds
+        self.lag_estimate = KalmanEstimate(default_lag, variance=0.25, process_noise=0.001,
+                                           measurement_noise=0.0025)
 
     def target_minus_overshoot(self) -> float:
         return self.target - self.overshoot
 
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'target': self.target,
+            'overshoot': self.overshoot,
+            'lag': self.lag,
+            'color': self.color,
+            'overshoot_estimate': self.overshoot_estimate.to_dict(),
+            'lag_estimate': self.lag_estimate.to_dict(),
+        }
+
+    def restore(self, state: dict):
+        """Take over what to_dict() saved, values outside the safe ranges keep their defaults"""
+        target = float(state['target'])
+        if 0 < target < 1000:
+            self.target = target
+        self.color = str(state.get('color', self.color))
+        overshoot = float(state['overshoot'])
+        if -10 <= overshoot <= 10:
+            self.overshoot = overshoot
+            if 'overshoot_estimate' in state:
+                self.overshoot_estimate.restore(state['overshoot_estimate'])
+        lag = float(state.get('lag', self.lag))
+        if 0 <= lag <= 5:
+            self.lag = lag
+            if 'lag_estimate' in state:
+                self.lag_estimate.restore(state['lag_estimate'])
+
     def update_overshoot(self, weight: float):
-        new_overshoot = self.overshoot + (weight - self.target)
-        if new_overshoot > 10 or new_overshoot < -10:
+        """Learn from a shot cut at target_minus_overshoot() that ended at weight"""
+        # the overshoot that would have landed this shot on target
+        self.observe_overshoot(self.overshoot + (weight - self.target))
+
+    def observe_overshoot(self, measured: float):
+        """Learn from a shot that gained measured grams after the weight the relay was cut on"""
+        if measured > 10 or measured < -10:
             logging.error("New overshoot out of safe range, ignoring")
+        elif not self.overshoot_estimate.update(measured):
+            logging.info("Overshoot %.2f looks like an outlier, ignoring" % measured)
         else:
-            self.overshoot = new_overshoot
+            self.overshoot = self.overshoot_estimate.value
             logging.debug("set new overshoot to %.2f" % self.overshoot)
 
+    def update_lag(self, lag: float):
+        if lag < 0 or lag > 5:
+            logging.error("Measured lag %.2fs out of safe range, ignoring" % lag)
+        elif not self.lag_estimate.update(lag):
+            logging.info("Lag %.2fs looks like an outlier, ignoring" % lag)
+        else:
+            self.lag = self.lag_estimate.value
+            logging.debug("set new lag to %.2f" % self.lag)
+
+
+class MovingAverage:
+    """Streaming mean over the last `window` samples, O(1) per sample"""
+
+    def __init__(self, window: int):
+        self.window = window
+        self.samples = deque([])
+        self.total = 0.0
+
+    def add(self, value: float) -> Optional[float]:
+        """Add a sample, returns the mean once a full window has been seen"""
+        self.samples.append(value)
+        self.total += value
+        if len(self.samples) > self.window:
+            self.total -= self.samples.popleft()
+        if len(self.samples) < self.window:
+            return None
+        return self.total / self.window
+
 
 class ControlManager:
     TARE_GPIO = 4
@@ -41,9 +168,16 @@ class ControlManager:
     PADDLE_GPIO = 20
     RELAY_GPIO = 26
 
-    def __init__(self, max_flow_points=500):
+    def __init__(self, max_flow_points=500, flow_smooth_factor=8):
         self.flow_rate_data = deque([])
         self.flow_rate_max_points = max_flow_points
+        # moving average of flow_rate_data, one point per full smoothing window
+        self.flow_smooth_factor = flow_smooth_factor
+        self.flow_rate_avg = MovingAverage(flow_smooth_factor)
+        self.smoothed_flow_rate_data = deque([])
+        self.smoothed_flow_count = 0
+        # the control thread adds flow points while the display thread reads them
+        self.flow_lock = Lock()
         self.memories = deque([TargetMemory("A"), TargetMemory("B", "#25a602"), TargetMemory("C", "#376efa")])
         self.relay_off_time = timer()
         self.shot_timer_start: Optional[float] = None
@@ -69,10 +203,15 @@ class ControlManager:
         self.memory_button.when_pressed = self.__rotate_memory
 
         self.scale_connect_button = Button(ControlManager.SCALE_CONNECT_GPIO, pull_up=True)
+        self.shot_start_handlers = []
 
     def add_tare_handler(self, callback: Callable):
         self.tare_button.when_pressed = callback
 
+    def add_shot_start_handler(self, callback: Callable):
+        """Call callback() right before the relay turns on for a shot"""
+        self.shot_start_handlers.append(callback)
+
     def should_scale_connect(self) -> bool:
         return self.scale_connect_button.value
 
@@ -81,15 +220,27 @@ class ControlManager:
 
     def add_flow_rate_data(self, data_point: float):
         if self.relay_on() or self.relay_off_time + 3.0 > timer():
-            self.flow_rate_data.append(data_point)
-            if len(self.flow_rate_data) > self.flow_rate_max_points:
-                self.flow_rate_data.popleft()
+            with self.flow_lock:
+                self.flow_rate_data.append(data_point)
+                if len(self.flow_rate_data) > self.flow_rate_max_points:
+                    self.flow_rate_data.popleft()
+                smoothed = self.flow_rate_avg.add(data_point)
+                if smoothed is not None:
+                    self.smoothed_flow_rate_data.append(smoothed)
+                    self.smoothed_flow_count += 1
+                    if len(self.smoothed_flow_rate_data) > self.flow_rate_max_points - self.flow_smooth_factor + 1:
+                        self.smoothed_flow_rate_data.popleft()
+
+    def last_flow_rate(self) -> float:
+        with self.flow_lock:
+            return self.flow_rate_data[-1] if self.flow_rate_data else 0.0
 
     def disable_relay(self):
-        logging.info("disable relay")
         if self.relay_on():
             self.relay_off_time = timer()
             self.relay.off()
+        # only after the relay is off, this is on the cutoff path
+        logging.info("disable relay")
 
     def current_memory(self):
         return self.memories[0]
@@ -113,24 +264,332 @@ class ControlManager:
 
     def __start_shot(self):
         logging.info("Start shot")
-        self.flow_rate_data = deque([])
+        with self.flow_lock:
+            self.flow_rate_data = deque([])
+            self.flow_rate_avg = MovingAverage(self.flow_smooth_factor)
+            self.smoothed_flow_rate_data = deque([])
+            self.smoothed_flow_count = 0
         if self.tare_button.when_pressed is not None:
-            self.tare_button.when_pressed()
+            tared = self.tare_button.when_pressed()
             logging.info("Sent tare to scale")
-            time.sleep(.5)
+            if isinstance(tared, Future):
+                # start as soon as the scale confirms instead of guessing how long it takes
+                try:
+                    tared.result(timeout=1.0)
+                except Exception as ex:
+                    logging.warning("Tare not acknowledged by scale: %s" % (str(ex) or type(ex).__name__))
+            else:
+                time.sleep(.5)
+        for handler in self.shot_start_handlers:
+            handler()
         self.shot_timer_start = timer()
         self.relay.on()
 
 
-def try_connect_scale(scale: AcaiaScale, mgr: ControlManager) -> bool:
+class ScaleProfileCache:
+    """Keeps the ScaleProfile of the last scale connected to in a JSON file, so after a restart or a scale
+    power cycle we can connect straight to it instead of scanning and rediscovering its services.
+    """
+
+    def __init__(self, path: str, retry_interval: float = 10.0):
+        self.path = path
+        self.profile: Optional[ScaleProfile] = self.__load()
+        # after a failed direct connect, scan for retry_interval seconds before trying it again
+        self.retry_interval = retry_interval
+        self.next_direct_attempt = 0.0
+
+    def __load(self) -> Optional[ScaleProfile]:
+        try:
+            with open(self.path) as f:
+                return ScaleProfile.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            logging.warning("Ignoring unreadable scale profile cache %s: %s" % (self.path, str(ex)))
+            return None
+
+    def direct_candidate(self, allowlist: frozenset) -> Optional[ScaleProfile]:
+        """The cached profile, if it's allowed and due for a direct connect attempt"""
+        if self.profile is None or not mac_allowed(self.profile.mac, allowlist) or timer() < self.next_direct_attempt:
+            return None
+        return self.profile
+
+    def direct_failed(self):
+        self.next_direct_attempt = timer() + self.retry_interval
+
+    def save(self, profile: Optional[ScaleProfile]):
+        if profile is None or profile == self.profile:
+            return
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(profile.to_dict(), f)
+            os.replace(tmp, self.path)
+            self.profile = profile
+            logging.info("Saved scale profile %s" % profile.mac)
+        except OSError as ex:
+            logging.error("Could not save scale profile to %s: %s" % (self.path, str(ex)))
+
+
+class MemoryStore(Thread):
+    """Keeps the target memories in a JSON file, so targets and everything learned about the machine
+    survive a restart.
+
+    Writes are write-behind: every interval seconds the memories are compared with what was last written
+    and only saved if something changed. Holding a target button, a shot updating the overshoot, all of it
+    folds into one write. Each write goes to a temporary file that is synced and then renamed over the
+    old one, a power cut leaves either the old state or the new one on the SD card.
+    """
+
+    def __init__(self, path: str, memories: deque, interval: float = 30.0):
+        super().__init__(name="memory-store", daemon=True)
+        self.path = path
+        self.memories = memories
+        self.interval = interval
+        self.saved: Optional[list] = None
+        self.writes = 0
+        self.mutex = Lock()
+        self.stopped = Event()
+
+    def load(self) -> bool:
+        """Restore the memories from the file, in the order they were saved so the same one is current.
+        Returns whether there was anything to restore"""
+        try:
+            with open(self.path) as f:
+                states = json.load(f)['memories']
+        except FileNotFoundError:
+            return False
+        except Exception as ex:
+            logging.warning("Ignoring unreadable memory state %s: %s" % (self.path, str(ex)))
+            return False
+        by_name = {memory.name: memory for memory in self.memories}
+        order = []
+        for state in states:
+            if not isinstance(state, dict):
+                logging.warning("Ignoring saved memory state that isn't an object: %r" % (state,))
+                continue
+            memory = by_name.pop(state.get('name'), None)
+            if memory is None:
+                continue
+            try:
+                memory.restore(state)
+            except (AttributeError, KeyError, TypeError, ValueError) as ex:
+                logging.warning("Ignoring saved state of memory %s: %s" % (memory.name, str(ex)))
+            order.append(memory)
+        restored = len(order)
+        order.extend(memory for memory in self.memories if memory.name in by_name)
+        self.memories.clear()
+        self.memories.extend(order)
+        self.saved = self.__snapshot()
+        logging.info("Restored %d memories from %s" % (restored, self.path))
+        return True
+
+    def stop(self):
+        """Stop the thread and write out anything not saved yet"""
+        self.stopped.set()
+        self.flush()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.mutex:
+            state = self.__snapshot()
+            if state == self.saved:
+                return
+            tmp = self.path + ".tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump({'memories': state}, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+                self.saved = state
+                self.writes += 1
+                logging.debug("Saved memory state to %s" % self.path)
+            except OSError as ex:
+                logging.error("Could not save memory state to %s: %s" % (self.path, str(ex)))
+
+    def __snapshot(self) -> list:
+        # list() copies the deque in one go, a rotating memory button can't get in between
+        return [memory.to_dict() for memory in list(self.memories)]
+
+
+def parse_mac_allowlist(value: str) -> frozenset:
+    """Comma or space separated MAC addresses, empty means any scale is allowed"""
+    return frozenset(mac.strip().lower() for mac in value.replace(",", " ").split() if mac.strip())
+
+
+def mac_allowed(mac: str, allowlist: frozenset) -> bool:
+    return not allowlist or mac.lower() in allowlist
+
+
+class SeenScale:
+    def __init__(self, mac: str, name: str, rssi: Optional[int], last_seen: float):
+        self.mac = mac
+        self.name = name
+        self.rssi = rssi
+        self.last_seen = last_seen
+
+
+class ScaleScanner(Thread):
+    """Scans for Acaia scales in a background thread while enabled, so the main loop never waits on a scan.
+
+    Every scale seen goes into a table with its RSSI and when it was last seen. Allowed scales are also
+    published as "scale available" events, to listeners and for try_connect_scale to pick up. While nothing
+    turns up the pause between scans doubles up to max_backoff seconds.
+    """
+
+    def __init__(self, transport, allowlist: frozenset = frozenset(), scan_time: float = 1.0,
+                 max_backoff: float = 4.0, stale_after: float = 10.0):
+        super().__init__(name="scale-scanner", daemon=True)
+        self.transport = transport
+        self.allowlist = allowlist
+        self.scan_time = scan_time
+        self.max_backoff = max_backoff
+        self.stale_after = stale_after
+        self.devices: dict[str, SeenScale] = {}
+        self.available: Optional[SeenScale] = None
+        self.listeners = []
+        self.scans = 0
+        self.mutex = Lock()
+        self.scanning = Lock()
+        self.wanted = Event()
+        self.stopped = Event()
+
+    def enable(self):
+        self.wanted.set()
+
+    def disable(self, wait: bool = True) -> bool:
+        """Stop scanning. Returns whether the radio is free to connect, with wait set that is once a scan in
+        progress has finished"""
+        self.wanted.clear()
+        if self.scanning.acquire(blocking=wait):
+            self.scanning.release()
+            return True
+        return False
+
+    def add_listener(self, callback: Callable):
+        """Call callback(SeenScale) from the scanner thread whenever an allowed scale is seen"""
+        self.listeners.append(callback)
+
+    def stop(self):
+        self.stopped.set()
+        self.wanted.set()
+
+    def seen(self) -> list:
+        """Scales seen so far, strongest signal first"""
+        with self.mutex:
+            devices = list(self.devices.values())
+        return sorted(devices, key=lambda d: -d.rssi if d.rssi is not None else 0)
+
+    def take_available(self) -> Optional[SeenScale]:
+        """The most recent "scale available" event unless it's stale, without waiting"""
+        with self.mutex:
+            available = self.available
+            self.available = None
+        if available is not None and timer() - available.last_seen > self.stale_after:
+            return None
+        return available
+
+    def has_available(self) -> bool:
+        return self.available is not None
+
+    def recently_seen(self, mac: str) -> bool:
+        """Whether mac showed up in a scan within the last stale_after seconds"""
+        with self.mutex:
+            seen = self.devices.get(mac)
+        return seen is not None and timer() - seen.last_seen <= self.stale_after
+
+    def run(self):
+        backoff = 0.0
+        while not self.stopped.is_set():
+            if not self.wanted.is_set():
+                backoff = 0.0
+                self.wanted.wait()
+                continue
+            found = self.__scan()
+            backoff = 0.0 if found else min(max(backoff * 2, 0.5), self.max_backoff)
+            if backoff:
+                self.stopped.wait(backoff)
+
+    def __scan(self) -> bool:
+        with self.scanning:
+            if not self.wanted.is_set():
+                return False
+            try:
+                results = self.transport.scan(timeout=self.scan_time)
+            except Exception as ex:
+                logging.debug("scan failed: %s" % str(ex))
+                return False
+            self.scans += 1
+            now = timer()
+            found = False
+            for mac, name, rssi in results:
+                seen = SeenScale(mac, name, rssi, now)
+                with self.mutex:
+                    self.devices[mac] = seen
+                if mac_allowed(mac, self.allowlist):
+                    logging.debug("scale available: %s %s rssi %s" % (name, mac, rssi))
+                    with self.mutex:
+                        self.available = seen
+                    for listener in self.listeners:
+                        try:
+                            listener(seen)
+                        except Exception as ex:
+                            logging.error("Scale listener failed: %s" % str(ex))
+                    found = True
+            return found
+
+
+def try_connect_scale(scale: AcaiaScale, mgr: ControlManager, profiles: Optional[ScaleProfileCache] = None,
+                      allowlist: frozenset = frozenset(), scanner: Optional[ScaleScanner] = None) -> bool:
+    """Connect or disconnect the scale as the connect switch asks. With a scanner this only ever connects to
+    scales it has reported available, without one it scans for a second itself"""
     try:
+        if scale.reconnecting:
+            return False
         if not scale.connected and mgr.should_scale_connect():
-            scale.device = None
-            devices = pyacaia.find_acaia_devices(timeout=1)
+            cached = profiles.direct_candidate(allowlist) if profiles is not None else None
+            if cached is not None and scanner is not None:
+                # connecting to a scale that's off blocks for the whole BLE connect timeout, with a scanner
+                # around only go direct once it has seen the scale advertising
+                if not scanner.recently_seen(cached.mac):
+                    cached = None
+                # the radio can't scan and connect at once, a running scan gets to finish before the next turn
+                elif not scanner.disable(wait=False):
+                    return False
+                else:
+                    scanner.take_available()
+            if cached is not None:
+                # skip the scan, a scale that's off fails fast here and we fall back to scanning for a while
+                scale.mac = cached.mac
+                scale.profile = cached
+                try:
+                    logging.debug("connecting directly to cached scale %s" % scale.mac)
+                    scale.connect(timeout=0)
+                    profiles.save(scale.profile)
+                    return True
+                except Exception as ex:
+                    logging.debug("direct connect to %s failed, scanning: %s" % (scale.mac, str(ex)))
+                    profiles.direct_failed()
+            if scanner is not None:
+                if not scanner.has_available():
+                    scanner.enable()
+                    return False
+                if not scanner.disable(wait=False):
+                    return False
+                available = scanner.take_available()
+                devices = [available.mac] if available is not None else []
+            else:
+                devices = [mac for mac in scale.transport.find_devices(timeout=1) if mac_allowed(mac, allowlist)]
             if devices:
                 scale.mac = devices[0]
                 logging.debug("calling connect on mac %s" % scale.mac)
                 scale.connect()
+                if profiles is not None:
+                    profiles.save(scale.profile)
                 # if scale.weight is None:
                 #     logging.error("Connected but no weight, need to reconnect")
                 #     scale.disconnect()
@@ -140,7 +599,9 @@ def try_connect_scale(scale: AcaiaScale, mgr: ControlManager) -> bool:
             else:
                 logging.debug("no devices found")
                 return False
-        elif scale.connected and not mgr.should_scale_connect():
+        if scanner is not None:
+            scanner.disable(wait=False)
+        if scale.connected and not mgr.should_scale_connect():
             logging.debug("scale connected but should not be")
             scale.disconnect()
             return False
@@ -0,0 +1,230 @@
+import logging
+import time
+from threading import Lock, Timer
+from typing import Callable, Optional
+
+from lib.control import TargetMemory
+
+# seconds of weight samples the flow rate is fitted over
+FLOW_WINDOW = 1.0
+# below this many g/s the flow estimate isn't trusted and the overshoot threshold is used instead
+MIN_FLOW = 0.3
+# how far ahead of the newest sample a cut gets scheduled, about two notification intervals
+HORIZON = 0.25
+# the weight has settled once it stayed within SETTLE_TOLERANCE grams for SETTLE_WINDOW seconds
+SETTLE_WINDOW = 1.0
+SETTLE_TOLERANCE = 0.1
+# weights are tenths of a gram as floats, 36.4 - 36.3 comes out a hair over 0.1, tolerances get this much slack
+WEIGHT_EPSILON = 1e-6
+
+
+def estimate_flow(samples: list, window: float = FLOW_WINDOW) -> Optional[float]:
+    """Least squares slope in g/s of (arrival, weight, sequence) samples over the last window seconds"""
+    if not samples:
+        return None
+    newest = samples[-1][0]
+    recent = [(t, w) for t, w, _ in samples if newest - t <= window]
+    if len(recent) < 4:
+        return None
+    n = len(recent)
+    mean_t = sum(t for t, _ in recent) / n
+    mean_w = sum(w for _, w in recent) / n
+    var = sum((t - mean_t) ** 2 for t, _ in recent)
+    if var <= 0:
+        return None
+    return sum((t - mean_t) * (w - mean_w) for t, w in recent) / var
+
+
+def settled_weight(samples: list, since: float, now: float, window: float = SETTLE_WINDOW,
+                   tolerance: float = SETTLE_TOLERANCE) -> Optional[float]:
+    """The final weight if the (arrival, weight, sequence) samples show the scale settled after since,
+    otherwise None. Settled means the weights that arrived after since over the last window seconds spread
+    no more than tolerance, with samples still arriving."""
+    if now - since < window or not samples or now - samples[-1][0] > window / 2:
+        return None
+    recent = [w for t, w, _ in samples if t >= since and t >= now - window]
+    if len(recent) < 2 or max(recent) - min(recent) > tolerance + WEIGHT_EPSILON:
+        return None
+    return recent[-1]
+
+
+def wait_for_settle(weight_samples, since: float, timeout: float = 6.0, poll: float = 0.05,
+                    window: float = SETTLE_WINDOW, tolerance: float = SETTLE_TOLERANCE) -> Optional[float]:
+    """Watch the scale's WeightSamples until the weight settles after since, returns the settled weight or
+    None if it didn't within timeout seconds"""
+    sequence = 0
+    samples = []
+    deadline = since + timeout
+    while True:
+        now = time.monotonic()
+        new = weight_samples.since(sequence)
+        if new:
+            sequence = new[-1][2]
+            samples.extend(s for s in new if s[0] >= since)
+            samples = [s for s in samples if s[0] >= now - window]
+        weight = settled_weight(samples, since, now, window, tolerance)
+        if weight is not None:
+            return weight
+        if now >= deadline:
+            return None
+        time.sleep(poll)
+
+
+def settle_time(samples: list, final_weight: float, tolerance: float = SETTLE_TOLERANCE) -> Optional[float]:
+    """Arrival of the first of the (arrival, weight, sequence) samples from which on every weight stayed
+    within tolerance of final_weight, None if the last one didn't"""
+    settled = None
+    for arrival, weight, _ in reversed(samples):
+        if abs(weight - final_weight) > tolerance + WEIGHT_EPSILON:
+            break
+        settled = arrival
+    return settled
+
+
+class CutPoint:
+    def __init__(self, weight: float, flow: Optional[float], sample_time: float, cut_time: float,
+                 predicted: float, decoded: Optional[float] = None):
+        # newest weight and flow estimate the decision was based on
+        self.weight = weight
+        self.flow = flow
+        self.sample_time = sample_time
+        # when that sample was decoded, None if the decision wasn't made on its arrival
+        self.decoded = decoded
+        # when the relay was cut, monotonic, and when the engine meant to cut it
+        self.cut_time = cut_time
+        self.planned = cut_time
+        self.predicted = predicted
+        # monotonic time the engine went to cut, whatever clock cut_time was given in
+        self.decided: Optional[float] = None
+
+
+class ShotReport:
+    def __init__(self, memory: str, target: float, cut: CutPoint, final_weight: float, lag: Optional[float]):
+        self.memory = memory
+        self.target = target
+        self.cut = cut
+        self.final_weight = final_weight
+        self.error = final_weight - target
+        # lag this shot measured, None if the flow was too low to tell
+        self.lag = lag
+
+    def __str__(self):
+        return "memory %s: final %.1fg for target %.1fg, error %+.1fg, predicted %.1fg, flow at cut %s, lag %s" % (
+            self.memory, self.final_weight, self.target, self.error, self.cut.predicted,
+            "%.2fg/s" % self.cut.flow if self.cut.flow is not None else "unknown",
+            "%.2fs" % self.lag if self.lag is not None else "unknown")
+
+
+class CutoffEngine:
+    """Decides when to cut the relay from the live flow rate and the memory's measured lag.
+
+    Everything still in flight when the relay goes off, the weight the scale hasn't reported yet because
+    of BLE delay, the relay and whatever drains from the puck, is taken as flow * lag. So the relay is cut
+    at the moment the latest weight plus the flow since that sample plus flow * lag reaches the target.
+    That moment usually falls between two weight notifications, it is hit with a timer instead of waiting
+    for the first sample past it.
+    """
+
+    def __init__(self, cut: Callable[[], None], window: float = FLOW_WINDOW, min_flow: float = MIN_FLOW,
+                 horizon: float = HORIZON):
+        self.cut = cut
+        self.window = window
+        self.min_flow = min_flow
+        self.horizon = horizon
+        self.mutex = Lock()
+        self.timer: Optional[Timer] = None
+        self.pending: Optional[CutPoint] = None
+        self.last_cut: Optional[CutPoint] = None
+        self.last_report: Optional[ShotReport] = None
+
+    def start_shot(self):
+        with self.mutex:
+            self.__cancel()
+            self.last_cut = None
+
+    def on_weight(self, memory: TargetMemory, samples: list, now: Optional[float] = None,
+                  decoded: Optional[float] = None):
+        """Check the newest of samples, (arrival, weight, sequence) tuples oldest first, against the target.
+        Cuts right away, schedules the cut, or leaves it for a later sample. decoded is when the newest
+        sample finished decoding, if this is called for its arrival"""
+        if now is None:
+            now = time.monotonic()
+        arrival, weight, _ = samples[-1]
+        flow = estimate_flow(samples, self.window)
+        with self.mutex:
+            if self.last_cut is not None:
+                return
+            point = None
+            if flow is None or flow < self.min_flow:
+                # no usable flow, fall back to the learned overshoot
+                if weight > memory.target_minus_overshoot():
+                    self.__cancel()
+                    point = self.__decide(CutPoint(weight, flow, arrival, now, weight + memory.overshoot, decoded))
+            else:
+                delay = (memory.target - weight) / flow - memory.lag
+                cut_at = arrival + max(delay, 0.0)
+                scheduled = CutPoint(weight, flow, arrival, cut_at, weight + flow * (cut_at - arrival + memory.lag),
+                                     decoded)
+                self.__cancel()
+                if cut_at <= now:
+                    scheduled.cut_time = now
+                    point = self.__decide(scheduled)
+                elif cut_at - arrival <= self.horizon:
+                    self.pending = scheduled
+                    self.timer = Timer(cut_at - now, self.__scheduled, (scheduled,))
+                    self.timer.daemon = True
+                    self.timer.start()
+        if point is not None:
+            self.__fire()
+
+    def cancel(self):
+        with self.mutex:
+            self.__cancel()
+
+    def __cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = None
+        self.pending = None
+
+    def __scheduled(self, point: CutPoint):
+        with self.mutex:
+            if self.pending is not point or self.last_cut is not None:
+                return
+            self.timer = None
+            self.pending = None
+            point.cut_time = time.monotonic()
+            self.__decide(point)
+        self.__fire()
+
+    def __decide(self, point: CutPoint) -> CutPoint:
+        # under the mutex, so only one cut is ever decided per shot
+        point.decided = time.monotonic()
+        self.last_cut = point
+        return point
+
+    def __fire(self):
+        # outside the mutex, cut() takes the caller's own locks and they may be held around cancel()
+        try:
+            self.cut()
+        except Exception as ex:
+            logging.error("Cutting the relay failed: %s" % str(ex))
+
+    def finish_shot(self, memory: TargetMemory, final_weight: float) -> Optional[ShotReport]:
+        """Report how the shot came out once the weight settled and learn the lag and overshoot it showed"""
+        cut = self.last_cut
+        if cut is None:
+            return None
+        lag = None
+        if cut.flow is not None and cut.flow >= self.min_flow:
+            # what arrived after the cut, less what flowed between the sample and the cut
+            lag = (final_weight - cut.weight) / cut.flow - (cut.cut_time - cut.sample_time)
+            memory.update_lag(lag)
+            # the cut wasn't made at the overshoot threshold, so missing the target says nothing about the
+            # threshold. What came in after the deciding weight does
+            memory.observe_overshoot(final_weight - cut.weight)
+        else:
+            memory.update_overshoot(final_weight)
+        report = ShotReport(memory.name, memory.target, cut, final_weight, lag)
+        self.last_report = report
+        return report
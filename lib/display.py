@@ -2,15 +2,18 @@ import logging
 import math
 import os.path
 import time
-import pandas as pd
 from datetime import datetime
 from enum import Enum, StrEnum, auto
-from multiprocessing import Process, Queue
+from functools import lru_cache
+from multiprocessing import Event, Process, Value
+from multiprocessing.sharedctypes import RawArray, RawValue
+from threading import Condition, Thread
 from typing import Optional
 
 from PIL import Image, ImageFont, ImageDraw
 
-from lib.control import TargetMemory
+from lib.control import MovingAverage, TargetMemory
+from lib.glyphs import GlyphAtlas
 
 label_font = ImageFont.truetype("lib/font/LiberationMono-Regular.ttf", 16)
 label_font_mid = ImageFont.truetype("lib/font/LiberationMono-Regular.ttf", 20)
@@ -19,6 +22,12 @@ value_font = ImageFont.truetype("lib/font/Quicksand-Regular.ttf", 24)
 value_font_lg = ImageFont.truetype("lib/font/Quicksand-Regular.ttf", 36)
 value_font_lg_bold = ImageFont.truetype("lib/font/Quicksand-Bold.ttf", 36)
 
+# pre-rasterized numerals and labels for the values redrawn every frame
+label_glyphs = GlyphAtlas(label_font, labels=("paddle:", "ON", "OFF", "battery:", "timer:", "g/s"))
+label_glyphs_lg = GlyphAtlas(label_font_lg, labels=("timer:",))
+value_glyphs = GlyphAtlas(value_font)
+value_glyphs_lg = GlyphAtlas(value_font_lg)
+
 bg_color = "BLACK"
 light_bg_color = "DIMGREY"
 fg_color = "WHITE"
@@ -40,58 +49,128 @@ class FlowGraph:
             self.x_pix_interval = width_pixels / 1
 
     def generate_graph(self) -> Image:
-        points = list()
-        i = 0
-        for y in self.flow_data:
-            x_coord = i * self.x_pix_interval if i * self.x_pix_interval < self.x_pix else self.x_pix
-            y_coord = y * self.y_pix_interval + 2 if y * self.y_pix_interval < self.y_pix else self.y_pix
-            # flip Y value because zero is at top of image
-            y_coord = abs(y_coord - self.y_pix)
-            points.append((x_coord, y_coord))
-            i += 1
         img = Image.new("RGBA", (self.x_pix, self.y_pix), "BLACK")
         draw = ImageDraw.Draw(img)
+        self.draw_axes(draw)
+        self.draw_series(draw)
+        self.draw_flow_rate(img)
+        return img
+
+    def draw_axes(self, draw: ImageDraw, origin=(0, 0)):
+        """Draw the static part of the graph, the background, grid lines and axis labels"""
+        x, y = origin
+        draw.rectangle((x, y, x + self.x_pix - 1, y + self.y_pix - 1), "BLACK")
 
         # 8g line
-        self.__draw_y_line(draw, 0, self.label_color)
+        self.__draw_y_line(draw, origin, 0, self.label_color)
         # 6g line
-        self.__draw_y_line(draw, self.y_pix * .25 - 2, self.line_color)
+        self.__draw_y_line(draw, origin, self.y_pix * .25 - 2, self.line_color)
         # 4g line
-        self.__draw_y_line(draw, self.y_pix / 2 - 2, self.line_color)
+        self.__draw_y_line(draw, origin, self.y_pix / 2 - 2, self.line_color)
         # 2g line
-        self.__draw_y_line(draw, self.y_pix * .75 - 2, self.line_color)
+        self.__draw_y_line(draw, origin, self.y_pix * .75 - 2, self.line_color)
         # 0g line
-        self.__draw_y_line(draw, self.y_pix - 2, self.line_color)
-
-        # data series line
-        draw.line(points, fill=self.series_color, width=2)
+        self.__draw_y_line(draw, origin, self.y_pix - 2, self.line_color)
 
         # 8g label
-        draw.text((2, 0), "8", self.label_color, label_font)
+        draw.text((x + 2, y), "8", self.label_color, label_font)
         # 6g label
-        draw.text((2, self.y_pix * .25), "6", self.label_color, label_font)
+        draw.text((x + 2, y + self.y_pix * .25), "6", self.label_color, label_font)
         # 4g label
-        draw.text((2, self.y_pix * .5), "4", self.label_color, label_font)
+        draw.text((x + 2, y + self.y_pix * .5), "4", self.label_color, label_font)
         # 2g label
-        draw.text((2, self.y_pix * .75), "2", self.label_color, label_font)
+        draw.text((x + 2, y + self.y_pix * .75), "2", self.label_color, label_font)
+
+    def point(self, i: int, flow: float, origin=(0, 0)) -> tuple:
+        x_coord = i * self.x_pix_interval if i * self.x_pix_interval < self.x_pix else self.x_pix
+        y_coord = flow * self.y_pix_interval + 2 if flow * self.y_pix_interval < self.y_pix else self.y_pix
+        # flip Y value because zero is at top of image
+        y_coord = abs(y_coord - self.y_pix)
+        return origin[0] + x_coord, origin[1] + y_coord
 
+    def draw_series(self, draw: ImageDraw, origin=(0, 0)):
+        points = [self.point(i, flow, origin) for i, flow in enumerate(self.flow_data)]
+
+        # data series line
+        draw.line(points, fill=self.series_color, width=2)
+
+    def draw_flow_rate(self, img: Image, origin=(0, 0)):
+        x, y = origin
         last_flow_rate = self.flow_data[-1] if len(self.flow_data) > 0 else 0
         fmt_flow = "{:0.1f}".format(last_flow_rate)
         fmt_flow_label = "g/s"
-        w = draw.textlength(fmt_flow, value_font)
-        wl = draw.textlength(fmt_flow_label, label_font)
-        draw.text(((self.x_pix - 4 - w - wl), (self.y_pix * .25) - value_font.size - 4), fmt_flow, fg_color, value_font)
-        draw.text(((self.x_pix - wl), (self.y_pix * .25) - label_font.size - 4), fmt_flow_label, fg_color, label_font)
-        return img
+        w = value_glyphs.textlength(fmt_flow)
+        wl = label_glyphs.textlength(fmt_flow_label)
+        value_glyphs.text(img, (x + (self.x_pix - 4 - w - wl), y + (self.y_pix * .25) - value_font.size - 4), fmt_flow, fg_color)
+        label_glyphs.text(img, (x + (self.x_pix - wl), y + (self.y_pix * .25) - label_font.size - 4), fmt_flow_label, fg_color)
+
+    def __draw_y_line(self, draw: ImageDraw, origin, y, color):
+        draw.line((origin[0], origin[1] + y, origin[0] + self.x_pix, origin[1] + y), fill=color, width=1)
+
+
+class IncrementalFlowGraph(FlowGraph):
+    """FlowGraph kept on a persistent surface, new samples are appended as line segments.
+
+    The x-axis starts out spanning min_points samples and doubles, up to max_points, when the
+    series outgrows it. Only then, or when the series restarts, shifts or changes color, is the
+    surface redrawn from scratch, so the per-frame cost doesn't grow with shot length.
+    """
+
+    def __init__(self, series_color="BLUE", width_pixels=240, height_pixels=160, max_points=600, min_points=64):
+        super().__init__([], series_color, width_pixels=width_pixels, height_pixels=height_pixels)
+        self.max_points = max_points
+        self.capacity = min(min_points, max_points)
+        self.x_pix_interval = self.x_pix / self.capacity
+        self.surface: Optional[Image] = None
+        self.drawn = 0
+        self.last_drawn: Optional[float] = None
+        self.axes = Image.new("RGBA", (self.x_pix, self.y_pix), "BLACK")
+        self.draw_axes(ImageDraw.Draw(self.axes))
+
+    def update(self, flow_data, series_color) -> Image:
+        count = len(flow_data)
+        redraw = (self.surface is None or series_color != self.series_color or count < self.drawn
+                  or (self.drawn > 0 and flow_data[self.drawn - 1] != self.last_drawn))
+        capacity = self.capacity_for(count)
+        if capacity != self.capacity:
+            # compress the x-axis
+            self.capacity = capacity
+            self.x_pix_interval = self.x_pix / self.capacity
+            redraw = True
+
+        self.flow_data = flow_data
+        self.series_color = series_color
+        if redraw:
+            self.surface = self.axes.copy()
+            if count > 0:
+                self.draw_series(ImageDraw.Draw(self.surface))
+        elif count > self.drawn:
+            start = max(self.drawn - 1, 0)
+            points = [self.point(i, flow_data[i]) for i in range(start, count)]
+            ImageDraw.Draw(self.surface).line(points, fill=self.series_color, width=2)
+
+        self.drawn = count
+        self.last_drawn = flow_data[-1] if count > 0 else None
+        return self.surface
+
+    def capacity_for(self, count: int) -> int:
+        """The capacity update() settles on for a series of count samples"""
+        capacity = self.capacity
+        while count > capacity and capacity < self.max_points:
+            capacity = min(capacity * 2, self.max_points)
+        return capacity
 
-    def __draw_y_line(self, draw: ImageDraw, y, color):
-        draw.line((0, y, self.x_pix, y), fill=color, width=1)
+
+def time_axis_label(sample_rate: float, points: int) -> str:
+    """Label at the far end of the flow graph's x-axis, the time points samples span"""
+    return "%ds" % math.ceil(sample_rate * float(points))
 
 
 class DisplayData:
     def __init__(self, weight: float, sample_rate: float, memory: TargetMemory, flow_data: list, battery: int,
                  paddle_on: bool, shot_time_elapsed: float, save_image: bool = False,
-                 flow_smooth_factor: int = 8):
+                 flow_smooth_factor: int = 8, smoothed_flow_data: list = None, smoothed_flow_count: int = None,
+                 flow_points: int = None):
         self.weight = weight
         self.sample_rate = sample_rate
         self.memory = memory
@@ -101,11 +180,234 @@ class DisplayData:
         self.shot_time_elapsed = shot_time_elapsed
         self.save_image = save_image
         self.flow_smooth_factor = flow_smooth_factor
+        # already smoothed by the producer, see ControlManager.smoothed_flow_rate_data
+        self.smoothed_flow_data = smoothed_flow_data
+        # total smoothed points produced this shot, lets DisplayState ship only the new ones
+        self.smoothed_flow_count = smoothed_flow_count
+        # number of raw flow samples, for when only the smoothed series is carried
+        if flow_points is None:
+            flow_points = len(flow_data) if flow_data is not None else 0
+        self.flow_points = flow_points
+
+    def visible_state(self, flow_graph: IncrementalFlowGraph = None) -> tuple:
+        """Everything that shows on screen, as rendered. Frames with equal visible state look the same.
+        Pass the flow_graph the frame is drawn with, the time axis is labeled from its capacity."""
+        time_label = None
+        if self.flow_points > 0:
+            points = self.flow_points
+            if flow_graph is not None:
+                points = flow_graph.capacity_for(len(self.flow_rate_moving_avg()))
+            time_label = time_axis_label(self.sample_rate, points)
+        return ("{:0.1f}".format(self.weight) if self.weight is not None else None,
+                "{:0.1f}".format(self.shot_time_elapsed), self.battery, self.paddle_on,
+                self.memory.name, self.memory.color, "{:0.1f}".format(self.memory.target),
+                self.flow_points, self.smoothed_flow_count, time_label)
 
     def flow_rate_moving_avg(self) -> list:
-        flow_data_series = pd.Series(self.flow_data)
-        flow_data_windows = flow_data_series.rolling(self.flow_smooth_factor)
-        return flow_data_windows.mean().dropna().to_list()
+        if self.smoothed_flow_data is not None:
+            return self.smoothed_flow_data
+        avg = MovingAverage(self.flow_smooth_factor)
+        smoothed = [avg.add(flow) for flow in self.flow_data]
+        return smoothed[self.flow_smooth_factor - 1:]
+
+
+class DisplayState:
+    """Latest DisplayData in shared memory, written by the control process and read by the display process.
+
+    Scalars live in fixed fields and the smoothed flow series in a ring indexed by the total number of
+    points produced, so a publish only copies the points added since the last one. A sequence counter
+    is made odd while a write is in progress and even when it's done, the reader retries until it
+    sees the same even value before and after copying, which always yields a consistent snapshot.
+    There is a single writer and a single reader.
+    """
+
+    NAME_LEN = 16
+    COLOR_LEN = 32
+
+    def __init__(self, max_flow_points: int = 600):
+        self.capacity = max_flow_points
+        self.sequence = RawValue('Q', 0)
+        self.weight = RawValue('d', math.nan)
+        self.sample_rate = RawValue('d', 0.0)
+        self.battery = RawValue('i', -1)
+        self.paddle_on = RawValue('b', 0)
+        self.shot_time_elapsed = RawValue('d', 0.0)
+        self.save_requests = RawValue('Q', 0)
+        self.flow_smooth_factor = RawValue('i', 8)
+        self.memory_name = RawArray('c', DisplayState.NAME_LEN)
+        self.memory_color = RawArray('c', DisplayState.COLOR_LEN)
+        self.memory_target = RawValue('d', 0.0)
+        self.memory_overshoot = RawValue('d', 0.0)
+        self.flow_points = RawValue('i', 0)
+        self.flow_len = RawValue('i', 0)
+        self.flow_count = RawValue('Q', 0)
+        self.flow_ring = RawArray('d', max_flow_points)
+        self.updated = Event()
+        # writer side bookkeeping
+        self._flow_written = 0
+        # reader side bookkeeping
+        self._saves_seen = 0
+
+    def publish(self, data: DisplayData):
+        self.sequence.value += 1
+        self.weight.value = data.weight if data.weight is not None else math.nan
+        self.sample_rate.value = data.sample_rate
+        self.battery.value = data.battery if data.battery is not None else -1
+        self.paddle_on.value = bool(data.paddle_on)
+        self.shot_time_elapsed.value = data.shot_time_elapsed
+        if data.save_image:
+            self.save_requests.value += 1
+        self.flow_smooth_factor.value = data.flow_smooth_factor
+        self.memory_name.value = data.memory.name.encode()[:DisplayState.NAME_LEN - 1]
+        self.memory_color.value = data.memory.color.encode()[:DisplayState.COLOR_LEN - 1]
+        self.memory_target.value = data.memory.target
+        self.memory_overshoot.value = data.memory.overshoot
+        self.flow_points.value = data.flow_points
+        self.__publish_flow(data)
+        self.sequence.value += 1
+        self.updated.set()
+
+    def __publish_flow(self, data: DisplayData):
+        flow_data = data.smoothed_flow_data if data.smoothed_flow_data is not None else data.flow_rate_moving_avg()
+        count = data.smoothed_flow_count if data.smoothed_flow_count is not None else len(flow_data)
+        if count < self._flow_written:
+            # new shot
+            self._flow_written = 0
+        length = min(len(flow_data), self.capacity)
+        new = min(count - self._flow_written, length)
+        for i in range(len(flow_data) - new, len(flow_data)):
+            self.flow_ring[(count - len(flow_data) + i) % self.capacity] = flow_data[i]
+        self._flow_written = count
+        self.flow_count.value = count
+        self.flow_len.value = length
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until something new is published, returns False on timeout"""
+        if not self.updated.wait(timeout):
+            return False
+        self.updated.clear()
+        return True
+
+    def snapshot(self) -> Optional[DisplayData]:
+        """Consistent copy of the last published data, None if nothing was published yet"""
+        while True:
+            sequence = self.sequence.value
+            if sequence == 0:
+                return None
+            if sequence % 2 == 1:
+                continue
+            weight = self.weight.value
+            sample_rate = self.sample_rate.value
+            battery = self.battery.value
+            paddle_on = bool(self.paddle_on.value)
+            shot_time_elapsed = self.shot_time_elapsed.value
+            save_requests = self.save_requests.value
+            flow_smooth_factor = self.flow_smooth_factor.value
+            memory = TargetMemory(self.memory_name.value.decode(), self.memory_color.value.decode())
+            memory.target = self.memory_target.value
+            memory.overshoot = self.memory_overshoot.value
+            flow_points = self.flow_points.value
+            count = self.flow_count.value
+            length = self.flow_len.value
+            start = (count - length) % self.capacity
+            if start + length <= self.capacity:
+                flow_data = self.flow_ring[start:start + length]
+            else:
+                flow_data = self.flow_ring[start:] + self.flow_ring[:start + length - self.capacity]
+            if sequence == self.sequence.value:
+                break
+
+        save_image = save_requests != self._saves_seen
+        self._saves_seen = save_requests
+        return DisplayData(None if math.isnan(weight) else weight, sample_rate, memory, None,
+                           None if battery < 0 else battery, paddle_on, shot_time_elapsed, save_image,
+                           flow_smooth_factor, flow_data, count, flow_points)
+
+
+class FrameSender:
+    """Clocks frames out to the panel on its own thread so the next frame renders during the transfer.
+
+    Holds at most one pending frame, a frame submitted while another is still waiting replaces it and
+    the older one is dropped, so the panel always gets the newest frame when the sender falls behind.
+    Blanking the panel goes through the same thread, so it never interleaves with a frame on the bus.
+    """
+
+    def __init__(self, lcd, panel_on: bool = True):
+        self.lcd = lcd
+        self.condition = Condition()
+        self.pending: Optional[Image] = None
+        self.invalidate = False
+        # whether the panel should be showing frames, and whether it is
+        self.panel_wanted = panel_on
+        self.panel_on = panel_on
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.frames_failed = 0
+        self.thread = Thread(target=self.__run, name="frame-sender", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, img: Image, invalidate: bool = False):
+        """Queue a frame, invalidate forces it out in full because the panel contents changed underneath us"""
+        with self.condition:
+            if self.pending is not None:
+                self.frames_dropped += 1
+            self.pending = img
+            self.invalidate = self.invalidate or invalidate
+            self.panel_wanted = True
+            self.condition.notify()
+
+    def blank(self):
+        """Turn the backlight off and paint the panel black, dropping any frame still waiting. The next
+        frame submitted turns it back on"""
+        with self.condition:
+            if self.pending is not None:
+                self.frames_dropped += 1
+            self.pending = None
+            self.panel_wanted = False
+            self.condition.notify()
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and self.panel_wanted == self.panel_on:
+                    self.condition.wait()
+                img = self.pending
+                invalidate = self.invalidate
+                self.pending = None
+                self.invalidate = False
+                panel_wanted = self.panel_wanted
+
+            try:
+                if not panel_wanted:
+                    self.__blank()
+                    continue
+                if not self.panel_on:
+                    self.lcd.PanelOn()
+                    self.lcd.On()
+                    self.panel_on = True
+                if img is None:
+                    continue
+                if invalidate:
+                    self.lcd.invalidate_framebuffers()
+                written = self.lcd.ShowImage(img, 0, 0, partial=True)
+            except Exception as ex:
+                self.frames_failed += 1
+                logging.error("Sending frame to panel failed: %s" % str(ex))
+                # whatever made it out of this frame is unknown, the next one goes out in full
+                with self.condition:
+                    self.invalidate = True
+                continue
+            self.frames_sent += 1
+            logging.debug("sent %d bytes to panel, %d frames dropped so far", written, self.frames_dropped)
+
+    def __blank(self):
+        self.panel_on = False
+        self.lcd.Off()
+        # paint black so nothing stale flashes up when the panel comes back on
+        self.lcd.fill(0x0000)
+        self.lcd.PanelOff()
 
 
 class DisplaySize(Enum):
@@ -117,7 +419,8 @@ class DisplayOrientation(StrEnum):
     LANDSCAPE = auto()
 
 class Display:
-    def __init__(self, data_queue: Queue, display_size: DisplaySize = DisplaySize.SIZE_2_0, image_save_dir: str = None):
+    def __init__(self, display_size: DisplaySize = DisplaySize.SIZE_2_0, image_save_dir: str = None,
+                 max_flow_points: int = 600):
         from lib import LCD_2inch4, LCD_2inch
         if display_size == DisplaySize.SIZE_2_4:
             self.lcd = LCD_2inch4.LCD_2inch4()
@@ -127,13 +430,20 @@ class Display:
             raise Exception("unknown display size configured: %s" % display_size.name)
         self.lcd.Init()
         self.lcd.clear()
+        # once the display process runs it owns the panel, display_on/off only tell it what we want
+        self.process = None
+        self.panel_wanted = Value('b', 1)
         self.on = True
-        self.data_queue: Queue[DisplayData] = data_queue
+        self.state = DisplayState(max_flow_points)
         self.flow_image = Image.new("RGBA", (0, 0), bg_color)
         self.display_off()
-        self.process = None
         self.image_save_dir = image_save_dir
         self.display_orientation = DisplayOrientation(os.environ.get('DISPLAY_ORIENTATION', DisplayOrientation.PORTRAIT))
+        if self.display_orientation == DisplayOrientation.LANDSCAPE:
+            self.flow_graph = IncrementalFlowGraph(width_pixels=320, height_pixels=132, max_points=max_flow_points)
+        else:
+            self.flow_graph = IncrementalFlowGraph(max_points=max_flow_points)
+        self.min_frame_interval = 1 / float(os.environ.get('DISPLAY_MAX_FPS', '20'))
 
     def start(self):
         self.process = Process(target=self.__update_display)
@@ -142,24 +452,37 @@ class Display:
     def stop(self):
         if self.process is not None:
             self.process.kill()
+            self.process = None
+            # the panel may be in whatever orientation the display process left it, which this process
+            # doesn't know, so no fill. The next start clears it anyway
+            self.lcd.Off()
+            self.lcd.PanelOff()
+            self.on = False
         self.display_off()
         self.lcd.module_exit()
 
     def display_off(self):
-        if self.on:
-            self.lcd.clear()
+        if self.process is not None:
+            if self.panel_wanted.value:
+                self.panel_wanted.value = 0
+                self.state.updated.set()
+        elif self.on:
             self.lcd.Off()
-            img = Image.new("RGBA", (self.lcd.width, self.lcd.height), bg_color)
-            self.lcd.ShowImage(img, 0, 0)
+            # paint black so nothing stale flashes up when the panel comes back on
+            self.lcd.fill(0x0000)
+            self.lcd.PanelOff()
             self.on = False
 
     def display_on(self):
-        if not self.on:
+        if self.process is not None:
+            self.panel_wanted.value = 1
+        elif not self.on:
+            self.lcd.PanelOn()
             self.lcd.On()
             self.on = True
 
     def put_data(self, data: DisplayData):
-        self.data_queue.put_nowait(data)
+        self.state.publish(data)
 
     def save_image(self, img: Image):
         if self.image_save_dir is None:
@@ -182,20 +505,34 @@ class Display:
             logging.error("Failed to save image: %s", str(ex))
 
     def __update_display(self):
+        sender = FrameSender(self.lcd, panel_on=self.on)
+        sender.start()
+        visible_state = None
+        last_frame = 0.0
         while True:
-            if self.data_queue.qsize() == 0:
-                time.sleep(.1)
+            updated = self.state.wait(timeout=1.0)
+            if not self.panel_wanted.value:
+                if sender.panel_wanted:
+                    sender.blank()
+                    # the frame on the panel is gone, the next one is drawn even if nothing changed
+                    visible_state = None
                 continue
+            if not updated:
+                continue
+
+            # hold off to stay under the frame rate cap, updates arriving meanwhile fold into this frame
+            delay = last_frame + self.min_frame_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
 
-            self.display_on()
-            data: Optional[DisplayData] = None
-            # always roll forward to latest data
-            while self.data_queue.qsize() > 0:
-                data = self.data_queue.get()
+            data: Optional[DisplayData] = self.state.snapshot()
 
             if data is None:
                 continue
 
+            if data.visible_state(self.flow_graph) == visible_state and not data.save_image:
+                continue
+
             if data.weight is None:
                 logging.error("Skipping display redraw because weight value is missing")
                 continue
@@ -206,19 +543,24 @@ class Display:
 
             img = None
             if self.display_orientation == DisplayOrientation.PORTRAIT:
-                img = draw_frame(self.lcd.width, self.lcd.height, data)
+                img = draw_frame(self.lcd.width, self.lcd.height, data, self.flow_graph)
             elif self.display_orientation == DisplayOrientation.LANDSCAPE:
-                img = draw_frame_wide(self.lcd.height, self.lcd.width, data)
+                img = draw_frame_wide(self.lcd.height, self.lcd.width, data, self.flow_graph)
             else:
                 logging.error("Failed to parse display orientation" % self.display_orientation)
                 sys.exit(1)
 
             if data.save_image and img is not None:
                 self.save_image(img)
-            self.lcd.ShowImage(img, 0, 0)
+            last_frame = time.monotonic()
+            visible_state = data.visible_state(self.flow_graph)
+            # turns the panel back on first if it was blanked
+            sender.submit(img)
 
 
-def draw_frame(width: int, height: int, data: DisplayData) -> Image:
+@lru_cache(maxsize=8)
+def draw_background(width: int, height: int, memory_name: str, memory_color: str, show_graph: bool) -> Image:
+    """Static layer of the portrait frame, everything that only changes with the selected memory"""
     img = Image.new("RGBA", (width, height), bg_color)
     draw = ImageDraw.Draw(img)
 
@@ -229,55 +571,72 @@ def draw_frame(width: int, height: int, data: DisplayData) -> Image:
 
     # weight and target labels
     draw.text((16, 16), "weight(g)", fg_color, label_font)
-    draw.text((130, 16), "target %s(g)" % data.memory.name, fg_color, label_font)
+    draw.text((130, 16), "target %s(g)" % memory_name, fg_color, label_font)
+
+    if show_graph:
+        FlowGraph([], memory_color).draw_axes(draw, (0, 98))
+        draw.text((218, 262), "0s", fg_color, label_font)
+    else:
+        fmt_ready = "Ready"
+        w = draw.textlength(fmt_ready, value_font_lg)
+        h = value_font_lg.size
+        h_pos = 164
+        draw.rectangle((116 - w / 2, h_pos, 124 + w / 2, h_pos + h + 4), bg_color, memory_color, 4)
+        draw.text((120 - w / 2, h_pos), fmt_ready, fg_color, value_font_lg)
+
+    return img
+
+
+def draw_frame(width: int, height: int, data: DisplayData, flow_graph: IncrementalFlowGraph = None) -> Image:
+    show_graph = data.flow_points > 0
+    img = draw_background(width, height, data.memory.name, data.memory.color, show_graph).copy()
+    draw = ImageDraw.Draw(img)
 
     # paddle and battery
     paddle_value = "ON" if data.paddle_on else "OFF"
-    draw.text((8, 294), "paddle:%s" % paddle_value, fg_color, label_font)
-    draw.text((124, 294), "battery:%d%%" % data.battery, fg_color, label_font)
+    label_glyphs.text(img, (8, 294), "paddle:%s" % paddle_value, fg_color)
+    label_glyphs.text(img, (124, 294), "battery:%d%%" % data.battery, fg_color)
 
     # weight value
     fmt_weight = "{:0.1f}".format(data.weight)
-    w = draw.textlength(fmt_weight, value_font_lg)
+    w = value_glyphs_lg.textlength(fmt_weight)
     h = value_font_lg.size
-    draw.text(((120 - w) / 2, (108 - h) / 2), fmt_weight, fg_color, value_font_lg)
+    value_glyphs_lg.text(img, ((120 - w) / 2, (108 - h) / 2), fmt_weight, fg_color)
 
     # target value
     fmt_target = "{:0.1f}".format(data.memory.target)
-    target_font = value_font_lg
-    w = draw.textlength(fmt_target, target_font)
-    h = target_font.size
-    draw.text(((120 - w) / 2 + 120, (108 - h) / 2), fmt_target, fg_color, target_font)
-
-    fmt_ready = "Ready"
-    w = draw.textlength(fmt_ready, value_font_lg)
+    w = value_glyphs_lg.textlength(fmt_target)
     h = value_font_lg.size
-    h_pos = 164
-    draw.rectangle((116 - w / 2, h_pos, 124 + w / 2, h_pos + h + 4), bg_color, data.memory.color, 4)
-    draw.text((120 - w / 2, h_pos), fmt_ready, fg_color, value_font_lg)
+    value_glyphs_lg.text(img, ((120 - w) / 2 + 120, (108 - h) / 2), fmt_target, fg_color)
 
-    if data.flow_data is not None and len(data.flow_data) > 0:
+    if show_graph:
         flow_rate_data = data.flow_rate_moving_avg()
-        flow_image = FlowGraph(flow_rate_data, data.memory.color).generate_graph()
-        last_sample_time = data.sample_rate * float(len(data.flow_data))
-
-        draw.text((4, 262), "%ds" % math.ceil(last_sample_time), fg_color, label_font)
-        draw.text((218, 262), "0s", fg_color, label_font)
+        if flow_graph is None:
+            flow_graph = FlowGraph(flow_rate_data, data.memory.color)
+            flow_graph.draw_series(draw, (0, 98))
+            points = data.flow_points
+        else:
+            img.paste(flow_graph.update(flow_rate_data, data.memory.color), (0, 98))
+            # the x-axis spans the graph's capacity, not the samples in it so far
+            points = flow_graph.capacity
+        flow_graph.draw_flow_rate(img, (0, 98))
+        label_glyphs.text(img, (4, 262), time_axis_label(data.sample_rate, points), fg_color)
 
         fmt_shot_time = "timer:{:0.1f}s".format(data.shot_time_elapsed)
-        w = draw.textlength(fmt_shot_time, label_font)
-        draw.text(((240 - w) / 2, 262), fmt_shot_time, fg_color, label_font)
-
-        img.paste(flow_image, (0, 98))
+        w = label_glyphs.textlength(fmt_shot_time)
+        label_glyphs.text(img, ((240 - w) / 2, 262), fmt_shot_time, fg_color)
 
     return img
 
-def draw_frame_wide(width: int, height: int, data: DisplayData) -> Image:
+
+@lru_cache(maxsize=8)
+def draw_background_wide(width: int, height: int, memory_name: str, memory_color: str, show_graph: bool,
+                         paddle_on: bool) -> Image:
+    """Static layer of the landscape frame, the background shade follows the paddle"""
     background = bg_color
-    if data.paddle_on:
+    if paddle_on:
         background = light_bg_color
     img = Image.new("RGBA", (width, height), background)
-
     draw = ImageDraw.Draw(img)
 
     # main boxes are 106 wide x 72 high
@@ -288,46 +647,61 @@ def draw_frame_wide(width: int, height: int, data: DisplayData) -> Image:
 
     # weight and target labels
     draw.text((10, 8), "weight(g)", fg_color, label_font)
-    draw.text((118, 8), "tgt %s (g)" % data.memory.name, fg_color, label_font)
+    draw.text((118, 8), "tgt %s (g)" % memory_name, fg_color, label_font)
     draw.text((234, 8), "battery", fg_color, label_font)
 
+    if show_graph:
+        FlowGraph([], memory_color, width_pixels=320, height_pixels=132).draw_axes(draw, (0, 72))
+        draw.text((298, 212), "0s", fg_color, label_font)
+    else:
+        fmt_ready = "Ready"
+        w = draw.textlength(fmt_ready, value_font_lg)
+        h = value_font_lg.size
+        h_pos = 120
+        draw.rectangle((156 - w / 2, h_pos, 164 + w / 2, h_pos + h + 4), bg_color, memory_color, 4)
+        draw.text((160 - w / 2, h_pos), fmt_ready, fg_color, value_font_lg)
+
+    return img
+
+
+def draw_frame_wide(width: int, height: int, data: DisplayData, flow_graph: IncrementalFlowGraph = None) -> Image:
+    show_graph = data.flow_points > 0
+    img = draw_background_wide(width, height, data.memory.name, data.memory.color, show_graph,
+                               data.paddle_on).copy()
+    draw = ImageDraw.Draw(img)
+
     # weight value
     fmt_weight = "{:0.1f}".format(data.weight)
-    w = draw.textlength(fmt_weight, value_font_lg)
+    w = value_glyphs_lg.textlength(fmt_weight)
     h = value_font_lg.size
-    draw.text(((106 - w) / 2, (88 - h) / 2), fmt_weight, fg_color, value_font_lg)
+    value_glyphs_lg.text(img, ((106 - w) / 2, (88 - h) / 2), fmt_weight, fg_color)
 
     # target value
     fmt_target = "{:0.1f}".format(data.memory.target)
-    target_font = value_font_lg
-    w = draw.textlength(fmt_target, target_font)
-    h = target_font.size
-    draw.text(((106 - w) / 2 + 106, (88 - h) / 2), fmt_target, fg_color, target_font)
+    w = value_glyphs_lg.textlength(fmt_target)
+    h = value_font_lg.size
+    value_glyphs_lg.text(img, ((106 - w) / 2 + 106, (88 - h) / 2), fmt_target, fg_color)
 
     # battery value
     fmt_batt = "%d%%" % data.battery
-    w = draw.textlength(fmt_batt, value_font_lg)
-    draw.text(((106 - w)/2 + 214, (88 - h) / 2), fmt_batt, fg_color, value_font_lg)
-
-    fmt_ready = "Ready"
-    w = draw.textlength(fmt_ready, value_font_lg)
-    h = value_font_lg.size
-    h_pos = 120
-    draw.rectangle((156 - w / 2, h_pos, 164 + w / 2, h_pos + h + 4), bg_color, data.memory.color, 4)
-    draw.text((160 - w / 2, h_pos), fmt_ready, fg_color, value_font_lg)
+    w = value_glyphs_lg.textlength(fmt_batt)
+    value_glyphs_lg.text(img, ((106 - w)/2 + 214, (88 - h) / 2), fmt_batt, fg_color)
 
-    if data.flow_data is not None and len(data.flow_data) > 0:
+    if show_graph:
         flow_rate_data = data.flow_rate_moving_avg()
-        flow_image = FlowGraph(flow_rate_data, data.memory.color, width_pixels=320, height_pixels=132).generate_graph()
-        last_sample_time = data.sample_rate * float(len(data.flow_data))
-
-        draw.text((4, 212), "%ds" % math.ceil(last_sample_time), fg_color, label_font)
-        draw.text((298, 212), "0s", fg_color, label_font)
+        if flow_graph is None:
+            flow_graph = FlowGraph(flow_rate_data, data.memory.color, width_pixels=320, height_pixels=132)
+            flow_graph.draw_series(draw, (0, 72))
+            points = data.flow_points
+        else:
+            img.paste(flow_graph.update(flow_rate_data, data.memory.color), (0, 72))
+            # the x-axis spans the graph's capacity, not the samples in it so far
+            points = flow_graph.capacity
+        flow_graph.draw_flow_rate(img, (0, 72))
+        label_glyphs.text(img, (4, 212), time_axis_label(data.sample_rate, points), fg_color)
 
         fmt_shot_time = "timer:{:0.1f}s".format(data.shot_time_elapsed)
-        w = draw.textlength(fmt_shot_time, label_font_lg)
-        draw.text(((320 - w) / 2, 208), fmt_shot_time, fg_color, label_font_lg)
-
-        img.paste(flow_image, (0, 72))
+        w = label_glyphs_lg.textlength(fmt_shot_time)
+        label_glyphs_lg.text(img, ((320 - w) / 2, 208), fmt_shot_time, fg_color)
 
     return img
@@ -0,0 +1,90 @@
+from typing import Optional
+
+import numpy as np
+
+# edge length in pixels of the tiles frames are compared in
+TILE_SIZE = 16
+# share of tiles that may change before we give up on partial updates and send the full frame
+FULL_FRAME_THRESHOLD = 0.5
+
+
+class Framebuffer:
+    """Preallocated RGB565 frame that PIL images are packed into before being clocked out over SPI.
+
+    The packed pixels are stored big-endian so the backing array can be handed straight to
+    spidev as one contiguous buffer, no per-frame Python lists or intermediate copies.
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        # big-endian words, the byte order the panel expects on the wire
+        self.pixels = np.zeros((height, width), dtype='>u2')
+        self._scratch = np.zeros((height, width), dtype=np.uint16)
+        self._channel = np.zeros((height, width), dtype=np.uint16)
+        self.buffer = memoryview(self.pixels).cast('B')
+        # what we believe is on the panel, only meaningful while sent is True
+        self._sent = np.zeros((height, width), dtype='>u2')
+        self._changed = np.zeros((height, width), dtype=bool)
+        self._row_tiles = np.arange(0, height, TILE_SIZE)
+        self._col_tiles = np.arange(0, width, TILE_SIZE)
+        self.sent = False
+
+    def pack(self, image) -> np.ndarray:
+        """Convert an RGB/RGBA PIL image of the framebuffer's size to RGB565 in place"""
+        rgb = np.asarray(image)
+        pix = self._scratch
+        tmp = self._channel
+        # RGB888 >> RGB565
+        np.bitwise_and(rgb[..., 0], 0xF8, out=pix, dtype=np.uint16)
+        np.left_shift(pix, 8, out=pix)
+        np.bitwise_and(rgb[..., 1], 0xFC, out=tmp, dtype=np.uint16)
+        np.left_shift(tmp, 3, out=tmp)
+        np.bitwise_or(pix, tmp, out=pix)
+        np.right_shift(rgb[..., 2], 3, out=tmp, dtype=np.uint16)
+        np.bitwise_or(pix, tmp, out=pix)
+        np.copyto(self.pixels, pix)
+        return self.pixels
+
+    def damage(self, full_threshold: float = FULL_FRAME_THRESHOLD) -> Optional[list]:
+        """Return the (x0, y0, x1, y1) regions that differ from the last committed frame.
+
+        Returns None when the full frame should be sent instead, either because the panel contents
+        are unknown or because more than full_threshold of the tiles changed.
+        """
+        if not self.sent:
+            return None
+        np.not_equal(self.pixels, self._sent, out=self._changed)
+        tiles = np.logical_or.reduceat(self._changed, self._row_tiles, axis=0)
+        tiles = np.logical_or.reduceat(tiles, self._col_tiles, axis=1)
+        if tiles.sum() > full_threshold * tiles.size:
+            return None
+
+        # one span per tile row, from the first to the last changed tile, then stack rows with equal spans
+        rects = []
+        for row, changed in enumerate(tiles):
+            cols = np.flatnonzero(changed)
+            if len(cols) == 0:
+                continue
+            x0 = int(cols[0]) * TILE_SIZE
+            x1 = min((int(cols[-1]) + 1) * TILE_SIZE, self.width)
+            y0 = row * TILE_SIZE
+            y1 = min(y0 + TILE_SIZE, self.height)
+            if rects and rects[-1][0] == x0 and rects[-1][2] == x1 and rects[-1][3] == y0:
+                rects[-1] = (x0, rects[-1][1], x1, y1)
+            else:
+                rects.append((x0, y0, x1, y1))
+        return rects
+
+    def region(self, x0: int, y0: int, x1: int, y1: int) -> memoryview:
+        """Bytes of a sub-rectangle in panel order, only copied when the rectangle is narrower than the frame"""
+        return memoryview(np.ascontiguousarray(self.pixels[y0:y1, x0:x1])).cast('B')
+
+    def commit(self):
+        """Record the packed frame as being what is now on the panel"""
+        np.copyto(self._sent, self.pixels)
+        self.sent = True
+
+    def invalidate(self):
+        """Forget the panel contents, the next frame goes out in full"""
+        self.sent = False
@@ -0,0 +1,67 @@
+from PIL import Image, ImageDraw, ImageFont
+
+NUMERIC_CHARS = "0123456789.-%s"
+
+
+class Glyph:
+    def __init__(self, mask: Image, offset: tuple, advance: float):
+        self.mask = mask
+        self.offset = offset
+        self.advance = advance
+
+
+class GlyphAtlas:
+    """Glyphs of one font rasterized once up front, so readouts are assembled by pasting cached masks
+    instead of going through FreeType on every frame.
+
+    Entries can be single characters or whole label strings, text is matched against the longest
+    entries first. Anything not in the atlas falls back to regular text drawing.
+    """
+
+    def __init__(self, font: ImageFont, chars: str = NUMERIC_CHARS, labels: tuple = ()):
+        self.font = font
+        self.glyphs: dict[str, Glyph] = {}
+        for entry in list(chars) + list(labels):
+            self.glyphs[entry] = self.__rasterize(entry)
+        self.labels = sorted(labels, key=len, reverse=True)
+
+    def __rasterize(self, text: str) -> Glyph:
+        left, top, right, bottom = self.font.getbbox(text)
+        mask = Image.new("L", (max(right - left, 1), max(bottom - top, 1)), 0)
+        ImageDraw.Draw(mask).text((-left, -top), text, 255, self.font)
+        return Glyph(mask, (left, top), self.font.getlength(text))
+
+    def __split(self, text: str) -> list:
+        parts = []
+        i = 0
+        while i < len(text):
+            for label in self.labels:
+                if text.startswith(label, i):
+                    parts.append(label)
+                    i += len(label)
+                    break
+            else:
+                parts.append(text[i])
+                i += 1
+        return parts
+
+    def textlength(self, text: str) -> float:
+        length = 0.0
+        for part in self.__split(text):
+            glyph = self.glyphs.get(part)
+            length += glyph.advance if glyph is not None else self.font.getlength(part)
+        return length
+
+    def text(self, img: Image, xy: tuple, text: str, fill):
+        x, y = xy
+        draw = None
+        for part in self.__split(text):
+            glyph = self.glyphs.get(part)
+            if glyph is None:
+                if draw is None:
+                    draw = ImageDraw.Draw(img)
+                draw.text((x, y), part, fill, self.font)
+                x += self.font.getlength(part)
+                continue
+            img.paste(fill, (round(x + glyph.offset[0]), round(y + glyph.offset[1])), glyph.mask)
+            x += glyph.advance
@@ -0,0 +1,130 @@
+from bisect import bisect_left
+from collections import deque
+from threading import Lock
+from typing import Optional
+
+from lib.pyacaia import percentile
+
+# histogram bucket upper bounds in milliseconds, the last bucket takes everything above
+BUCKETS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+# stages of the cutoff path, in order, see ShotLatency.breakdown()
+STAGES = ('decode', 'decision', 'relay', 'total', 'settle')
+
+
+class RollingHistogram:
+    """Bucket counts and percentiles over the last window values, in milliseconds"""
+
+    def __init__(self, window: int = 256, bounds: tuple = BUCKETS_MS):
+        self.bounds = bounds
+        self.values = deque()
+        self.window = window
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+
+    def add(self, ms: float):
+        self.values.append(ms)
+        self.counts[bisect_left(self.bounds, ms)] += 1
+        self.total += 1
+        if len(self.values) > self.window:
+            self.counts[bisect_left(self.bounds, self.values.popleft())] -= 1
+
+    def snapshot(self) -> dict:
+        values = sorted(self.values)
+        buckets = {}
+        for bound, count in zip(self.bounds, self.counts):
+            buckets['<=%g' % bound] = count
+        buckets['>%g' % self.bounds[-1]] = self.counts[-1]
+        return {
+            'count': len(values),
+            'total': self.total,
+            'p50': percentile(values, 0.5),
+            'p90': percentile(values, 0.9),
+            'p99': percentile(values, 0.99),
+            'max': values[-1] if values else None,
+            'buckets': buckets,
+        }
+
+
+class ShotLatency:
+    """Monotonic timestamps along the cutoff path of one shot, from the weight notification the cut was
+    decided on to the weight settling"""
+
+    def __init__(self, memory: str, arrival: float, decoded: Optional[float], planned: float, decided: float,
+                 relay_off: float):
+        self.memory = memory
+        # the deciding weight notification came in, and was decoded. decoded is None when the cut wasn't
+        # triggered by a fresh notification
+        self.arrival = arrival
+        self.decoded = decoded
+        # when the cutoff engine meant to cut, and when it did
+        self.planned = planned
+        self.decided = decided
+        # DigitalOutputDevice.off() returned
+        self.relay_off = relay_off
+        # the weight stopped moving, at final_weight
+        self.settled: Optional[float] = None
+        self.final_weight: Optional[float] = None
+
+    def breakdown(self) -> dict:
+        """Milliseconds spent in each of STAGES. A cut scheduled ahead of time only counts its timer being
+        late as decision time, not the wait it was scheduled for"""
+        decoded = self.decoded if self.decoded is not None else self.arrival
+        stages = {
+            'decode': (decoded - self.arrival) * 1000,
+            'decision': (self.decided - max(decoded, self.planned)) * 1000,
+            'relay': (self.relay_off - self.decided) * 1000,
+            'total': (self.relay_off - self.arrival) * 1000,
+            'settle': (self.settled - self.relay_off) * 1000 if self.settled is not None else None,
+        }
+        stages['memory'] = self.memory
+        stages['scheduled'] = self.planned > decoded
+        stages['final_weight'] = self.final_weight
+        return stages
+
+    def __str__(self):
+        stages = self.breakdown()
+        return "decode %.2fms, decision %.2fms%s, relay %.2fms, total %.2fms, settle %s" % (
+            stages['decode'], stages['decision'], " (scheduled)" if stages['scheduled'] else "", stages['relay'],
+            stages['total'], "%.0fms" % stages['settle'] if stages['settle'] is not None else "unknown")
+
+
+class LatencyTracker:
+    """Per-shot latency breakdowns of the last shots, plus rolling histograms of every stage and of the
+    decode time of every weight notification. Safe to query from any thread."""
+
+    def __init__(self, shots: int = 20, window: int = 256):
+        self.mutex = Lock()
+        self.shots = deque(maxlen=shots)
+        self.histograms = {stage: RollingHistogram(window) for stage in STAGES}
+        self.notifications = RollingHistogram(window)
+
+    def notification(self, arrival: float, decoded: float):
+        with self.mutex:
+            self.notifications.add((decoded - arrival) * 1000)
+
+    def cut(self, shot: ShotLatency):
+        """The relay is off, records everything up to there"""
+        stages = shot.breakdown()
+        with self.mutex:
+            self.shots.append(shot)
+            for stage in STAGES:
+                if stages[stage] is not None:
+                    self.histograms[stage].add(stages[stage])
+
+    def settled(self, shot: ShotLatency, when: float, final_weight: float):
+        with self.mutex:
+            shot.settled = when
+            shot.final_weight = final_weight
+            self.histograms['settle'].add((when - shot.relay_off) * 1000)
+
+    def last_shot(self) -> Optional[ShotLatency]:
+        with self.mutex:
+            return self.shots[-1] if self.shots else None
+
+    def snapshot(self) -> dict:
+        with self.mutex:
+            return {
+                'shots': [shot.breakdown() for shot in self.shots],
+                'stages': {stage: histogram.snapshot() for stage, histogram in self.histograms.items()},
+                'notification_decode': self.notifications.snapshot(),
+            }
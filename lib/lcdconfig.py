@@ -34,6 +34,8 @@ import spidev
 import logging
 import numpy as np
 
+from .framebuffer import Framebuffer
+
 class RaspberryPi:
     def __init__(self,spi=spidev.SpiDev(0,0),spi_freq=40000000,rst = 27,dc = 25,bl = 18,bl_freq=1000,i2c=None,i2c_freq=100000):
         import RPi.GPIO
@@ -53,6 +55,11 @@ class RaspberryPi:
         self.GPIO.output(self.BL_PIN,   self.GPIO.HIGH)
         #Initialize SPI
         self.SPI = spi
+        self._framebuffers = {}
+        self._fill_buffers = {}
+        # size of the window frames were last sent in by this process, follows the orientation of the
+        # last image it showed. Only the process sending the frames knows it, so only that one may fill()
+        self.window_size = None
         if self.SPI!=None :
             self.SPI.max_speed_hz = spi_freq
             self.SPI.mode = 0b00
@@ -69,6 +76,56 @@ class RaspberryPi:
     def spi_writebyte(self, data):
         if self.SPI!=None :
             self.SPI.writebytes(data)
+
+    def spi_writebuffer(self, data):
+        # writebytes2 takes any buffer object and does its own chunking to the spidev bufsiz
+        if self.SPI!=None :
+            self.SPI.writebytes2(data)
+
+    def framebuffer(self, width, height):
+        fb = self._framebuffers.get((width, height))
+        if fb is None:
+            fb = Framebuffer(width, height)
+            self._framebuffers[(width, height)] = fb
+        return fb
+
+    def invalidate_framebuffers(self):
+        # the panel was written outside of the framebuffers, next frame has to be sent in full
+        for fb in self._framebuffers.values():
+            fb.invalidate()
+
+    def write_framebuffer(self, fb, partial=False):
+        """Send a packed frame, optionally only the regions that changed since the last one sent.
+        Returns the number of pixel bytes written."""
+        rects = fb.damage() if partial else None
+        if rects is None:
+            self.SetWindows(0, 0, fb.width, fb.height)
+            self.digital_write(self.DC_PIN,self.GPIO.HIGH)
+            self.spi_writebuffer(fb.buffer)
+            written = fb.buffer.nbytes
+        else:
+            written = 0
+            for (x0, y0, x1, y1) in rects:
+                region = fb.region(x0, y0, x1, y1)
+                self.SetWindows(x0, y0, x1, y1)
+                self.digital_write(self.DC_PIN,self.GPIO.HIGH)
+                self.spi_writebuffer(region)
+                written += region.nbytes
+        fb.commit()
+        self.window_size = (fb.width, fb.height)
+        return written
+
+    def fill(self, color=0x0000):
+        """Paint the whole panel in one RGB565 color, written in bulk from a constant buffer built once per color"""
+        buf = self._fill_buffers.get(color)
+        if buf is None:
+            buf = memoryview(np.full(self.width * self.height, color, dtype='>u2')).cast('B')
+            self._fill_buffers[color] = buf
+        width, height = self.window_size if self.window_size is not None else (self.width, self.height)
+        self.SetWindows(0, 0, width, height)
+        self.digital_write(self.DC_PIN,self.GPIO.HIGH)
+        self.spi_writebuffer(buf)
+        self.invalidate_framebuffers()
     def bl_DutyCycle(self, duty):
         self._pwm.ChangeDutyCycle(duty)
 
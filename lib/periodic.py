@@ -0,0 +1,110 @@
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+from threading import Event, Lock, Thread
+from typing import Callable
+
+from lib.pyacaia import percentile
+
+
+class PeriodicThread(Thread):
+    """Calls func every period seconds on monotonic deadlines, recording how late each tick started and how
+    long it took.
+
+    Deadlines are start + n * period, so the time func takes doesn't stretch the period. A tick that runs past
+    the next deadline counts as an overrun and the deadlines it missed are skipped, not run back to back.
+
+    A realtime_priority puts the thread under SCHED_FIFO, a nice value lowers its priority instead. Both need
+    privileges the service has, elsewhere they're logged and ignored.
+    """
+
+    def __init__(self, name: str, period: float, func: Callable[[], None], realtime_priority: int = None,
+                 nice: int = None, history: int = 1024):
+        super().__init__(name=name, daemon=True)
+        self.period = period
+        self.func = func
+        self.realtime_priority = realtime_priority
+        self.nice = nice
+        self.stopped = Event()
+
+        self.history = history
+        self.lateness = array('d', bytes(8 * history))
+        self.durations = array('d', bytes(8 * history))
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.errors = 0
+        self.mutex = Lock()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        self.__set_priority()
+        deadline = time.monotonic()
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            if now < deadline and self.stopped.wait(deadline - now):
+                break
+            start = time.monotonic()
+            try:
+                self.func()
+            except Exception as ex:
+                with self.mutex:
+                    self.errors += 1
+                logging.error("%s tick failed: %s" % (self.name, str(ex)))
+            end = time.monotonic()
+            self.__record(start - deadline, end - start)
+
+            deadline += self.period
+            if end > deadline:
+                missed = math.floor((end - deadline) / self.period) + 1
+                with self.mutex:
+                    self.overruns += 1
+                    self.skipped += missed
+                deadline += missed * self.period
+
+    def __record(self, lateness: float, duration: float):
+        with self.mutex:
+            index = self.ticks % self.history
+            self.lateness[index] = lateness
+            self.durations[index] = duration
+            self.ticks += 1
+
+    def stats(self) -> dict:
+        """Jitter (how late ticks started) and work time percentiles over the recent ticks, in seconds"""
+        with self.mutex:
+            count = min(self.ticks, self.history)
+            lateness = sorted(self.lateness[:count])
+            durations = sorted(self.durations[:count])
+            ticks, overruns, skipped, errors = self.ticks, self.overruns, self.skipped, self.errors
+        return {
+            'period': self.period,
+            'ticks': ticks,
+            'overruns': overruns,
+            'skipped': skipped,
+            'errors': errors,
+            'jitter_p50': percentile(lateness, 0.5),
+            'jitter_p99': percentile(lateness, 0.99),
+            'jitter_max': lateness[-1] if lateness else None,
+            'work_p50': percentile(durations, 0.5),
+            'work_p99': percentile(durations, 0.99),
+            'work_max': durations[-1] if durations else None,
+        }
+
+    def __set_priority(self):
+        tid = threading.get_native_id()
+        if self.realtime_priority is not None:
+            try:
+                os.sched_setscheduler(tid, os.SCHED_FIFO, os.sched_param(self.realtime_priority))
+            except (AttributeError, OSError) as ex:
+                logging.warning("Could not make %s realtime: %s" % (self.name, str(ex)))
+        if self.nice is not None:
+            try:
+                # on Linux this takes a thread id and only affects that thread
+                os.setpriority(os.PRIO_PROCESS, tid, self.nice)
+            except (AttributeError, OSError) as ex:
+                logging.warning("Could not lower the priority of %s: %s" % (self.name, str(ex)))
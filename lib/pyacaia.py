@@ -9,9 +9,15 @@
 
 __version__ = "0.4.0"
 
+import abc
 import logging
+import struct
 import time
-from threading import Thread, Timer, Lock
+from array import array
+from collections import deque
+from concurrent.futures import Future
+from queue import SimpleQueue
+from threading import Thread, Timer, Lock, RLock, Event, current_thread
 
 root = logging.getLogger()
 root.setLevel(logging.INFO)
@@ -23,7 +29,13 @@ HEADER2 = 0xdd
 
 
 def find_acaia_devices(timeout=3, backend='bluepy'):
-    addresses = []
+    return [address for address, name, rssi in scan_acaia_devices(timeout, backend)]
+
+
+def scan_acaia_devices(timeout=3, backend='bluepy'):
+    """Scan for Acaia scales, returns (address, name, rssi) tuples.  The
+    RSSI is None when the backend doesn't report it"""
+    found = []
     logging.debug('Looking for ACAIA devices...')
 
     devices_start_names = [
@@ -41,12 +53,11 @@ def find_acaia_devices(timeout=3, backend='bluepy'):
             adapter.reset()
             adapter.start(False)
             devices = adapter.scan(timeout=timeout, run_as_root=True)
-            addresses = []
             for d in devices:
                 if (d['name']
                         and any(d['name'].startswith(name) for name in devices_start_names)):
-                    print(d['name'], d['address'])
-                    addresses.append(d['address'])
+                    logging.debug('found %s %s', d['name'], d['address'])
+                    found.append((d['address'], d['name'], d.get('rssi')))
             adapter.stop()
         except Exception as ex:
             raise Exception('pygatt scan failed: %s' % str(ex))
@@ -65,21 +76,20 @@ def find_acaia_devices(timeout=3, backend='bluepy'):
             try:
                 devices = scanner.scan(timeout)
             except BTLEDisconnectError:
-                print("Disconnected error, retry")
+                logging.warning("Scan disconnected, retrying")
                 devices = scanner.scan(timeout)
 
-            addresses = []
             for dev in devices:
                 for (adtype, desc, value) in dev.getScanData():
                     if (desc == 'Complete Local Name'
                             and any(value.startswith(name) for name in devices_start_names)):
-                        print(value, dev.addr)
-                        addresses.append(dev.addr)
+                        logging.debug('found %s %s rssi %s', value, dev.addr, dev.rssi)
+                        found.append((dev.addr, value, dev.rssi))
 
         except Exception as ex:
             raise Exception('bluepy scan failed: %s' % str(ex))
 
-    return addresses
+    return found
 
 
 class Queue(object):
@@ -115,27 +125,468 @@ class Queue(object):
         return dequeue(self)
 
 
+class Command(object):
+    __slots__ = ('packet', 'future', 'ack')
+
+    def __init__(self, packet, ack=None):
+        self.packet = packet
+        self.future = Future()
+        # type 8 button message the scale acknowledges the command with.
+        # Without one the future resolves once the packet is written
+        self.ack = ack
+
+
 class CommandQueue(object):
+    """Commands waiting to be written from the notification thread, urgent
+    ones ahead of the rest.  wake() is called for every command so the
+    thread doesn't sit out its wait before writing it"""
 
-    def __init__(self):
-        self.queue = []
+    def __init__(self, wake=None):
+        self.urgent = deque()
+        self.normal = deque()
         self.mutex = Lock()
+        self.wake = wake
 
-    def add(self, packet):
-        self.mutex.acquire()
-        self.queue.append(packet)
-        self.mutex.release()
+    def add(self, command, urgent=False):
+        with self.mutex:
+            if urgent:
+                self.urgent.append(command)
+            else:
+                self.normal.append(command)
+        if self.wake is not None:
+            self.wake()
+        return command.future
 
     def dequeue(self):
-        packet = None
-        self.mutex.acquire()
-        if self.queue:
-            packet = self.queue.pop(0)
-        self.mutex.release()
-        return packet
+        with self.mutex:
+            if self.urgent:
+                return self.urgent.popleft()
+            if self.normal:
+                return self.normal.popleft()
+            return None
+
+    def __len__(self):
+        return len(self.urgent) + len(self.normal)
+
+    def fail(self, ex):
+        """Drop every queued command, failing its future with ex"""
+        with self.mutex:
+            commands = list(self.urgent) + list(self.normal)
+            self.urgent.clear()
+            self.normal.clear()
+        for command in commands:
+            _fail(command.future, ex)
+
+
+def _resolve(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _fail(future, ex):
+    if not future.done():
+        future.set_exception(ex)
+
+
+# largest length byte a frame can carry, the longest messages the scales send are well
+# under 20 bytes. Anything longer is a corrupted length byte or not a header at all
+MAX_MESSAGE_LENGTH = 32
+
+
+class PacketFramer(object):
+    """Reassembles the notification stream into complete messages.
+
+    Notifications are copied into one preallocated buffer, the unread part is
+    only moved to the front when a new notification would not fit behind it.
+    Header search resumes where the previous call stopped, and complete frames
+    are handed out as memoryviews into the buffer.  A frame is only valid until
+    the next call to feed().
+    """
+
+    HEADER = bytes([HEADER1, HEADER2])
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # bytes thrown away while looking for a header
+        self.discarded = 0
+        # where the frame next() returned last started, until reject() or the next feed()
+        self.frame_start = None
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+        self.frame_start = None
+
+    def feed(self, data):
+        size = len(data)
+        self.frame_start = None
+        if size >= self.capacity:
+            # only the tail of an oversized chunk can still hold a message
+            self.discarded += self.end - self.start + size - self.capacity
+            self.view[0:self.capacity] = memoryview(data)[size - self.capacity:]
+            self.start = 0
+            self.end = self.capacity
+            return
+        if self.end + size > self.capacity:
+            pending = self.end - self.start
+            if pending + size > self.capacity:
+                # more than a buffer worth of garbage, keep the newest bytes
+                drop = pending + size - self.capacity
+                self.discarded += drop
+                self.start += drop
+                pending -= drop
+            self.buffer[0:pending] = bytes(self.view[self.start:self.end])
+            self.start = 0
+            self.end = pending
+        self.view[self.end:self.end + size] = data
+        self.end += size
+
+    def next(self):
+        """Return the next complete frame, header to checksum, or None if
+        more data is needed"""
+        while True:
+            header = self.buffer.find(PacketFramer.HEADER, self.start, self.end)
+            if header < 0:
+                # keep a trailing first header byte, its partner may be in the next notification
+                keep = 1 if self.end > self.start and self.buffer[self.end - 1] == HEADER1 else 0
+                self.discarded += self.end - self.start - keep
+                self.start = self.end - keep
+                return None
+            if header > self.start:
+                logging.debug("Ignoring %d bytes before header", header - self.start)
+                self.discarded += header - self.start
+                self.start = header
+            if self.end - self.start < 6:
+                return None
+
+            length = self.buffer[self.start + 3]
+            if length > MAX_MESSAGE_LENGTH:
+                # a corrupted length byte or a header inside a payload, waiting for that
+                # many bytes would hold back every frame behind it
+                self.discarded += 1
+                self.start += 1
+                continue
+            frame_end = self.start + length + 5
+            if frame_end > self.end:
+                return None
+            frame = self.view[self.start:frame_end]
+            self.frame_start = self.start
+            self.start = frame_end
+            return frame
+
+    def reject(self):
+        """The frame next() returned last is corrupt. Look for the next header
+        from its second byte on, instead of dropping whatever it spanned"""
+        if self.frame_start is not None:
+            self.discarded += 1
+            self.start = self.frame_start + 1
+            self.frame_start = None
+
+
+WEIGHT_BE = struct.Struct('>I')
+WEIGHT_LE = struct.Struct('<I')
+WEIGHT_DIVISORS = {1: 10.0, 2: 100.0, 3: 1000.0, 4: 10000.0}
+UNITS = {2: 'grams', 5: 'ounces'}
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def decodeWeight(payload):
+    unit = payload[4] & 0xFF
+    divisor = WEIGHT_DIVISORS.get(unit)
+    if divisor is None:
+        raise ValueError("Bad unit %d" % unit)
+    sign = -1 if (payload[5] & 0x02) else 1
+
+    # Try big-endian first
+    w = sign * (WEIGHT_BE.unpack_from(payload)[0] / divisor)
+    if abs(w) <= 2000:
+        return w
+
+    # Otherwise fall back to little-endian
+    return sign * (WEIGHT_LE.unpack_from(payload)[0] / divisor)
+
+
+def decodeTime(time_payload):
+    return (time_payload[0] & 0xff) * 60 + time_payload[1] + time_payload[2] / 10.0
+
+
+def _weightEvent(msg, payload):
+    msg.value = decodeWeight(payload)
+
+
+def _heartbeatEvent(msg, payload):
+    if payload[2] == 5:
+        msg.value = decodeWeight(payload[3:])
+    elif payload[2] == 7:
+        msg.time = decodeTime(payload[3:])
+    logging.debug('heartbeat response (weight: %s time: %s)', msg.value, msg.time)
+
+
+def _timerEvent(msg, payload):
+    msg.time = decodeTime(payload)
+    logging.debug('timer: %s', msg.time)
+
+
+def _buttonWeight(msg, payload):
+    msg.value = decodeWeight(payload[2:])
+
+
+def _buttonTimeWeight(msg, payload):
+    msg.time = decodeTime(payload[2:])
+    msg.value = decodeWeight(payload[6:])
+
+
+# (payload[0], payload[1]) of a type 8 event -> button name, decoder for the rest
+BUTTONS = {
+    (0, 5): ('tare', _buttonWeight),
+    (8, 5): ('start', _buttonWeight),
+    (10, 7): ('stop', _buttonTimeWeight),
+    (9, 7): ('reset', _buttonTimeWeight),
+}
+
+
+def _buttonEvent(msg, payload):
+    button = BUTTONS.get((payload[0], payload[1]))
+    if button is None:
+        msg.button = 'unknownbutton'
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('unknownbutton %s', bytes(payload))
+        return
+    msg.button = button[0]
+    button[1](msg, payload)
+    logging.debug('%s (time: %s weight: %s)', msg.button, msg.time, msg.value)
+
+
+# event message type -> decoder filling in the Message
+EVENTS = {
+    5: _weightEvent,
+    11: _heartbeatEvent,
+    7: _timerEvent,
+    8: _buttonEvent,
+}
+
+
+class WeightSamples(object):
+    """Ring of the most recent weight notifications as (arrival time,
+    weight, sequence number).  Arrival times come from time.monotonic(),
+    sequence numbers start at 1 and keep counting across reconnects.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.weights = array('d', bytes(8 * capacity))
+        # sequence number of the newest sample, 0 if there is none
+        self.sequence = 0
+        self.mutex = Lock()
+
+    def add(self, arrival, weight):
+        with self.mutex:
+            index = self.sequence % self.capacity
+            self.times[index] = arrival
+            self.weights[index] = weight
+            self.sequence += 1
+            return self.sequence
+
+    def latest(self):
+        with self.mutex:
+            if self.sequence == 0:
+                return None
+            index = (self.sequence - 1) % self.capacity
+            return (self.times[index], self.weights[index], self.sequence)
+
+    def since(self, sequence):
+        """All samples newer than the given sequence number, oldest first.
+        Samples that were already overwritten are skipped"""
+        with self.mutex:
+            first = max(sequence, self.sequence - self.capacity) + 1
+            samples = []
+            for seq in range(first, self.sequence + 1):
+                index = (seq - 1) % self.capacity
+                samples.append((self.times[index], self.weights[index], seq))
+            return samples
+
+
+# raw notification logs: CAPTURE_MAGIC, then per notification its
+# monotonic arrival time, payload length and the payload itself
+CAPTURE_MAGIC = b'ACAIACAP'
+CAPTURE_RECORD = struct.Struct('<dH')
+
+
+class NotificationCapture(Thread):
+    """Appends every raw notification payload to a binary log, see
+    read_capture() and lib/acaia_replay.py.
+
+    write() only queues the record, the file is written from this thread so
+    a slow SD card never holds up the notification thread"""
+
+    # queued by flush(), the writer flushes the file when it gets there
+    FLUSH = object()
+
+    def __init__(self, path, buffering=65536):
+        Thread.__init__(self, name='notification-capture', daemon=True)
+        self.path = path
+        self.file = open(path, 'ab', buffering=buffering)
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+        self.records = 0
+        self.pending = SimpleQueue()
+        self.closed = False
+
+    def write(self, timestamp, value):
+        if not self.closed:
+            self.pending.put((timestamp, bytes(value)))
+
+    def flush(self):
+        self.pending.put(self.FLUSH)
+
+    def close(self):
+        """Write out everything queued so far and close the file"""
+        self.closed = True
+        self.pending.put(None)
+        if self.is_alive():
+            self.join()
+        else:
+            self.file.close()
+
+    def run(self):
+        try:
+            while True:
+                record = self.pending.get()
+                if record is None:
+                    break
+                if record is self.FLUSH:
+                    self.file.flush()
+                    continue
+                timestamp, value = record
+                self.file.write(CAPTURE_RECORD.pack(timestamp, len(value)))
+                self.file.write(value)
+                self.records += 1
+        except Exception as ex:
+            logging.error('Notification capture to %s failed: %s' % (self.path, str(ex)))
+        finally:
+            self.closed = True
+            self.file.close()
+
+
+def read_capture(path):
+    """Yield the (arrival time, payload) records of a notification log"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(CAPTURE_MAGIC):
+        raise ValueError('%s is not a notification capture' % path)
+    offset = len(CAPTURE_MAGIC)
+    while offset + CAPTURE_RECORD.size <= len(data):
+        timestamp, length = CAPTURE_RECORD.unpack_from(data, offset)
+        offset += CAPTURE_RECORD.size
+        if offset + length > len(data):
+            # log cut short while being written
+            break
+        yield timestamp, data[offset:offset + length]
+        offset += length
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class LinkStats(object):
+    """Health of the link to the scale: when notifications arrived,
+    connects, stalls and how long it took to get weights again after the
+    link was lost.  Times come from time.monotonic()"""
+
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self.arrivals = array('d', bytes(8 * capacity))
+        self.notifications = 0
+        self.connects = 0
+        self.reidents = 0
+        self.stalls = 0
+        self.connected_at = None
+        self.lost_at = None
+        # seconds from losing the link to the first weight after it came back
+        self.recoveries = deque(maxlen=32)
+        self.mutex = Lock()
+
+    def notification(self, arrival):
+        with self.mutex:
+            self.arrivals[self.notifications % self.capacity] = arrival
+            self.notifications += 1
+
+    def connected(self, now):
+        with self.mutex:
+            self.connects += 1
+            self.connected_at = now
+
+    def lost(self, now):
+        with self.mutex:
+            if self.lost_at is None:
+                self.lost_at = now
+
+    def stall(self):
+        with self.mutex:
+            self.stalls += 1
+
+    def weight(self, arrival):
+        if self.lost_at is None:
+            return
+        with self.mutex:
+            if self.lost_at is not None and self.connected_at is not None and self.connected_at > self.lost_at:
+                self.recoveries.append(arrival - self.lost_at)
+                logging.info('Scale link recovered in %.2fs', arrival - self.lost_at)
+                self.lost_at = None
+
+    def recent(self, since):
+        """Arrival times of the kept notifications at or after since, oldest first"""
+        with self.mutex:
+            count = min(self.notifications, self.capacity)
+            first = self.notifications - count
+            times = [self.arrivals[i % self.capacity] for i in range(first, self.notifications)]
+        return [t for t in times if t >= since]
+
+    def rate(self, window, now=None):
+        """Notifications per second over the last window seconds"""
+        if now is None:
+            now = time.monotonic()
+        return len(self.recent(now - window)) / window
+
+    def snapshot(self, window=10.0, now=None):
+        if now is None:
+            now = time.monotonic()
+        times = self.recent(now - window)
+        gaps = sorted(b - a for a, b in zip(times, times[1:]))
+        recoveries = list(self.recoveries)
+        return {
+            'notifications': self.notifications,
+            'rate': len(times) / window,
+            'interval_p50': percentile(gaps, 0.5),
+            'interval_p90': percentile(gaps, 0.9),
+            'interval_p99': percentile(gaps, 0.99),
+            'interval_max': gaps[-1] if gaps else None,
+            'since_last': now - times[-1] if times else None,
+            'reconnects': max(self.connects - 1, 0),
+            'reidents': self.reidents,
+            'stalls': self.stalls,
+            'recovery_last': recoveries[-1] if recoveries else None,
+            'recovery_max': max(recoveries) if recoveries else None,
+        }
 
 
 class Message(object):
+    __slots__ = ('msgType', 'payload', 'value', 'button', 'time')
 
     def __init__(self, msgType, payload):
         self.msgType = msgType
@@ -144,90 +595,30 @@ class Message(object):
         self.button = None
         self.time = None
 
-        if self.msgType == 5:
-            self.value = self._decode_weight(payload)
-
-        elif self.msgType == 11:
-            if payload[2] == 5:
-                self.value = self._decode_weight(payload[3:])
-            elif payload[2] == 7:
-                self.time = self._decode_time(payload[3:])
-            logging.debug('heartbeat response (weight: ' + str(self.value) + ' time: ' + str(self.time))
-
-        elif self.msgType == 7:
-            self.time = self._decode_time(payload)
-            logging.debug('timer: ' + str(self.time))
-
-        elif self.msgType == 8:
-            if payload[0] == 0 and payload[1] == 5:
-                self.button = 'tare'
-                self.value = self._decode_weight(payload[2:])
-                logging.debug('tare (weight: ' + str(self.value) + ')')
-            elif payload[0] == 8 and payload[1] == 5:
-                self.button = 'start'
-                self.value = self._decode_weight(payload[2:])
-                logging.debug('start (weight: ' + str(self.value) + ')')
-            elif payload[0] == 10 and payload[1] == 7:
-                self.button = 'stop'
-                self.time = self._decode_time(payload[2:])
-                self.value = self._decode_weight(payload[6:])
-                logging.debug('stop time: ' + str(self.time) + ' weight: ' + str(self.value))
-            elif payload[0] == 9 and payload[1] == 7:
-                self.button = 'reset'
-                self.time = self._decode_time(payload[2:])
-                self.value = self._decode_weight(payload[6:])
-                logging.debug('reset time: ' + str(self.time) + ' weight: ' + str(self.value))
-            else:
-                self.button = 'unknownbutton'
-                logging.debug('unknownbutton ' + str(payload))
-
+        decoder = EVENTS.get(msgType)
+        if decoder is not None:
+            decoder(self, payload)
+        elif logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('message %d: %s', msgType, bytes(payload))
 
-        else:
-            logging.debug('message ' + str(msgType) + ': %s' % payload)
-
-    def _decode_weight(self, payload: bytes) -> float:
-         import struct
-         unit = payload[4] & 0xFF
-         scales = {1:10.0,2:100.0,3:1000.0,4:10000.0}
-         divisor = scales.get(unit) or (_ for _ in ()).throw(ValueError(f"Bad unit {unit}"))
-         sign = -1 if (payload[5] & 0x02) else 1
- 
-         # Try big‑endian first (if that’s your dominant device)
-         raw = struct.unpack('>I', payload[0:4])[0]
-         w = sign * (raw / divisor)
-         if 0 <= abs(w) <= 2000:
-             return w
- 
-         # Otherwise fall back to little‑endian
-         raw = struct.unpack('<I', payload[0:4])[0]
-         return sign * (raw / divisor)
-
-    def _decode_time(self, time_payload):
-        value = (time_payload[0] & 0xff) * 60
-        value = value + (time_payload[1])
-        value = value + (time_payload[2] / 10.0)
-        return value
 
 class Settings(object):
+    __slots__ = ('battery', 'units', 'auto_off', 'beep_on')
 
     def __init__(self, payload):
         # payload[0] is unknown
         self.battery = payload[1] & 0x7F
-        if payload[2] == 2:
-            self.units = 'grams'
-        elif payload[2] == 5:
-            self.units = 'ounces'
-        else:
-            self.units = None
+        self.units = UNITS.get(payload[2])
         # payload[2 and 3] is unknown
         self.auto_off = payload[4] * 5
         # payload[5] is unknown
         self.beep_on = payload[6] == 1
         # payload[7-9] unknown
-        logging.debug('settings: battery=' + str(self.battery) + ' ' + str(self.units)
-                      + ' auto_off=' + str(self.auto_off) + ' beep=' + str(self.beep_on))
-        logging.debug('unknown settings: ' + str([payload[0], payload[1] & 0x80, payload[3],
-                                                  payload[5], payload[7], payload[8], payload[9]]))
+        logging.debug('settings: battery=%s %s auto_off=%s beep=%s',
+                      self.battery, self.units, self.auto_off, self.beep_on)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('unknown settings: %s', [payload[0], payload[1] & 0x80, payload[3],
+                                                   payload[5], payload[7], payload[8], payload[9]])
 
 
 def encode(msgType, payload):
@@ -283,19 +674,37 @@ def decode(bytes):
         return (None, bytes)
 
     if messageStart > 0:
-        logging.debug("Ignoring " + str(i) + " bytes before header")
+        logging.debug("Ignoring %d bytes before header", messageStart)
 
-    cmd = bytes[messageStart + 2]
+    try:
+        return (decodeFrame(memoryview(bytes)[messageStart:messageEnd]), bytes[messageEnd:])
+    except ChecksumError as ex:
+        logging.debug(str(ex))
+        return (None, bytes[messageEnd:])
+
+
+def checksumValid(frame):
+    """Check the two checksum bytes encode() appends, the sums of the even
+       and odd payload bytes"""
+    payload = frame[3:-2]
+    return (sum(payload[0::2]) & 0xFF) == frame[-2] and (sum(payload[1::2]) & 0xFF) == frame[-1]
+
+
+def decodeFrame(frame):
+    """Turn one complete frame from PacketFramer into a Message,
+       Settings or None for notifications we don't handle.
+       Raises ChecksumError for corrupted frames
+    """
+    if not checksumValid(frame):
+        raise ChecksumError("Bad checksum on frame %s" % bytes(frame).hex())
+    cmd = frame[2]
     if cmd == 12:
-        msgType = bytes[messageStart + 4]
-        payloadIn = bytes[messageStart + 5:messageEnd]
-        return (Message(msgType, payloadIn), bytes[messageEnd:])
+        return Message(frame[4], frame[5:])
     if cmd == 8:
-        return (Settings(bytes[messageStart + 3:]), bytes[messageEnd:])
+        return Settings(frame[3:])
 
-    logging.debug("Non event notification message command " + str(cmd) + ' '
-                  + str(bytes[messageStart:messageEnd]))
-    return (None, bytes[messageEnd:])
+    logging.debug("Non event notification message command %d %s", cmd, bytes(frame))
+    return None
 
 
 def encodeEventData(payload):
@@ -388,48 +797,401 @@ class setInterval(Thread):
                 self.timer.start()
 
 
-class AcaiaScale(object):
+class ScaleProfile(object):
+    """How to reach a scale found before: its address, style,
+    characteristic UUIDs and attribute handles, so connecting again needs
+    neither a scan nor service discovery"""
 
-    def __init__(self, mac, char_uuid=None, backend='bluepy', iface='hci0', weight_uuid=None):
-        """For Pyxis-style devices, the UUIDs can be overridden.  char_uuid
-           is the command UUID, and weight_uuid is where the notify comes
-           from.  Old-style scales only specify char_uuid
-        """
+    FIELDS = ('mac', 'pyxis', 'char_uuid', 'weight_uuid', 'command_handle', 'weight_handle', 'cccd_handle')
+
+    def __init__(self, mac, pyxis, char_uuid, weight_uuid=None, command_handle=None, weight_handle=None,
+                 cccd_handle=None):
+        self.mac = mac
+        self.pyxis = pyxis
+        self.char_uuid = char_uuid
+        self.weight_uuid = weight_uuid
+        self.command_handle = command_handle
+        self.weight_handle = weight_handle
+        self.cccd_handle = cccd_handle
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in ScaleProfile.FIELDS}
+
+    @staticmethod
+    def from_dict(values):
+        return ScaleProfile(**{field: values.get(field) for field in ScaleProfile.FIELDS})
+
+    def __eq__(self, other):
+        return isinstance(other, ScaleProfile) and self.to_dict() == other.to_dict()
 
+    def __repr__(self):
+        return 'ScaleProfile(%s)' % ', '.join('%s=%r' % item for item in self.to_dict().items())
+
+
+class ScaleTransport(abc.ABC):
+    """The link between AcaiaScale and a scale.
+
+    connect() opens the link and subscribes to notifications, which are
+    delivered by calling scale.handleNotification(handle, value).  When
+    pumps_notifications is set, notifications are only delivered from
+    inside wait(), and AcaiaScale runs its heartbeat loop around it and
+    sends commands from that same thread.  Otherwise they arrive on the
+    transport's own thread and heartbeats run every heartbeat_interval
+    seconds.
+    """
+
+    pumps_notifications = True
+    heartbeat_interval = 0
+    # longest wait() between checks for queued commands
+    command_latency = 1
+
+    def find_devices(self, timeout=3):
+        """Addresses of scales that can be passed to connect"""
+        return [address for address, name, rssi in self.scan(timeout)]
+
+    def scan(self, timeout=3):
+        """(address, name, rssi) of the scales in range"""
+        return scan_acaia_devices(timeout=timeout)
+
+    @abc.abstractmethod
+    def connect(self, scale, timeout=10):
+        """Connect to scale.mac, giving up after timeout seconds.  Should
+        leave a ScaleProfile in scale.profile, and make use of one already
+        there for the same address"""
+
+    @abc.abstractmethod
+    def write(self, packet, withResponse=False):
+        pass
+
+    @abc.abstractmethod
+    def wait(self, timeout):
+        """Deliver notifications for up to timeout seconds, returns True if
+        one was delivered"""
+
+    def wake(self):
+        """Make a wait() in progress return early, if the transport can"""
+        pass
+
+    @abc.abstractmethod
+    def disconnect(self):
+        pass
+
+
+class BluepyTransport(ScaleTransport):
+
+    # waitForNotifications can't be interrupted, so wait in short slices
+    # to pick up commands quickly
+    command_latency = 0.05
+
+    def __init__(self):
+        try:
+            from bluepy import btle
+        except:
+            raise Exception('bluepy is not installed')
+        self.btle = btle
+        self.device = None
+        self.char = None
         self.notifyDescriptors = None
-        if backend == 'pygatt':
+        self.command_handle = None
+
+    def connect(self, scale, timeout=10):
+        self.device = None
+        start_connection_time = time.time()
+        while not self.device:
             try:
-                from pygatt import GATTToolBackend
-            except:
-                raise Exception('pygatt is not installed')
-            self.backend_class = GATTToolBackend
+                self.device = self.btle.Peripheral(scale.mac, addrType=self.btle.ADDR_TYPE_PUBLIC)
+                # MTU of 247 required by Pyxis for long notification payloads,
+                # not sure if it is needed for older scales
+                self.device.setMTU(247)
+            except Exception as e:
+                self.device = None
+                logging.debug("Failed connection attempt " + str(e))
+                # GIve up after 10 seconds, probably the scale is not on
+                if time.time() - start_connection_time > timeout:
+                    raise e
+        self.device = self.device.withDelegate(scale)
+
+        profile = scale.profile
+        if profile is not None and profile.mac == scale.mac and profile.command_handle:
+            try:
+                self.__restore(scale, profile)
+                return
+            except Exception as e:
+                logging.info("Cached scale profile didn't work, discovering: " + str(e))
+        self.__discover(scale)
 
-        elif backend == 'bluepy':
+    def __restore(self, scale, profile):
+        # skip GATT discovery, write the handles found last time directly
+        self.char = None
+        self.command_handle = profile.command_handle
+        scale.isPyxisStyle = profile.pyxis
+        scale.char_uuid = profile.char_uuid
+        scale.weight_uuid = profile.weight_uuid
+        self.device.writeCharacteristic(profile.cccd_handle, bytearray([0x01, 0x00]), profile.pyxis)
+        # old-style scales take the write without a response, so a stale handle only shows up as weights
+        # never arriving. Read the descriptor back to check it really is the subscription we just turned on
+        value = self.device.readCharacteristic(profile.cccd_handle)
+        if bytes(value) != b'\x01\x00':
+            raise Exception("cached handle %s is not the weight subscription" % profile.cccd_handle)
+        logging.debug("Subscribed with cached handles %s/%s", profile.command_handle, profile.cccd_handle)
+
+    def __discover(self, scale):
+        foundCommandChar = False
+        foundWeightChar = False
+        pyxisWeightChar = None
+
+        if scale.char_uuid:
+            self.char = self.device.getCharacteristics(uuid=scale.char_uuid)[0]
+            foundCommandChar = True
+            scale.isPyxisStyle = False
+            if scale.weight_uuid:
+                pyxisWeightChar = self.device.getCharacteristics(uuid=scale.weight_uuid)[0]
+                scale.isPyxisStyle = True
+            logging.debug("Overriding characteristic UUIDs from constructor")
+            foundWeightChar = True
+        else:
+            UUID = self.btle.UUID
+            # Get all the characteristics to decide if we
+            # are connecting to an older scale or or a new Pyxis
+            characteristics = self.device.getCharacteristics()
+            pyxisWeightChar = None
+            for char in characteristics:
+                if char.uuid == UUID('49535343-8841-43f4-a8d4-ecbe34729bb3') or char.uuid == UUID('0000fe41-8e22-4541-9d4c-21edae82ed19'):
+                    logging.debug("Has Pyxis-style command char")
+                    self.char = char
+                    scale.char_uuid = str(self.char.uuid)
+                    scale.isPyxisStyle = True
+                    foundCommandChar = True
+                elif char.uuid == UUID('49535343-1e4d-4bd9-ba61-23c647249616') or char.uuid == UUID('0000fe42-8e22-4541-9d4c-21edae82ed19'):
+                    logging.debug("Has Pyxis-style weight char")
+                    pyxisWeightChar = char
+                    scale.weight_uuid = str(pyxisWeightChar.uuid)
+                    foundWeightChar = True
+                elif char.uuid == UUID('00002a80-0000-1000-8000-00805f9b34fb'):
+                    logging.debug("Has old-style char")
+                    self.char = char
+                    scale.char_uuid = str(self.char.uuid)
+                    # command and weight in the same characteristic
+                    scale.isPyxisStyle = False
+                    foundCommandChar = True
+                    foundWeightChar = True
+
+        if not foundCommandChar:
+            raise Exception("Could not find command characteristic")
+
+        # Subscribe to notifications
+        cccd_handle = None
+        if scale.isPyxisStyle:
+            self.notifyDescriptors = pyxisWeightChar.getDescriptors(forUUID='2902',
+                                                                    hndEnd=pyxisWeightChar.valHandle + 3)
+            if self.notifyDescriptors:
+                cccd_handle = self.notifyDescriptors[0].handle
+                self.device.writeCharacteristic(cccd_handle, bytearray([0x01, 0x00]), True)
+                foundWeightChar = True
+            weight_handle = pyxisWeightChar.valHandle
+        else:
+            # Old-style scale: Hardcoded write to client config descriptor
+            # which uses the same characteristic as the command
+            # characteristic.  Instead of hardcoding,
+            # this could probably be done like the Pyxis style
+            cccd_handle = 14
+            self.device.writeCharacteristic(cccd_handle, bytearray([0x01, 0x00]))
+            foundWeightChar = True
+            weight_handle = self.char.valHandle
+
+        if not foundWeightChar:
+            raise Exception("Could not find weight characteristic");
+
+        self.command_handle = self.char.valHandle
+        if cccd_handle is not None:
+            scale.profile = ScaleProfile(scale.mac, bool(scale.isPyxisStyle), scale.char_uuid, scale.weight_uuid,
+                                         self.command_handle, weight_handle, cccd_handle)
+
+    def write(self, packet, withResponse=False):
+        # what Characteristic.write() does, without needing the discovered characteristic
+        self.device.writeCharacteristic(self.command_handle, packet, withResponse)
+
+    def wait(self, timeout):
+        # for bluepy, instead of waking up for a heartbeat, we
+        # do a waitForNotifications so that notifications from heartbeat
+        # and notifications from waitForNotifications happen in the same
+        # thread.
+        return self.device.waitForNotifications(timeout)
+
+    def disconnect(self):
+        if self.device:
+            self.device.disconnect()
+
+
+class PygattTransport(ScaleTransport):
+
+    pumps_notifications = False
+    heartbeat_interval = 5
+
+    def __init__(self, iface='hci0'):
+        try:
+            from pygatt import GATTToolBackend
+        except:
+            raise Exception('pygatt is not installed')
+        self.backend_class = GATTToolBackend
+        self.iface = iface
+        self.adapter = None
+        self.device = None
+        self.handle = None
+
+    def scan(self, timeout=3):
+        return scan_acaia_devices(timeout=timeout, backend='pygatt')
+
+    def connect(self, scale, timeout=10):
+        # Only old-style supported with pygatt now
+        if not scale.char_uuid:
+            scale.char_uuid = '00002a80-0000-1000-8000-00805f9b34fb'
+        self.adapter = self.backend_class(self.iface)
+        self.adapter.reset()
+        self.adapter.start(False)
+        self.device = self.adapter.connect(scale.mac)
+        self.device.subscribe(scale.char_uuid, scale.characteristicValueChanged)
+        self.handle = self.device.get_handle(scale.char_uuid)
+        scale.profile = ScaleProfile(scale.mac, False, scale.char_uuid, command_handle=self.handle,
+                                     weight_handle=self.handle)
+
+    def write(self, packet, withResponse=False):
+        self.device.char_write_handle(self.handle, packet, wait_for_response=withResponse)
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def disconnect(self):
+        if self.device:
+            self.device.disconnect()
+            self.adapter.stop()
+
+
+class LinkWatchdog(Thread):
+    """Forces a reconnect when the scale's notification rate falls below
+    min_rate while active() says it matters, e.g. during a shot.
+
+    The reconnect runs on its own thread, a single bluepy connect attempt
+    blocks for as long as the BLE stack takes.  If weights aren't coming in
+    again recovery_timeout seconds after the stall and active() still holds,
+    give_up() is called, to stop the shot instead of pouring blind.  The
+    reconnect carries on regardless, if it fails the regular connect logic
+    takes over"""
+
+    def __init__(self, scale, active, min_rate=3.0, window=1.0, recovery_timeout=5.0, interval=0.1,
+                 give_up=None):
+        Thread.__init__(self, name='scale-watchdog', daemon=True)
+        self.scale = scale
+        self.active = active
+        self.min_rate = min_rate
+        self.window = window
+        self.recovery_timeout = recovery_timeout
+        self.interval = interval
+        self.give_up = give_up
+        self.gave_up = 0
+        self.reconnector = None
+        self.stopped = Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def check(self, now=None):
+        """Returns True if the link is stalled"""
+        if now is None:
+            now = time.monotonic()
+        link = self.scale.link
+        if not self.scale.connected or not self.active():
+            return False
+        if link.connected_at is None or now - link.connected_at < self.window:
+            # give a fresh connection time to get going
+            return False
+        return link.rate(self.window, now) < self.min_rate
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.reconnector is not None and self.reconnector.is_alive():
+                continue
+            if not self.check():
+                continue
+            self.scale.link.stall()
+            logging.error('Scale link stalled at %.1f notifications/s, reconnecting',
+                          self.scale.link.rate(self.window))
+            self.__recover(time.monotonic())
+
+    def __recover(self, now):
+        deadline = now + self.recovery_timeout
+        # counted as lost from here, not from whenever the reconnect gets going
+        self.scale.link.lost(now)
+        self.reconnector = Thread(target=self.__reconnect, name='scale-reconnect', daemon=True)
+        self.reconnector.start()
+        while self.scale.link.lost_at is not None:
+            if time.monotonic() >= deadline:
+                self.__give_up()
+                return
+            if self.stopped.wait(self.interval):
+                return
+
+    def __give_up(self):
+        if not self.active():
+            return
+        self.gave_up += 1
+        logging.error('Scale link not back after %.1fs, giving up on this shot', self.recovery_timeout)
+        if self.give_up is not None:
             try:
-                from bluepy import btle
-            except:
-                raise Exception('bluepy is not installed')
-            self.backend_class = btle
+                self.give_up()
+            except Exception as e:
+                logging.error('Giving up on stalled scale failed: ' + str(e))
+
+    def __reconnect(self):
+        try:
+            self.scale.reconnect(self.recovery_timeout)
+        except Exception as e:
+            logging.error('Reconnecting stalled scale failed: ' + str(e))
 
+
+class AcaiaScale(object):
+
+    def __init__(self, mac, char_uuid=None, backend='bluepy', iface='hci0', weight_uuid=None, transport=None):
+        """For Pyxis-style devices, the UUIDs can be overridden.  char_uuid
+           is the command UUID, and weight_uuid is where the notify comes
+           from.  Old-style scales only specify char_uuid.
+           transport replaces the bluetooth backend, see ScaleTransport
+        """
+
+        if transport is not None:
+            self.transport = transport
+        elif backend == 'pygatt':
+            self.transport = PygattTransport(iface)
+        elif backend == 'bluepy':
+            self.transport = BluepyTransport()
         else:
             raise Exception('Backend not supported')
 
         self.backend = backend
         self.iface = iface
         self.mac = mac
-        self.adapter = None
-        self.device = None
         self.connected = False
 
         self.char_uuid = char_uuid
         self.weight_uuid = weight_uuid
         self.isPyxisStyle = (char_uuid and weight_uuid)
-        self.char = None
-        self.handle = None
-
+        # ScaleProfile of the last scale connected to
+        self.profile = None
         self.queue = None
-        self.command_queue = CommandQueue()
-        self.packet = None
+        self.command_queue = CommandQueue(self.transport.wake)
+        # written commands waiting for the scale to acknowledge them
+        self.awaiting_ack = []
+        self.ack_mutex = Lock()
+        self.framer = PacketFramer()
+        # frames dropped because their checksum didn't match
+        self.checksum_errors = 0
+        # frames with a good checksum the decoder still couldn't make sense of
+        self.decode_errors = 0
+        self.link = LinkStats()
+        self.connect_mutex = RLock()
+        # set while reconnect() is replacing the link
+        self.reconnecting = False
         self.set_interval_thread = None
         self.last_heartbeat = 0
         self.timer_start_time = 0
@@ -440,6 +1202,16 @@ class AcaiaScale(object):
 
         # weight in the units given
         self.weight = None
+        # every weight notification with its arrival time
+        self.weight_samples = WeightSamples()
+        # monotonic arrival time of the notification being decoded
+        self.notification_time = 0.0
+        # when the newest weight finished decoding, for weight listeners measuring latency
+        self.decode_time = 0.0
+        # called with (weight, arrival time, sequence number) for each weight notification
+        self.weight_listeners = []
+        # NotificationCapture recording raw notifications, if any
+        self.capture = None
         # battery level in percent
         self.battery = None
         # Units is 'grams' or 'ounces'
@@ -459,31 +1231,50 @@ class AcaiaScale(object):
         else:
             return self.paused_time
 
-    def addBuffer(self, buffer2):
-
-        packet_len = 0
-
-        if self.packet:
-            packet_len = len(self.packet)
-
-        result = bytearray(packet_len + len(buffer2))
+    def add_weight_listener(self, callback):
+        """Call callback(weight, arrival, sequence) synchronously from the
+        notification thread for every decoded weight.  Keep it short, the
+        next notification isn't read until it returns"""
+        self.weight_listeners.append(callback)
 
-        for i in range(packet_len):
-            result[i] = self.packet[i]
-
-        for i in range(len(buffer2)):
-            result[i + packet_len] = buffer2[i]
+    def notify_weight_listeners(self, weight, arrival, sequence):
+        for listener in self.weight_listeners:
+            try:
+                listener(weight, arrival, sequence)
+            except Exception as ex:
+                logging.error('Weight listener failed: %s' % str(ex))
+
+    def start_capture(self, path):
+        """Record raw notifications to path until stop_capture()"""
+        self.capture = NotificationCapture(path)
+        self.capture.start()
+        logging.info('Capturing scale notifications to %s' % path)
+
+    def stop_capture(self):
+        capture = self.capture
+        self.capture = None
+        if capture is not None:
+            capture.close()
 
-        self.packet = result
+    def addBuffer(self, buffer2):
+        self.framer.feed(buffer2)
 
     def characteristicValueChanged(self, handle, value):
         # print handle,value
+        self.notification_time = time.monotonic()
+        self.link.notification(self.notification_time)
+        if self.capture is not None:
+            self.capture.write(self.notification_time, value)
         self.queue.add(value)
 
     def handleDiscovery(self, scanEntry, isNewDev, isNewData):
         pass  # DBG("Discovered device", scanEntry.addr)
 
     def handleNotification(self, handle, value):
+        self.notification_time = time.monotonic()
+        self.link.notification(self.notification_time)
+        if self.capture is not None:
+            self.capture.write(self.notification_time, value)
         self.queue.add(value)
 
     def callback_queue(self, payload):
@@ -491,9 +1282,22 @@ class AcaiaScale(object):
         self.addBuffer(payload)
 
         while True:
-            (msg, self.packet) = decode(self.packet)
-            if not msg:
+            frame = self.framer.next()
+            if frame is None:
                 return
+            try:
+                msg = decodeFrame(frame)
+            except ChecksumError as ex:
+                self.checksum_errors += 1
+                logging.debug(str(ex))
+                self.framer.reject()
+                continue
+            except (ValueError, IndexError, struct.error) as ex:
+                # the checksum matched but the message doesn't make sense, e.g. an unknown weight unit
+                self.decode_errors += 1
+                logging.debug('Undecodable frame %s: %s' % (bytes(frame).hex(), str(ex)))
+                self.framer.reject()
+                continue
             if isinstance(msg, Settings):
                 self.battery = msg.battery
                 self.units = msg.units
@@ -501,12 +1305,18 @@ class AcaiaScale(object):
                 self.beep_on = msg.beep_on
             elif isinstance(msg, Message):
                 if msg.msgType == 5:
+                    self.decode_time = time.monotonic()
                     self.weight = msg.value
-                    logging.debug('weight: ' + str(msg.value) + ' ' + str(time.time()))
+                    sequence = self.weight_samples.add(self.notification_time, msg.value)
                     self.receiving_notifications = True
+                    self.link.weight(self.notification_time)
+                    self.notify_weight_listeners(msg.value, self.notification_time, sequence)
+                    logging.debug('weight: %s %s', msg.value, self.notification_time)
                 elif msg.msgType == 7:
                     self.timer_start_time = time.time() - msg.time
                     self.timer_running = True
+                elif msg.msgType == 8 and msg.button == 'tare':
+                    self.acknowledge('tare', msg.value)
                 elif msg.msgType == 8 and msg.button == 'start':
                     self.timer_start_time = time.time() - self.paused_time + self.transit_delay
                     self.timer_running = True
@@ -517,7 +1327,11 @@ class AcaiaScale(object):
                     self.paused_time = 0
                     self.timer_running = False
 
-    def connect(self):
+    def connect(self, timeout=10):
+        with self.connect_mutex:
+            self.__connect(timeout)
+
+    def __connect(self, timeout):
 
         if self.connected:
             return
@@ -525,95 +1339,9 @@ class AcaiaScale(object):
         self.receiving_notifications = False
 
         self.queue = Queue(self.callback_queue)
+        self.framer.reset()
 
-        if self.backend == 'bluepy':
-            start_connection_time = time.time()
-            while not self.device:
-                try:
-                    self.device = self.backend_class.Peripheral(self.mac, addrType=self.backend_class.ADDR_TYPE_PUBLIC)
-                    # MTU of 247 required by Pyxis for long notification payloads,
-                    # not sure if it is needed for older scales
-                    self.device.setMTU(247)
-                except Exception as e:
-                    self.device = None
-                    logging.debug("Failed connection attempt " + str(e))
-                    # GIve up after 10 seconds, probably the scale is not on
-                    if time.time() - start_connection_time > 10:
-                        raise e
-            self.device = self.device.withDelegate(self)
-            foundCommandChar = False
-            foundWeightChar = False
-            pyxisWeightChar = None
-
-            if self.char_uuid:
-                self.char = self.device.getCharacteristics(uuid=self.char_uuid)[0]
-                foundCommandChar = True
-                self.isPyxisStyle = False
-                if self.weight_uuid:
-                    pyxisWeightChar = self.device.getCharacteristics(uuid=self.weight_uuid)[0]
-                    self.isPyxisStyle = True
-                logging.debug("Overriding characteristic UUIDs from constructor")
-                foundWeightChar = True
-            else:
-                from bluepy.btle import UUID
-                # Get all the characteristics to decide if we
-                # are connecting to an older scale or or a new Pyxis
-                characteristics = self.device.getCharacteristics()
-                pyxisWeightChar = None
-                for char in characteristics:
-                    if char.uuid == UUID('49535343-8841-43f4-a8d4-ecbe34729bb3') or char.uuid == UUID('0000fe41-8e22-4541-9d4c-21edae82ed19'):
-                        logging.debug("Has Pyxis-style command char")
-                        self.char = char
-                        self.char_uuid = str(self.char.uuid)
-                        self.isPyxisStyle = True
-                        foundCommandChar = True
-                    elif char.uuid == UUID('49535343-1e4d-4bd9-ba61-23c647249616') or char.uuid == UUID('0000fe42-8e22-4541-9d4c-21edae82ed19'):
-                        logging.debug("Has Pyxis-style weight char")
-                        pyxisWeightChar = char
-                        self.weight_uuid = str(pyxisWeightChar.uuid)
-                        foundWeightChar = True
-                    elif char.uuid == UUID('00002a80-0000-1000-8000-00805f9b34fb'):
-                        logging.debug("Has old-style char")
-                        self.char = char
-                        self.char_uuid = str(self.char.uuid)
-                        # command and weight in the same characteristic
-                        self.isPyxisStyle = False
-                        foundCommandChar = True
-                        foundWeightChar = True
-
-            if not foundCommandChar:
-                raise Exception("Could not find command characteristic")
-
-            # Subscribe to notifications
-            if self.isPyxisStyle:
-                self.notifyDescriptors = pyxisWeightChar.getDescriptors(forUUID='2902',
-                                                                   hndEnd=pyxisWeightChar.valHandle + 3)
-                if self.notifyDescriptors:
-                    self.device.writeCharacteristic(
-                        self.notifyDescriptors[0].handle,
-                        bytearray([0x01, 0x00]), True)
-                    foundWeightChar = True
-            else:
-                # Old-style scale: Hardcoded write to client config descriptor
-                # which uses the same characteristic as the command
-                # characteristic.  Instead of hardcoding,
-                # this could probably be done like the Pyxis style
-                self.device.writeCharacteristic(14, bytearray([0x01, 0x00]))
-                foundWeightChar = True
-
-            if not foundWeightChar:
-                raise Exception("Could not find weight characteristic");
-
-        elif self.backend == 'pygatt':
-            # Only old-style supported with pygatt now
-            if not self.char_uuid:
-                self.char_uuid = '00002a80-0000-1000-8000-00805f9b34fb'
-            self.adapter = self.backend_class(self.iface)
-            self.adapter.reset()
-            self.adapter.start(False)
-            self.device = self.adapter.connect(self.mac)
-            self.device.subscribe(self.char_uuid, self.characteristicValueChanged)
-            self.handle = self.device.get_handle(self.char_uuid)
+        self.transport.connect(self, timeout)
 
         self.notificationsReady()
         time.sleep(0.5)
@@ -628,6 +1356,7 @@ class AcaiaScale(object):
         if addresses:
             device_address = addresses[0]
             logging.info('Connecting to:%s' % device_address)
+            self.mac = device_address
             self.connect()
         else:
             logging.info('No ACAIA scale found')
@@ -637,22 +1366,15 @@ class AcaiaScale(object):
         self.last_heartbeat = time.time()
         logging.info('Scale Ready!')
         self.connected = True
-        if self.backend == 'bluepy':
-            # For bluepy, use waitForNotifications() instead of Timer,
-            # see notes in heartbeat()
-            self.set_interval_thread = setInterval(self.heartbeat, 0)
-        elif self.backend == 'pygatt':
-            self.set_interval_thread = setInterval(self.heartbeat, 5)
+        self.link.connected(time.monotonic())
+        # Transports that pump their own notifications use wait() instead
+        # of Timer, see notes in heartbeat()
+        self.set_interval_thread = setInterval(self.heartbeat, self.transport.heartbeat_interval)
         self.set_interval_thread.start()
 
     def ident(self):
-        if self.backend == 'bluepy':
-            self.char.write(encodeId(self.isPyxisStyle), withResponse=False)
-            self.char.write(encodeNotificationRequest(), withResponse=False)
-        elif self.backend == 'pygatt':
-            self.device.char_write(self.char_uuid, encodeId(self.isPyxisStyle), wait_for_response=False)
-            self.device.char_write(self.char_uuid, encodeNotificationRequest(), wait_for_response=False)
-
+        self.transport.write(encodeId(self.isPyxisStyle), withResponse=False)
+        self.transport.write(encodeNotificationRequest(), withResponse=False)
         return True
 
     def heartbeat(self):
@@ -661,18 +1383,18 @@ class AcaiaScale(object):
             return False
 
         try:
-            if self.backend == 'bluepy':
-                # for bluepy, instead of waking up for a heartbeat, we
-                # do a waitForNotifications so that notifications from heartbeat
-                # and notifications from waitForNotifications happen in the same
+            if self.transport.pumps_notifications:
+                # instead of waking up for a heartbeat, we wait for
+                # notifications so that notifications from heartbeat
+                # and notifications from wait() happen in the same
                 # thread.  setInterval object calls heartbeat() without any
                 # timer delay
-                self.device.waitForNotifications(1)
+                self.transport.wait(self.transport.command_latency)
                 while True:
                     # Send queued up commands in this heartbeat thread
-                    packet = self.command_queue.dequeue()
-                    if packet:
-                        self.char.write(packet, withResponse=False)
+                    command = self.command_queue.dequeue()
+                    if command:
+                        self.write_command(command)
                     else:
                         break
                 if time.time() >= self.last_heartbeat + 2:
@@ -684,82 +1406,133 @@ class AcaiaScale(object):
                     # once every 5 seconds as in the earlier scales.
                     self.last_heartbeat = time.time()
                     if self.isPyxisStyle:
-                        self.char.write(encodeId(self.isPyxisStyle))
-                    self.char.write(encodeHeartbeat(), withResponse=False)
+                        self.transport.write(encodeId(self.isPyxisStyle))
+                    self.transport.write(encodeHeartbeat(), withResponse=False)
                     # We get settings with the encodeId(), so commenting ths out for now
                     # if self.isPyxisStyle:
-                    #    self.char.write(encodeGetSettings(), withResponse=False)
+                    #    self.transport.write(encodeGetSettings(), withResponse=False)
                     logging.debug('Heartbeat success')
                     if not self.receiving_notifications:
                         logging.error("We aren't receiving notifications, reidentify")
+                        self.link.reidents += 1
                         self.ident()
 
-            elif self.backend == 'pygatt':
-                self.device.char_write_handle(self.handle, encodeHeartbeat(), wait_for_response=False)
+            else:
+                self.transport.write(encodeHeartbeat(), withResponse=False)
                 logging.debug('Heartbeat success')
 
             return True
         except Exception as e:
             logging.debug('Heartbeat failed ' + str(e))
+            self.link.lost(time.monotonic())
             try:
                 self.disconnect()
             except:
                 return False
 
+    def send_command(self, packet, urgent=False, ack=None):
+        """Returns a Future resolving once the packet is written or, if ack
+        names a button message, with the weight the scale acknowledges it
+        with.  Urgent commands are written ahead of queued ones"""
+        command = Command(packet, ack)
+        if self.transport.pumps_notifications:
+            # written from the heartbeat thread, see heartbeat()
+            return self.command_queue.add(command, urgent)
+        self.write_command(command)
+        return command.future
+
+    def write_command(self, command):
+        if command.ack is not None:
+            # before writing, the acknowledgement can beat write() returning
+            with self.ack_mutex:
+                self.awaiting_ack.append(command)
+        try:
+            self.transport.write(command.packet, withResponse=False)
+        except Exception as ex:
+            with self.ack_mutex:
+                if command in self.awaiting_ack:
+                    self.awaiting_ack.remove(command)
+            _fail(command.future, ex)
+            raise
+        if command.ack is None:
+            _resolve(command.future, None)
+
+    def acknowledge(self, button, value):
+        with self.ack_mutex:
+            acknowledged = [c for c in self.awaiting_ack if c.ack == button]
+            self.awaiting_ack = [c for c in self.awaiting_ack if c.ack != button]
+        for command in acknowledged:
+            _resolve(command.future, value)
+
     def tare(self):
         if not self.connected:
             return False
-        if self.backend == 'bluepy':
-            self.command_queue.add(encodeTare())
-        elif self.backend == 'pygatt':
-            self.device.char_write(self.char_uuid, encodeTare(), wait_for_response=False)
-
-        return True
+        return self.send_command(encodeTare(), urgent=True, ack='tare')
 
     def startTimer(self):
         if not self.connected:
             return False
-        if self.backend == 'bluepy':
-            self.command_queue.add(encodeStartTimer())
-        elif self.backend == 'pygatt':
-            self.device.char_write(self.char_uuid, encodeStartTimer(), wait_for_response=False)
+        future = self.send_command(encodeStartTimer())
         self.timer_start_time = time.time()
         self.timer_running = True
+        return future
 
     def stopTimer(self):
         if not self.connected:
             return False
-        if self.backend == 'bluepy':
-            self.command_queue.add(encodeStopTimer())
-        elif self.backend == 'pygatt':
-            self.device.char_write(self.char_uuid, encodeStopTimer(), wait_for_response=False)
-
+        future = self.send_command(encodeStopTimer(), urgent=True)
         self.paused_time = time.time() - self.timer_start_time
         self.timer_running = False
+        return future
 
     def resetTimer(self):
         if not self.connected:
             return False
-        if self.backend == 'bluepy':
-            self.command_queue.add(encodeResetTimer())
-        elif self.backend == 'pygatt':
-            self.device.char_write(self.char_uuid, encodeResetTimer(), wait_for_response=False)
+        future = self.send_command(encodeResetTimer())
         self.paused_time = 0
         self.timer_running = False
+        return future
+
+    def link_stats(self):
+        """LinkStats.snapshot() plus what the decoder threw away"""
+        stats = self.link.snapshot()
+        stats['checksum_errors'] = self.checksum_errors
+        stats['decode_errors'] = self.decode_errors
+        stats['discarded_bytes'] = self.framer.discarded
+        stats['connected'] = self.connected
+        return stats
+
+    def reconnect(self, timeout=5):
+        """Drop the link and connect to the same scale again, counting it
+        as lost until weights arrive again"""
+        self.link.lost(time.monotonic())
+        with self.connect_mutex:
+            self.reconnecting = True
+            try:
+                if self.connected:
+                    try:
+                        self.disconnect()
+                    except Exception as e:
+                        logging.debug('Disconnect before reconnect failed ' + str(e))
+                self.connect(timeout)
+            finally:
+                self.reconnecting = False
 
     def disconnect(self):
         self.connected = False
-        if self.device:
-
-            if self.backend == 'pygatt':
-                self.device.disconnect()
-                self.adapter.stop()
-
-            elif self.backend == 'bluepy':
-                self.device.disconnect()
+        if self.capture is not None:
+            self.capture.flush()
+        self.transport.disconnect()
         self.set_interval_thread.stop()
-        self.set_interval_thread.join()
-
+        if self.set_interval_thread is not current_thread():
+            self.set_interval_thread.join()
+        ex = ConnectionError('scale disconnected')
+        self.command_queue.fail(ex)
+        with self.ack_mutex:
+            awaiting = self.awaiting_ack
+            self.awaiting_ack = []
+        for command in awaiting:
+            _fail(command.future, ex)
 
 def main():
     addresses = find_acaia_devices()
@@ -0,0 +1,17 @@
+# conftest.py
+import time
+
+import pytest
+
+
+def poll(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def wait_for():
+    """Polls condition() until it holds, failing the test after timeout seconds"""
+    return poll
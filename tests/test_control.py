@@ -0,0 +1,262 @@
+# test_control.py
+import json
+import random
+import time
+from collections import deque
+
+from lib.acaia_sim import SIMULATED_MAC, SimulatedTransport
+from lib.control import KalmanEstimate, MemoryStore, MovingAverage, ScaleProfileCache, ScaleScanner, TargetMemory, \
+    parse_mac_allowlist, try_connect_scale
+from lib.pyacaia import AcaiaScale, ScaleProfile
+from lib.display import DisplayData
+
+
+def test_moving_average_matches_window_mean():
+    window = 8
+    samples = [random.uniform(0.0, 6.0) for _ in range(0, 300)]
+    avg = MovingAverage(window)
+    for i, sample in enumerate(samples):
+        value = avg.add(sample)
+        if i < window - 1:
+            assert value is None
+        else:
+            assert abs(value - sum(samples[i - window + 1:i + 1]) / window) < 1e-9
+
+
+def test_display_data_smooths_raw_flow():
+    flow_data = [float(i) for i in range(0, 20)]
+    data = DisplayData(1.0, 0.1, TargetMemory("A"), flow_data, 50, False, 0.0, flow_smooth_factor=4)
+    assert data.flow_rate_moving_avg() == [1.5 + i for i in range(0, 17)]
+
+
+class ConnectSwitch:
+    def __init__(self, on: bool = True):
+        self.on = on
+
+    def should_scale_connect(self) -> bool:
+        return self.on
+
+
+def test_scale_profile_cache_round_trip(tmp_path):
+    path = str(tmp_path / "scale.json")
+    assert ScaleProfileCache(path).profile is None
+    profile = ScaleProfile("AA:BB", True, "cmd-uuid", "weight-uuid", 10, 12, 13)
+    ScaleProfileCache(path).save(profile)
+    assert ScaleProfileCache(path).profile == profile
+
+    with open(path, "w") as f:
+        f.write("{not json")
+    assert ScaleProfileCache(path).profile is None
+
+
+def memories() -> deque:
+    return deque([TargetMemory("A"), TargetMemory("B", "#25a602"), TargetMemory("C", "#376efa")])
+
+
+def test_memory_store_round_trip(tmp_path):
+    path = str(tmp_path / "memories.json")
+    saved = memories()
+    store = MemoryStore(path, saved, interval=60)
+    assert not store.load()
+    saved[0].target = 36.5
+    saved[0].update_overshoot(38.0)
+    saved[1].color = "#000000"
+    saved.rotate(-1)
+    store.flush()
+    assert store.writes == 1
+
+    restored = memories()
+    assert MemoryStore(path, restored).load()
+    assert [memory.name for memory in restored] == ["B", "C", "A"]
+    assert restored[0].color == "#000000"
+    assert restored[2].target == 36.5
+    assert restored[2].overshoot == saved[2].overshoot != 2.0
+    assert restored[2].overshoot_estimate.variance == saved[2].overshoot_estimate.variance
+
+    with open(path, "w") as f:
+        f.write("{not json")
+    assert not MemoryStore(path, memories()).load()
+
+
+def test_memory_store_coalesces_writes(tmp_path):
+    path = str(tmp_path / "memories.json")
+    saved = memories()
+    store = MemoryStore(path, saved, interval=60)
+    # a held target button, one step per repeat tick, between two flushes of the store thread
+    for _ in range(20):
+        saved[0].target += 1
+    store.flush()
+    assert store.writes == 1
+    # nothing changed since, nothing gets written
+    store.flush()
+    assert store.writes == 1
+    saved[0].target -= 0.5
+    store.stop()
+    assert store.writes == 2
+    restored = memories()
+    MemoryStore(path, restored).load()
+    assert restored[0].target == saved[0].target
+
+
+def test_memory_store_skips_broken_entries(tmp_path):
+    path = str(tmp_path / "memories.json")
+    saved = memories()
+    saved[1].target = 20.0
+    saved[2].target = 30.0
+    MemoryStore(path, saved).flush()
+    with open(path) as f:
+        states = json.load(f)['memories']
+    states[1]['overshoot_estimate'] = "garbage"
+    states[2]['overshoot_estimate']['variance'] = float('nan')
+    with open(path, "w") as f:
+        json.dump({'memories': ["garbage", 42] + states}, f)
+
+    restored = memories()
+    assert MemoryStore(path, restored).load()
+    assert [memory.name for memory in restored] == ["A", "B", "C"]
+    assert restored[2].target == 30.0
+    # a NaN variance would turn every later overshoot update into NaN
+    assert restored[2].overshoot_estimate.variance == 4.0
+
+
+def test_reconnect_skips_scan_with_cached_profile(tmp_path):
+    path = str(tmp_path / "scale.json")
+    transport = SimulatedTransport(speed=50.0)
+    scans = []
+    find_devices = transport.find_devices
+    transport.find_devices = lambda timeout: scans.append(timeout) or find_devices(timeout)
+    scale = AcaiaScale(mac='', transport=transport)
+    switch = ConnectSwitch()
+
+    # nothing allowed, nothing connected
+    assert not try_connect_scale(scale, switch, ScaleProfileCache(path), parse_mac_allowlist("11:22:33:44:55:66"))
+    assert len(scans) == 1
+
+    assert try_connect_scale(scale, switch, ScaleProfileCache(path), parse_mac_allowlist(SIMULATED_MAC.upper()))
+    assert len(scans) == 2
+    scale.disconnect()
+
+    # after a restart the cached profile gets us connected without scanning
+    scale = AcaiaScale(mac='', transport=transport)
+    profiles = ScaleProfileCache(path)
+    assert profiles.profile.mac == SIMULATED_MAC
+    assert try_connect_scale(scale, switch, profiles)
+    assert len(scans) == 2
+    scale.disconnect()
+
+    # with the scale off the direct attempt fails, we scan instead and hold off on direct attempts
+    transport.available = False
+    connects = transport.connects
+    assert not try_connect_scale(scale, switch, profiles)
+    assert not try_connect_scale(scale, switch, profiles)
+    assert transport.connects == connects + 1
+    assert len(scans) == 4
+
+
+def test_direct_connect_waits_for_the_scanner_to_see_the_scale(tmp_path, wait_for):
+    path = str(tmp_path / "scale.json")
+    ScaleProfileCache(path).save(ScaleProfile(SIMULATED_MAC, False, "cmd-uuid", command_handle=10, cccd_handle=14))
+    profiles = ScaleProfileCache(path)
+    transport = SimulatedTransport(speed=50.0)
+    transport.available = False
+    scale = AcaiaScale(mac='', transport=transport)
+    switch = ConnectSwitch()
+    scanner = ScaleScanner(transport, scan_time=0.0, max_backoff=0.1)
+    scanner.start()
+    try:
+        # the cached scale is off, no connect attempt blocks on it
+        assert not try_connect_scale(scale, switch, profiles, scanner=scanner)
+        time.sleep(0.3)
+        assert not try_connect_scale(scale, switch, profiles, scanner=scanner)
+        assert transport.connects == 0
+        assert scanner.wanted.is_set()
+
+        transport.available = True
+        wait_for(lambda: try_connect_scale(scale, switch, profiles, scanner=scanner))
+        assert transport.connects == 1
+        assert scale.mac == SIMULATED_MAC
+        assert not scanner.has_available()
+    finally:
+        scanner.stop()
+        if scale.connected:
+            scale.disconnect()
+
+
+def test_scanner_connects_without_blocking(wait_for):
+    transport = SimulatedTransport(speed=50.0)
+    scale = AcaiaScale(mac='', transport=transport)
+    switch = ConnectSwitch()
+    scanner = ScaleScanner(transport, scan_time=0.2)
+    events = []
+    scanner.add_listener(events.append)
+    scanner.start()
+    try:
+        start = time.monotonic()
+        assert not try_connect_scale(scale, switch, scanner=scanner)
+        assert time.monotonic() - start < 0.1
+        wait_for(lambda: try_connect_scale(scale, switch, scanner=scanner))
+        assert scale.mac == SIMULATED_MAC
+        assert events[0].mac == SIMULATED_MAC
+        assert scanner.seen()[0].rssi == -60
+        assert not scanner.wanted.is_set()
+
+        switch.on = False
+        assert not try_connect_scale(scale, switch, scanner=scanner)
+        assert not scale.connected
+    finally:
+        scanner.stop()
+        if scale.connected:
+            scale.disconnect()
+
+
+def test_scanner_backs_off_and_respects_allowlist(wait_for):
+    transport = SimulatedTransport()
+    scanner = ScaleScanner(transport, allowlist=parse_mac_allowlist("11:22:33:44:55:66"), scan_time=0.0,
+                           max_backoff=0.2)
+    scanner.start()
+    try:
+        scanner.enable()
+        wait_for(lambda: scanner.scans >= 3)
+        # seen but not allowed
+        assert [d.mac for d in scanner.seen()] == [SIMULATED_MAC]
+        assert scanner.take_available() is None
+        scans = scanner.scans
+        time.sleep(0.3)
+        # nothing allowed turned up, so it pauses max_backoff between scans
+        assert scanner.scans - scans <= 2
+
+        assert scanner.disable()
+        scans = scanner.scans
+        time.sleep(0.3)
+        assert scanner.scans == scans
+    finally:
+        scanner.stop()
+
+
+def test_overshoot_estimate_rejects_outliers():
+    memory = TargetMemory("A")
+    memory.target = 36.0
+    rng = random.Random(5)
+    # a true overshoot of 3.2 g, each shot lands 3.2 - overshoot off the target give or take the noise
+    for _ in range(0, 4):
+        memory.update_overshoot(memory.target + 3.2 - memory.overshoot + rng.gauss(0, 0.2))
+    assert abs(memory.overshoot - 3.2) < 0.3
+    settled = memory.overshoot
+
+    # one bumped cup doesn't move it
+    memory.update_overshoot(memory.target + 4.0)
+    assert memory.overshoot == settled
+
+    # but a lasting change does, after a couple of shots
+    for _ in range(0, 6):
+        memory.update_overshoot(memory.target + 1.2 - memory.overshoot + rng.gauss(0, 0.1))
+    assert abs(memory.overshoot - 1.2) < 0.3
+
+
+def test_kalman_estimate_converges():
+    estimate = KalmanEstimate(0.0, variance=1.0, process_noise=0.0, measurement_noise=0.04)
+    rng = random.Random(2)
+    for _ in range(0, 20):
+        assert estimate.update(2.0 + rng.gauss(0, 0.2))
+    assert abs(estimate.value - 2.0) < 0.1
+    assert estimate.variance < 0.01
@@ -0,0 +1,156 @@
+# test_cutoff.py
+import time
+from threading import Event, Lock, Thread
+
+from lib import pyacaia
+from lib.acaia_sim import SIMULATED_MAC, ShotProfile, SimulatedTransport
+from lib.control import TargetMemory
+from lib.cutoff import CutoffEngine, estimate_flow, settle_time, settled_weight, wait_for_settle
+
+
+def test_estimate_flow_from_quantized_weights():
+    samples = [(i * 0.1, round(2.2 * i * 0.1, 1), i) for i in range(0, 40)]
+    assert abs(estimate_flow(samples) - 2.2) < 0.05
+    assert estimate_flow(samples[:3]) is None
+    assert estimate_flow([]) is None
+
+
+def test_cut_lands_between_samples(wait_for):
+    memory = TargetMemory("A")
+    memory.target = 10.0
+    memory.lag = 0.5
+    cuts = []
+    engine = CutoffEngine(cut=lambda: cuts.append(time.monotonic()))
+    engine.start_shot()
+    start = time.monotonic()
+    samples = []
+    # 10 g/s, so the relay has to go off at 0.5 s for 5 g in flight to land on 10 g
+    for i in range(0, 6):
+        time.sleep(max(start + i * 0.1 - time.monotonic(), 0))
+        if cuts:
+            break
+        samples.append((start + i * 0.1, i * 1.0, i + 1))
+        engine.on_weight(memory, samples)
+    wait_for(lambda: cuts)
+    assert len(cuts) == 1
+    assert abs(cuts[0] - (start + 0.5)) < 0.03
+    assert abs(engine.last_cut.predicted - 10.0) < 0.1
+
+    # 5.1 g arrived after the sample at 0.4 s, 1 g of it flowed before the cut
+    report = engine.finish_shot(memory, 4.0 + 0.1 * 10 + 5.1)
+    assert abs(report.error - 0.1) < 1e-9
+    assert abs(memory.lag - 0.51) < 0.03
+    # learned from what came in after the weight the cut was decided on, not the 0.1 g it missed by
+    assert abs(memory.overshoot - (report.final_weight - engine.last_cut.weight)) < 0.2
+
+
+def test_falls_back_to_overshoot_without_flow():
+    memory = TargetMemory("A")
+    memory.target = 10.0
+    memory.overshoot = 1.0
+    cuts = []
+    engine = CutoffEngine(cut=lambda: cuts.append(1))
+    samples = [(i * 0.1, 8.95 + i * 0.001, i) for i in range(0, 10)]
+    engine.on_weight(memory, samples[:5], now=0.5)
+    assert not cuts
+    engine.on_weight(memory, samples[:5] + [(0.6, 9.01, 6)], now=0.6)
+    assert cuts == [1]
+    assert engine.last_cut.flow < engine.min_flow
+    # low flow tells nothing about the lag
+    assert engine.finish_shot(memory, 9.4).lag is None
+    assert memory.lag == 1.0
+    # cut at the threshold, so the overshoot learns from where the shot ended
+    assert memory.overshoot < 1.0
+
+
+def test_cut_runs_outside_the_engine_lock():
+    memory = TargetMemory("A")
+    memory.target = 10.0
+    # apollo's cut_relay takes its own lock, which abandon_shot may hold while it cancels the engine
+    relay_lock = Lock()
+    cutting = Event()
+
+    def cut():
+        cutting.set()
+        with relay_lock:
+            pass
+    engine = CutoffEngine(cut=cut)
+    samples = [(i * 0.1, 8.95 + i * 0.001, i) for i in range(0, 6)] + [(0.6, 9.5, 6)]
+    with relay_lock:
+        notification = Thread(target=engine.on_weight, args=(memory, samples), kwargs={'now': 0.6})
+        notification.start()
+        assert cutting.wait(timeout=1.0)
+        # the engine is done deciding, cancelling doesn't wait on the cut in progress
+        canceller = Thread(target=engine.cancel)
+        canceller.start()
+        canceller.join(timeout=1.0)
+        assert not canceller.is_alive()
+    notification.join(timeout=1.0)
+    assert not notification.is_alive()
+    assert engine.last_cut.weight == 9.5
+
+
+def test_settle_waits_for_weight_to_stop_moving():
+    # drip tapering off after a cut at t=0, then flat at 36.4 from t=1.2
+    samples = [(i * 0.1, min(35.0 + i * 0.12, 36.4), i) for i in range(0, 30)]
+    assert settled_weight(samples[:15], 0.0, 1.5) is None
+    assert settled_weight(samples[:22], 0.0, 2.2) == 36.4
+    # no fresh samples, can't tell
+    assert settled_weight(samples[:22], 0.0, 3.0) is None
+
+    # the weight was still rising when samples stopped arriving
+    weights = pyacaia.WeightSamples()
+    start = time.monotonic()
+    for t, w, _ in samples[:15]:
+        weights.add(start + t - 1.5, w)
+    assert wait_for_settle(weights, start - 1.5, timeout=1.7) is None
+
+    weights = pyacaia.WeightSamples()
+    start = time.monotonic()
+    for t, w, _ in samples:
+        weights.add(start + t - 2.9, w)
+    assert wait_for_settle(weights, start - 2.9, timeout=1.0) == 36.4
+
+
+def test_settles_on_a_flickering_last_digit():
+    # 36.4 - 36.3 is just over 0.1 in floating point, one count of flicker still has to count as settled
+    samples = [(i * 0.1, 36.3 if i % 2 else 36.4, i) for i in range(0, 20)]
+    assert settled_weight(samples, 0.0, 1.95) == 36.3
+    assert settle_time(samples, 36.4) == 0.0
+
+
+def test_simulated_shots_converge_on_target(wait_for):
+    relay = [False]
+    transport = SimulatedTransport(profile=ShotProfile(phases=((1.0, 2.0),), drip_time=1.0), speed=4.0,
+                                   flowing=lambda: relay[0])
+    scale = pyacaia.AcaiaScale(mac=SIMULATED_MAC, transport=transport)
+    memory = TargetMemory("A")
+    memory.target = 14.0
+
+    def cut():
+        relay[0] = False
+    engine = CutoffEngine(cut=cut)
+
+    def on_weight(weight, arrival, sequence):
+        # like apollo, only a running shot gets cut
+        if relay[0]:
+            engine.on_weight(memory, scale.weight_samples.since(sequence - 32))
+    scale.add_weight_listener(on_weight)
+    scale.connect()
+    try:
+        errors = []
+        for _ in range(0, 3):
+            wait_for(lambda: scale.weight is not None)
+            scale.tare().result(timeout=1.0)
+            engine.start_shot()
+            relay[0] = True
+            wait_for(lambda: not relay[0])
+            # drip takes a simulated second
+            final = wait_for_settle(scale.weight_samples, engine.last_cut.cut_time, window=0.3)
+            assert final == scale.weight
+            errors.append(engine.finish_shot(memory, final).error)
+        # the default 1 s lag is four simulated seconds here, far more than the drip, after that it is learned
+        assert errors[0] < -3.0
+        assert abs(errors[1]) < 0.3 and abs(errors[2]) < 0.3
+    finally:
+        scale.disconnect()
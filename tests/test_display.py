@@ -41,3 +41,224 @@ def test_generate_frame_wide():
     data = DisplayData(234.1, 0.1, memory, flow_data, 59, True, 22.1, False)
     img = display.draw_frame_wide(320, 240, data)
     img.show()
+
+
+def test_background_cached_per_memory():
+    first = display.draw_background(240, 320, "A", "orange", True)
+    assert display.draw_background(240, 320, "A", "orange", True) is first
+    assert display.draw_background(240, 320, "B", "orange", True) is not first
+    assert display.draw_background_wide(320, 240, "A", "orange", True, True) is not \
+           display.draw_background_wide(320, 240, "A", "orange", True, False)
+
+
+def test_incremental_flow_graph():
+    graph = display.IncrementalFlowGraph("orange", max_points=200, min_points=50)
+    flow_data = []
+    surface = None
+    for i in range(0, 50):
+        flow_data.append(random.uniform(1.0, 5.0))
+        img = graph.update(flow_data, "orange")
+        # samples are appended to the same surface until the axis has to compress
+        assert surface is None or img is surface
+        surface = img
+    flow_data.append(2.0)
+    assert graph.update(flow_data, "orange") is not surface
+    assert graph.capacity == 100
+
+    # a new shot starts over
+    assert graph.update([1.0], "orange") is not surface
+    assert graph.drawn == 1
+
+
+def test_generate_frame_incremental():
+    memory = TargetMemory("F", "orange")
+    graph = display.IncrementalFlowGraph(max_points=600)
+    flow_data = []
+    surfaces = []
+    rng = random.Random(5)
+    for i in range(0, 200):
+        flow_data.append(rng.uniform(1.0, 5.0))
+        data = DisplayData(i / 10, 0.1, memory, flow_data, 59, True, i / 10, False)
+        img = display.draw_frame(240, 320, data, graph)
+        if graph.surface is not None and (not surfaces or surfaces[-1] is not graph.surface):
+            surfaces.append(graph.surface)
+    # one surface for the first samples, then a fresh one each time the axis doubled, 64 to 128 to 256
+    assert len(surfaces) == 3
+    assert graph.capacity == 256
+    # below the flow rate label in its top corner, the frame carries the graph as drawn on its surface
+    top = graph.y_pix // 2
+    graph_area = img.crop((0, 98 + top, graph.x_pix, 98 + graph.y_pix)).convert("RGB")
+    assert graph_area.tobytes() == graph.surface.crop((0, top, graph.x_pix, graph.y_pix)).convert("RGB").tobytes()
+    assert (255, 165, 0) in [color for _, color in graph_area.getcolors(maxcolors=65536)]
+
+
+def test_time_label_follows_graph_axis(monkeypatch):
+    memory = TargetMemory("F", "orange")
+    graph = display.IncrementalFlowGraph(max_points=600, min_points=64)
+    labels = []
+    text = display.label_glyphs.text
+    monkeypatch.setattr(display.label_glyphs, "text", lambda img, xy, s, color: labels.append(s) or text(img, xy, s, color))
+    # 30 points on an axis 64 wide, at 0.1s each the left edge is 6.4s back
+    data = DisplayData(3.0, 0.1, memory, [2.0] * 30, 59, True, 3.0, False)
+    display.draw_frame(240, 320, data, graph)
+    assert "7s" in labels
+    labels.clear()
+    # the axis doubled to 128 points
+    data = DisplayData(10.0, 0.1, memory, [2.0] * 100, 59, True, 10.0, False)
+    display.draw_frame_wide(320, 240, data, display.IncrementalFlowGraph(width_pixels=320, height_pixels=132))
+    assert "13s" in labels
+
+
+def test_display_state_snapshot():
+    from collections import deque
+    state = display.DisplayState(max_flow_points=10)
+    assert state.snapshot() is None
+
+    memory = TargetMemory("B", "#25a602")
+    memory.target = 36.5
+    smoothed = deque([])
+    for count in range(1, 26):
+        smoothed.append(count / 10)
+        if len(smoothed) > 8:
+            smoothed.popleft()
+        # publish only every few points so several new ones are shipped at once
+        if count % 3 == 0 or count == 25:
+            state.publish(DisplayData(12.3, 0.1, memory, None, 80, True, count / 10, count == 9, 4, smoothed,
+                                      count, count + 3))
+    data = state.snapshot()
+    assert data.flow_rate_moving_avg() == list(smoothed)
+    assert data.flow_points == 28
+    assert (data.weight, data.battery, data.paddle_on, data.memory.name, data.memory.target) == \
+           (12.3, 80, True, "B", 36.5)
+    # the save request was seen once and not repeated
+    assert data.save_image
+    assert not state.snapshot().save_image
+
+    # a new shot restarts the series
+    state.publish(DisplayData(0.0, 0.1, memory, None, 80, True, 0.1, False, 4, deque([0.5]), 1, 4))
+    assert state.snapshot().flow_rate_moving_avg() == [0.5]
+
+
+def test_visible_state_ignores_invisible_changes():
+    memory = TargetMemory("A")
+    data = DisplayData(12.31, 0.1, memory, [1.0], 80, False, 3.01, False)
+    assert DisplayData(12.34, 0.1, memory, [1.0], 80, False, 3.04, False).visible_state() == data.visible_state()
+    assert DisplayData(12.36, 0.1, memory, [1.0], 80, False, 3.04, False).visible_state() != data.visible_state()
+    assert DisplayData(12.31, 0.1, memory, [1.0, 2.0], 80, False, 3.01, False).visible_state() != \
+           data.visible_state()
+
+    # drawn on a graph the time axis shows its capacity, 64 points, whatever the few samples in it
+    graph = display.IncrementalFlowGraph(max_points=600)
+    flow = [1.0] * 20
+    data = DisplayData(12.31, 0.1, memory, flow, 80, True, 3.01, False, flow_smooth_factor=4)
+    assert data.visible_state(graph)[-1] == "7s"
+    assert DisplayData(12.31, 0.1003, memory, flow, 80, True, 3.01, False,
+                       flow_smooth_factor=4).visible_state(graph) == data.visible_state(graph)
+    assert DisplayData(12.31, 0.1, memory, [1.0] * 70, 80, True, 3.01, False,
+                       flow_smooth_factor=4).visible_state(graph)[-1] == "13s"
+
+
+def test_frame_sender_drops_stale_frames():
+    import threading
+    import time
+
+    class SlowLcd:
+        def __init__(self):
+            self.shown = []
+            self.invalidated = 0
+            self.release = threading.Event()
+
+        def invalidate_framebuffers(self):
+            self.invalidated += 1
+
+        def ShowImage(self, img, x, y, partial=False):
+            self.release.wait()
+            self.shown.append(img)
+            return 0
+
+    lcd = SlowLcd()
+    sender = display.FrameSender(lcd)
+    sender.start()
+    frames = ["first", "second", "third", "fourth"]
+    sender.submit(frames[0])
+    time.sleep(0.05)
+    # the sender is busy with the first frame, only the newest of the rest survives
+    sender.submit(frames[1], invalidate=True)
+    sender.submit(frames[2])
+    sender.submit(frames[3])
+    lcd.release.set()
+    deadline = time.monotonic() + 2
+    while len(lcd.shown) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert lcd.shown == ["first", "fourth"]
+    assert sender.frames_dropped == 2
+    assert lcd.invalidated == 1
+
+
+def test_frame_sender_survives_panel_errors():
+    import time
+
+    class FlakyLcd:
+        def __init__(self):
+            self.shown = []
+            self.invalidated = 0
+
+        def invalidate_framebuffers(self):
+            self.invalidated += 1
+
+        def ShowImage(self, img, x, y, partial=False):
+            if img == "broken":
+                raise OSError("SPI transfer failed")
+            self.shown.append(img)
+            return 0
+
+    lcd = FlakyLcd()
+    sender = display.FrameSender(lcd)
+    sender.start()
+    sender.submit("broken")
+    deadline = time.monotonic() + 2
+    while sender.frames_failed < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    sender.submit("next")
+    while not lcd.shown and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert lcd.shown == ["next"]
+    assert sender.frames_failed == 1
+    # the frame after a failed one is sent in full
+    assert lcd.invalidated == 1
+
+
+def test_frame_sender_blanks_in_order():
+    import threading
+    import time
+
+    class RecordingLcd:
+        def __init__(self):
+            self.calls = []
+            self.done = threading.Event()
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: self.calls.append(name)
+
+        def ShowImage(self, img, x, y, partial=False):
+            self.calls.append(img)
+            if img == "after":
+                self.done.set()
+            return 0
+
+    lcd = RecordingLcd()
+    sender = display.FrameSender(lcd, panel_on=False)
+    sender.start()
+    sender.submit("before")
+    sender.blank()
+    sender.submit("after")
+    assert lcd.done.wait(2)
+    time.sleep(0.05)
+    # whatever got dropped on the way, the panel ends up on and showing the last frame
+    assert lcd.calls[-3:] == ["PanelOn", "On", "after"]
+    assert lcd.calls[:2] == ["PanelOn", "On"]
+    sender.blank()
+    deadline = time.monotonic() + 2
+    while lcd.calls[-1] != "PanelOff" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert lcd.calls[-3:] == ["Off", "fill", "PanelOff"]
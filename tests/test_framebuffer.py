@@ -0,0 +1,56 @@
+# test_framebuffer.py
+import numpy as np
+from PIL import Image
+
+from lib.framebuffer import Framebuffer
+
+
+def legacy_rgb565(img: Image) -> bytes:
+    # conversion ShowImage used before the framebuffer path
+    rgb = np.asarray(img)
+    pix = np.zeros((img.size[1], img.size[0], 2), dtype=np.uint8)
+    pix[..., [0]] = np.add(np.bitwise_and(rgb[..., [0]], 0xF8), np.right_shift(rgb[..., [1]], 5))
+    pix[..., [1]] = np.add(np.bitwise_and(np.left_shift(rgb[..., [1]], 3), 0xE0), np.right_shift(rgb[..., [2]], 3))
+    return bytes(pix.flatten().tolist())
+
+
+def test_pack_matches_legacy_conversion():
+    rng = np.random.default_rng(1)
+    for size in ((240, 320), (320, 240)):
+        data = rng.integers(0, 256, (size[1], size[0], 4), dtype=np.uint8)
+        img = Image.fromarray(data, "RGBA")
+        fb = Framebuffer(*size)
+        fb.pack(img)
+        assert fb.buffer.nbytes == size[0] * size[1] * 2
+        assert bytes(fb.buffer) == legacy_rgb565(img)
+
+
+def test_damage_tracks_changed_tiles():
+    img = Image.new("RGBA", (240, 320), "BLACK")
+    fb = Framebuffer(240, 320)
+    fb.pack(img)
+    # nothing has been sent yet, so the whole frame goes out
+    assert fb.damage() is None
+    fb.commit()
+
+    fb.pack(img)
+    assert fb.damage() == []
+
+    img.putpixel((20, 40), (255, 255, 255, 255))
+    img.putpixel((21, 50), (255, 255, 255, 255))
+    img.putpixel((239, 319), (255, 255, 255, 255))
+    fb.pack(img)
+    assert fb.damage() == [(16, 32, 32, 64), (224, 304, 240, 320)]
+
+    fb.invalidate()
+    assert fb.damage() is None
+
+
+def test_damage_falls_back_to_full_frame():
+    fb = Framebuffer(240, 320)
+    fb.pack(Image.new("RGBA", (240, 320), "BLACK"))
+    fb.commit()
+    fb.pack(Image.new("RGBA", (240, 320), "WHITE"))
+    assert fb.damage() is None
+    region = fb.region(0, 16, 240, 32)
+    assert region.nbytes == 240 * 16 * 2
@@ -0,0 +1,18 @@
+# test_glyphs.py
+from PIL import Image, ImageChops, ImageDraw
+
+from lib import display
+from lib.glyphs import GlyphAtlas
+
+
+def test_atlas_matches_freetype_text():
+    atlas = GlyphAtlas(display.label_font, labels=("timer:",))
+    for text in ("timer:22.1s", "-3.4", "battery:59%"):
+        expected = Image.new("RGBA", (200, 40), "BLACK")
+        draw = ImageDraw.Draw(expected)
+        assert atlas.textlength(text) == draw.textlength(text, display.label_font)
+        draw.text((4, 6), text, "WHITE", display.label_font)
+
+        img = Image.new("RGBA", (200, 40), "BLACK")
+        atlas.text(img, (4, 6), text, "WHITE")
+        assert ImageChops.difference(expected, img).getbbox() is None
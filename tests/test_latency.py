@@ -0,0 +1,68 @@
+# test_latency.py
+import time
+
+from lib.control import TargetMemory
+from lib.cutoff import CutoffEngine, settle_time
+from lib.latency import LatencyTracker, RollingHistogram, ShotLatency
+
+
+def test_histogram_keeps_only_the_window():
+    histogram = RollingHistogram(window=4)
+    for ms in (0.05, 3.0, 3.0, 700.0, 9000.0, 1.5):
+        histogram.add(ms)
+    stats = histogram.snapshot()
+    assert stats['count'] == 4
+    assert stats['total'] == 6
+    assert stats['max'] == 9000.0
+    assert stats['buckets']['<=0.1'] == 0
+    assert stats['buckets']['<=2'] == 1
+    assert stats['buckets']['<=5'] == 1
+    assert stats['buckets']['<=1000'] == 1
+    assert stats['buckets']['>5000'] == 1
+    assert sum(stats['buckets'].values()) == 4
+
+
+def test_scheduled_cut_only_counts_timer_lateness():
+    shot = ShotLatency("A", arrival=10.0, decoded=10.002, planned=10.15, decided=10.151, relay_off=10.1512)
+    stages = shot.breakdown()
+    assert stages['scheduled']
+    assert abs(stages['decode'] - 2.0) < 1e-6
+    assert abs(stages['decision'] - 1.0) < 1e-6
+    assert abs(stages['relay'] - 0.2) < 1e-6
+    assert abs(stages['total'] - 151.2) < 1e-6
+    assert stages['settle'] is None
+
+    tracker = LatencyTracker()
+    tracker.cut(shot)
+    tracker.settled(shot, 11.4512, 36.4)
+    snapshot = tracker.snapshot()
+    assert abs(snapshot['shots'][0]['settle'] - 1300.0) < 1e-6
+    assert snapshot['shots'][0]['final_weight'] == 36.4
+    assert snapshot['stages']['relay']['count'] == 1
+    assert snapshot['stages']['settle']['count'] == 1
+
+
+def test_engine_records_the_deciding_sample():
+    memory = TargetMemory("A")
+    memory.target = 10.0
+    memory.lag = 0.5
+    engine = CutoffEngine(cut=lambda: None)
+    engine.start_shot()
+    now = time.monotonic()
+    # 10 g/s and 9.5 g already, way past the cut point
+    samples = [(now - 0.402 + i * 0.1, 5.5 + i * 1.0, i + 1) for i in range(0, 5)]
+    engine.on_weight(memory, samples, now=now, decoded=now - 0.001)
+    cut = engine.last_cut
+    assert cut.sample_time == samples[-1][0]
+    assert cut.decoded == now - 0.001
+    assert cut.planned == cut.sample_time
+    assert cut.decided >= now
+    stages = ShotLatency("A", cut.sample_time, cut.decoded, cut.planned, cut.decided, time.monotonic()).breakdown()
+    assert not stages['scheduled']
+    assert 0 <= stages['decision'] < 50
+
+
+def test_settle_time_is_where_the_weight_stopped_moving():
+    samples = [(i * 0.1, min(35.0 + i * 0.12, 36.4), i) for i in range(0, 30)]
+    assert abs(settle_time(samples, 36.4) - 1.1) < 1e-9
+    assert settle_time(samples + [(3.0, 36.9, 30)], 36.4) is None
@@ -0,0 +1,52 @@
+# test_periodic.py
+import time
+
+from lib.periodic import PeriodicThread
+
+
+def test_period_does_not_drift_with_work():
+    starts = []
+
+    def tick():
+        starts.append(time.monotonic())
+        time.sleep(0.005)
+
+    thread = PeriodicThread("test", 0.02, tick)
+    thread.start()
+    time.sleep(0.5)
+    thread.stop()
+    thread.join()
+    # ticks start on the start + n * period grid, sleeping the period after the work would shift every
+    # one of them another quarter period further off it
+    offsets = [((start - starts[0]) / 0.02) % 1 for start in starts]
+    assert len([offset for offset in offsets if min(offset, 1 - offset) < 0.2]) >= 0.9 * len(starts)
+    stats = thread.stats()
+    assert stats['ticks'] == len(starts)
+    assert 0.004 < stats['work_p50'] < 0.015
+    assert stats['jitter_p50'] < 0.005
+
+
+def test_overruns_skip_missed_deadlines():
+    count = 0
+
+    def tick():
+        nonlocal count
+        count += 1
+        if count == 3:
+            # ends halfway between the second and third deadline after its own
+            time.sleep(0.125)
+        if count == 5:
+            raise ValueError("broken tick")
+
+    thread = PeriodicThread("test", 0.05, tick, history=4)
+    thread.start()
+    time.sleep(0.6)
+    thread.stop()
+    thread.join()
+    stats = thread.stats()
+    assert stats['overruns'] == 1
+    assert stats['skipped'] == 2
+    assert stats['errors'] == 1
+    assert stats['ticks'] == count
+    # the ticks after the slow one start on the regular grid again instead of running back to back
+    assert stats['jitter_max'] < 0.025
@@ -0,0 +1,383 @@
+# test_pyacaia.py
+import random
+import time
+
+from lib import pyacaia
+from lib import acaia_replay
+from lib.acaia_sim import SIMULATED_MAC, ShotProfile, SimulatedTransport
+from lib.pyacaia import PacketFramer
+
+
+def weight_message(grams: float) -> bytes:
+    raw = round(abs(grams) * 10)
+    sign = 0x02 if grams < 0 else 0x00
+    return bytes(pyacaia.encodeEventData([5, raw & 0xff, (raw >> 8) & 0xff, (raw >> 16) & 0xff, 0, 1, sign]))
+
+
+def settings_message(battery: int) -> bytes:
+    return bytes(pyacaia.encode(8, [11, battery, 2, 0, 6, 0, 1, 0, 0, 0, 0]))
+
+
+def decode_stream(framer: PacketFramer, chunks) -> list:
+    decoded = []
+    for chunk in chunks:
+        framer.feed(chunk)
+        while True:
+            frame = framer.next()
+            if frame is None:
+                break
+            try:
+                msg = pyacaia.decodeFrame(frame)
+            except pyacaia.ChecksumError:
+                framer.reject()
+                continue
+            if isinstance(msg, pyacaia.Message):
+                decoded.append(msg.value)
+            elif isinstance(msg, pyacaia.Settings):
+                decoded.append("battery:%d" % msg.battery)
+    return decoded
+
+
+def random_chunks(stream: bytes, rng: random.Random) -> list:
+    chunks = []
+    i = 0
+    while i < len(stream):
+        size = rng.randint(1, 40)
+        chunks.append(stream[i:i + size])
+        i += size
+    return chunks
+
+
+def test_framer_reassembles_split_notifications():
+    rng = random.Random(7)
+    expected = []
+    stream = b""
+    for i in range(0, 2000):
+        if i % 50 == 0:
+            stream += settings_message(i % 100)
+            expected.append("battery:%d" % (i % 100))
+        grams = round(rng.uniform(-20.0, 500.0), 1)
+        stream += weight_message(grams)
+        expected.append(grams)
+
+    framer = PacketFramer(capacity=256)
+    assert decode_stream(framer, random_chunks(stream, rng)) == expected
+    assert framer.discarded == 0
+    assert len(framer) == 0
+
+
+def test_framer_resyncs_after_garbage():
+    rng = random.Random(11)
+    framer = PacketFramer(capacity=256)
+    # noise without header bytes, any amount of it, including more than the buffer holds
+    noise = bytes(rng.choice([b for b in range(256) if b not in (pyacaia.HEADER1, pyacaia.HEADER2)])
+                  for _ in range(0, 1000))
+    stream = noise[:5] + weight_message(12.5) + noise + weight_message(13.0) + noise[:37] + weight_message(-1.5)
+    assert decode_stream(framer, random_chunks(stream, rng)) == [12.5, 13.0, -1.5]
+    assert framer.discarded == 5 + 1000 + 37
+
+
+def test_framer_survives_corrupted_length():
+    weights = [18.2, 18.4, 18.6]
+    valid = b"".join(weight_message(grams) for grams in weights)
+    framer = PacketFramer(capacity=256)
+    # longer than any message, nothing waits for the 200 bytes it claims
+    corrupt = bytearray(weight_message(18.0))
+    corrupt[3] = 200
+    assert decode_stream(framer, [bytes(corrupt) + valid]) == weights
+    # plausible but wrong, the frame swallows the next one and fails its checksum
+    corrupt[3] = 20
+    assert decode_stream(framer, [bytes(corrupt) + valid]) == weights
+    # a header inside a payload
+    corrupt = bytearray(weight_message(18.0))
+    corrupt[5:7] = PacketFramer.HEADER
+    assert decode_stream(framer, [bytes(corrupt) + valid]) == weights
+    assert len(framer) == 0
+
+
+def test_scale_skips_undecodable_frames():
+    scale = pyacaia.AcaiaScale(mac='', transport=SimulatedTransport())
+    weights = []
+    scale.add_weight_listener(lambda weight, arrival, sequence: weights.append(weight))
+    # a good checksum around a weight in a unit the decoder doesn't know
+    bad_unit = bytes(pyacaia.encodeEventData([5, 182, 0, 0, 0, 9, 0]))
+    scale.callback_queue(weight_message(18.0) + bad_unit + weight_message(18.2))
+    assert weights == [18.0, 18.2]
+    assert scale.link_stats()['decode_errors'] == 1
+    assert scale.checksum_errors == 0
+
+
+def test_framer_fuzz_random_bytes():
+    rng = random.Random(3)
+    framer = PacketFramer(capacity=128)
+    for _ in range(0, 2000):
+        chunk = bytes(rng.randint(0, 255) for _ in range(rng.randint(0, 300)))
+        if rng.random() < 0.3:
+            chunk += bytes([pyacaia.HEADER1, pyacaia.HEADER2])
+        framer.feed(chunk)
+        while True:
+            frame = framer.next()
+            if frame is None:
+                break
+            assert bytes(frame[:2]) == PacketFramer.HEADER
+            try:
+                pyacaia.decodeFrame(frame)
+            except (IndexError, ValueError):
+                # garbage that happens to start with a header, rejected by the decoders
+                pass
+        assert 0 <= framer.start <= framer.end <= framer.capacity
+
+
+def test_framer_throughput():
+    stream = b"".join(weight_message(i / 10) for i in range(0, 1000))
+    chunks = [stream[i:i + 20] for i in range(0, len(stream), 20)]
+    framer = PacketFramer()
+    start = time.perf_counter()
+    for _ in range(0, 10):
+        assert len(decode_stream(framer, chunks)) == 1000
+    elapsed = time.perf_counter() - start
+    # a scale sends ~10 weights per second, this has orders of magnitude of headroom
+    assert 10000 / elapsed > 5000
+
+
+def test_decode_rejects_bad_checksum():
+    frame = bytearray(weight_message(18.2))
+    assert pyacaia.decodeFrame(memoryview(frame)).value == 18.2
+    frame[6] ^= 0x01
+    try:
+        pyacaia.decodeFrame(memoryview(frame))
+        assert False, "corrupted frame was accepted"
+    except pyacaia.ChecksumError:
+        pass
+    (msg, rest) = pyacaia.decode(frame + bytearray(weight_message(3.0)))
+    assert msg is None
+    assert pyacaia.decode(rest)[0].value == 3.0
+
+
+def test_decode_buttons():
+    tare = bytes(pyacaia.encodeEventData([8, 0, 5, 0x34, 0x12, 0, 0, 1, 0]))
+    msg = pyacaia.decodeFrame(memoryview(tare))
+    assert (msg.button, msg.value) == ('tare', 466.0)
+
+    stop = bytes(pyacaia.encodeEventData([8, 10, 7, 0, 25, 3, 0, 0x2c, 0x01, 0, 0, 1, 0]))
+    msg = pyacaia.decodeFrame(memoryview(stop))
+    assert (msg.button, msg.time, msg.value) == ('stop', 25.3, 30.0)
+
+    unknown = bytes(pyacaia.encodeEventData([8, 1, 1]))
+    assert pyacaia.decodeFrame(memoryview(unknown)).button == 'unknownbutton'
+
+
+def test_weight_samples_since():
+    samples = pyacaia.WeightSamples(capacity=8)
+    assert samples.latest() is None
+    assert samples.since(0) == []
+    for i in range(1, 6):
+        assert samples.add(i / 10, i * 2.0) == i
+    assert samples.since(3) == [(0.4, 8.0, 4), (0.5, 10.0, 5)]
+    for i in range(6, 21):
+        samples.add(i / 10, i * 2.0)
+    # older samples were overwritten
+    assert [s[2] for s in samples.since(3)] == list(range(13, 21))
+    assert samples.latest() == (2.0, 40.0, 20)
+    assert samples.since(20) == []
+
+
+def test_weight_listeners_fire_per_notification():
+    scale = pyacaia.AcaiaScale(mac='', transport=SimulatedTransport())
+    scale.queue = pyacaia.Queue(scale.callback_queue)
+    seen = []
+    scale.add_weight_listener(lambda weight, arrival, sequence: seen.append((weight, sequence)))
+
+    def broken_listener(weight, arrival, sequence):
+        raise RuntimeError("listener errors must not stop decoding")
+    scale.add_weight_listener(broken_listener)
+
+    scale.handleNotification(0, weight_message(1.0) + weight_message(1.5)[:4])
+    scale.handleNotification(0, weight_message(1.5)[4:])
+    assert seen == [(1.0, 1), (1.5, 2)]
+    assert scale.weight == 1.5
+
+
+def test_shot_profile_integrates_phases():
+    profile = ShotProfile(phases=((2.0, 0.0), (2.0, 2.0), (10.0, 2.0)))
+    assert profile.flow_at(1.0) == 0.0
+    assert profile.flow_at(3.0) == 1.0
+    assert profile.weight_at(2.0) == 0.0
+    assert profile.weight_at(4.0) == 2.0
+    assert profile.weight_at(9.0) == 12.0
+    # flow holds after the last phase
+    assert profile.weight_at(20.0) == 34.0
+
+
+def test_simulated_scale_streams_through_decoder(wait_for):
+    flowing = [True]
+    transport = SimulatedTransport(profile=ShotProfile(phases=((1.0, 2.0),), drip_time=1.0), rate=10.0,
+                                   jitter=0.03, drop=0.05, split=0.3, speed=50.0, flowing=lambda: flowing[0],
+                                   seed=3)
+    scale = pyacaia.AcaiaScale(mac=SIMULATED_MAC, transport=transport)
+    scale.connect()
+    try:
+        assert scale.connected
+        wait_for(lambda: scale.weight is not None and scale.weight > 30.0)
+        assert scale.battery == 80
+
+        flowing[0] = False
+        wait_for(lambda: transport.stopped_at is not None and transport.clock() > transport.stopped_at + 2.0)
+        # a 1s ramp to 2 g/s puts 2t - 1 grams in by the time flow stops, the drip adds another gram
+        assert abs(transport.poured - 2 * transport.shot_time) < 0.001
+        wait_for(lambda: scale.weight == round(transport.poured, 1))
+
+        scale.tare()
+        wait_for(lambda: scale.weight == 0.0)
+        assert 4 in transport.commands
+    finally:
+        scale.disconnect()
+    assert not scale.connected
+    assert transport.dropped > 0 and transport.splits > 0
+    assert scale.checksum_errors == 0
+    assert scale.framer.discarded == 0
+
+
+def test_capture_replays_through_decoder(tmp_path):
+    path = str(tmp_path / "notifications.bin")
+    stream = b"".join(weight_message(i / 2) for i in range(0, 40)) + settings_message(55)
+    chunks = random_chunks(stream, random.Random(11))
+
+    scale = pyacaia.AcaiaScale(mac='', transport=SimulatedTransport())
+    scale.queue = pyacaia.Queue(scale.callback_queue)
+    scale.start_capture(path)
+    for chunk in chunks:
+        scale.handleNotification(14, chunk)
+    scale.stop_capture()
+    # a log cut short mid-record still reads up to the last complete one
+    with open(path, 'ab') as f:
+        f.write(pyacaia.CAPTURE_RECORD.pack(1.0, 10) + b"\x01")
+
+    records = list(pyacaia.read_capture(path))
+    assert [payload for _, payload in records] == chunks
+    assert all(a[0] <= b[0] for a, b in zip(records, records[1:]))
+
+    replayed = pyacaia.AcaiaScale(mac='', transport=SimulatedTransport())
+    weights = []
+    replayed.add_weight_listener(lambda weight, arrival, sequence: weights.append(weight))
+    assert acaia_replay.replay(replayed, path, speed=0) == len(chunks)
+    assert weights == [i / 2 for i in range(0, 40)]
+    assert replayed.battery == 55
+
+
+def test_command_queue_urgent_lane_first():
+    wakes = []
+    queue = pyacaia.CommandQueue(wake=lambda: wakes.append(1))
+    heartbeat = pyacaia.Command(pyacaia.encodeHeartbeat())
+    start = pyacaia.Command(pyacaia.encodeStartTimer())
+    tare = pyacaia.Command(pyacaia.encodeTare(), ack='tare')
+    queue.add(heartbeat)
+    queue.add(start)
+    future = queue.add(tare, urgent=True)
+    assert len(wakes) == 3
+    assert [queue.dequeue(), queue.dequeue()] == [tare, heartbeat]
+
+    queue.fail(ConnectionError("gone"))
+    assert queue.dequeue() is None
+    assert isinstance(start.future.exception(), ConnectionError)
+    assert not future.done()
+
+
+def test_tare_resolves_on_acknowledgement(wait_for):
+    transport = SimulatedTransport(profile=ShotProfile(phases=((1.0, 5.0),)), rate=10.0)
+    scale = pyacaia.AcaiaScale(mac=SIMULATED_MAC, transport=transport)
+    scale.connect()
+    try:
+        wait_for(lambda: scale.weight is not None and scale.weight > 0.0)
+        sent = time.monotonic()
+        future = scale.tare()
+        assert future.result(timeout=1.0) == 0.0
+        # written straight away rather than after the heartbeat's wait runs out
+        assert time.monotonic() - sent < 0.2
+        assert scale.awaiting_ack == []
+        assert scale.stopTimer().result(timeout=1.0) is None
+    finally:
+        scale.disconnect()
+
+    # nothing is written once disconnected
+    assert scale.tare() is False
+    scale.command_queue.add(pyacaia.Command(pyacaia.encodeTare()))
+    scale.disconnect()
+    assert len(scale.command_queue) == 0
+
+
+def test_link_stats_snapshot():
+    link = pyacaia.LinkStats(capacity=64)
+    link.connected(0.0)
+    for i in range(0, 100):
+        # every tenth gap is 0.3 s instead of 0.1 s
+        link.notification(i * 0.1 + (i // 10) * 0.2)
+    now = 99 * 0.1 + 9 * 0.2
+    assert link.rate(1.0, now) == 10.0
+    stats = link.snapshot(window=10.0, now=now)
+    assert stats['notifications'] == 100
+    assert abs(stats['interval_p50'] - 0.1) < 1e-9
+    assert abs(stats['interval_max'] - 0.3) < 1e-9
+    assert stats['reconnects'] == 0
+
+    link.lost(now)
+    link.weight(now + 1.0)
+    # still lost until connected again
+    assert len(link.recoveries) == 0
+    link.connected(now + 2.0)
+    link.weight(now + 2.5)
+    assert link.snapshot(now=now + 3.0)['recovery_last'] == 2.5
+    assert link.snapshot(now=now + 3.0)['reconnects'] == 1
+
+
+def test_watchdog_reconnects_stalled_link(wait_for):
+    shot = [True]
+    transport = SimulatedTransport(rate=10.0, speed=1.0)
+    scale = pyacaia.AcaiaScale(mac=SIMULATED_MAC, transport=transport)
+    watchdog = pyacaia.LinkWatchdog(scale, lambda: shot[0], min_rate=3.0, window=0.5, recovery_timeout=1.0,
+                                    interval=0.05)
+    scale.connect()
+    watchdog.start()
+    try:
+        wait_for(lambda: scale.weight_samples.sequence > 5)
+        assert scale.link_stats()['stalls'] == 0
+        transport.stalled = True
+        wait_for(lambda: scale.link.stalls == 1 and scale.link.recoveries)
+        stats = scale.link_stats()
+        assert stats['reconnects'] == 1
+        # half a second to notice, half a second in connect(), and the next weight
+        assert stats['recovery_last'] < 1.5
+        assert scale.connected
+
+        # only watched while the shot is on
+        shot[0] = False
+        transport.stalled = True
+        time.sleep(0.8)
+        assert scale.link.stalls == 1
+    finally:
+        watchdog.stop()
+        scale.disconnect()
+
+
+def test_watchdog_gives_up_on_a_lost_scale(wait_for):
+    shot = [True]
+    transport = SimulatedTransport(rate=10.0, speed=1.0)
+    scale = pyacaia.AcaiaScale(mac=SIMULATED_MAC, transport=transport)
+    watchdog = pyacaia.LinkWatchdog(scale, lambda: shot[0], min_rate=3.0, window=0.5, recovery_timeout=0.5,
+                                    interval=0.05, give_up=lambda: shot.__setitem__(0, False))
+    scale.connect()
+    watchdog.start()
+    try:
+        wait_for(lambda: scale.weight_samples.sequence > 5)
+        # the scale switched off mid-shot, reconnecting can't work
+        transport.stalled = True
+        transport.available = False
+        stalled_at = time.monotonic()
+        wait_for(lambda: not shot[0])
+        assert time.monotonic() - stalled_at < 0.5 + 0.5 + 0.2
+        assert watchdog.gave_up == 1
+        assert scale.link_stats()['stalls'] == 1
+        assert not scale.connected
+    finally:
+        watchdog.stop()
+        watchdog.reconnector.join(timeout=2.0)